@@ -0,0 +1,340 @@
+import os
+import time
+import argparse
+import numpy as np
+import pandas as pd
+from scipy.spatial.distance import cdist
+
+from covoiturage_solver import (MAX_STOPS, solve_covoiturage, detour_matrix, savings_candidates, merge_routes,
+                                _merge_block_numba, sparse_distance_matrix, solve_arrays, route_stats, assign_sites,
+                                pool_within_communes, improve_routes)
+
+# Mêmes paramètres que covoiturage_app.py
+CHU_SITES = {
+    "Pontchaillou": (-1.6948973, 48.1189081),
+    "Hôpital Sud": (-1.6556722, 48.0837382),
+}
+CHU_COORDS = CHU_SITES["Pontchaillou"] # Lon, Lat
+AVG_SPEED_KMH = 50
+TORTUOSITY = 1.3
+GEOJSON_PATH = "communes-version-simplifiee.geojson"
+DENSE_MAX_NODES = 5000 # Au-delà, les matrices denses ne sont pas construites
+SPARSE_TARGET_S = 0.1 # Objectif de résolution par facteur en mode knn (échelle nationale, ~35 000 communes)
+
+# --- Données ---
+
+def load_geojson_nodes(path):
+    """
+    Noeuds (centroïdes des communes) et coordonnées Lambert 93, comme load_data() de l'application.
+    Renvoie aussi les coordonnées Lambert 93 des sites du CHU (dist_CHU / time_CHU : premier site).
+    """
+    import geopandas as gpd
+
+    gdf = gpd.read_file(path)
+    if gdf.crs != "EPSG:4326":
+        gdf = gdf.to_crs(epsg=4326)
+    gdf_proj = gdf.to_crs(epsg=2154)
+    centroids = gdf_proj.geometry.centroid
+    lons, lats = zip(*CHU_SITES.values())
+    chu_points = gpd.points_from_xy(lons, lats, crs="EPSG:4326").to_crs(epsg=2154)
+    sites_m = np.column_stack([chu_points.x, chu_points.y])
+
+    coords = np.column_stack([centroids.x, centroids.y])
+    nodes = pd.DataFrame({'code': gdf['code'].values, 'nom': gdf['nom'].values})
+    centroids_wgs = centroids.to_crs(epsg=4326)
+    nodes['lon'] = centroids_wgs.x.values
+    nodes['lat'] = centroids_wgs.y.values
+    nodes['dist_CHU'] = (np.linalg.norm(coords - sites_m[0], axis=1) / 1000) * TORTUOSITY
+    nodes['time_CHU'] = (nodes['dist_CHU'] / AVG_SPEED_KMH) * 60
+    return nodes, coords, sites_m
+
+def synthetic_nodes(n, seed=0):
+    """
+    Communes fictives dans un rayon de ~60 km autour du CHU (Lambert 93).
+    Le second site est placé comme l'Hôpital Sud par rapport à Pontchaillou (~3 km à l'est, ~4 km au sud).
+    """
+    rng = np.random.default_rng(seed)
+    chu = np.array([351000.0, 6790000.0])
+    sites_m = np.array([chu, chu + [2900.0, -3900.0]])
+    coords = chu + rng.normal(scale=30000, size=(n, 2))
+    nodes = pd.DataFrame({'code': np.arange(n).astype(str), 'nom': [f"commune {i}" for i in range(n)]})
+    nodes['dist_CHU'] = (np.linalg.norm(coords - chu, axis=1) / 1000) * TORTUOSITY
+    nodes['time_CHU'] = (nodes['dist_CHU'] / AVG_SPEED_KMH) * 60
+    return nodes, coords, sites_m
+
+def distance_matrices(coords):
+    mat_dist_km = (cdist(coords, coords, metric='euclidean') / 1000) * TORTUOSITY
+    mat_time_min = (mat_dist_km / AVG_SPEED_KMH) * 60
+    return mat_dist_km, mat_time_min
+
+# --- Implémentation d'origine (référence pour vérifier l'identité des routes) ---
+
+def solve_covoiturage_reference(nodes, mat_dist_km, mat_time_min, benefit_factor):
+    n_nodes = len(nodes)
+    routes = [{'id': i, 'driver': i, 'stops': [i], 'load': 0} for i in range(n_nodes)]
+
+    time_chu = nodes['time_CHU'].values
+    dist_chu = nodes['dist_CHU'].values
+    detour_mat = mat_time_min + time_chu[None, :] - time_chu[:, None]
+    score_mat = (dist_chu * benefit_factor)[None, :] - detour_mat
+    np.fill_diagonal(score_mat, -np.inf)
+
+    rows, cols = np.where(score_mat > 0)
+    candidates = pd.DataFrame({'i': rows, 'j': cols, 'score': score_mat[rows, cols]})
+    candidates = candidates.sort_values('score', ascending=False, kind='stable').reset_index(drop=True)
+
+    node_to_route = list(range(n_nodes))
+    route_active = [True] * n_nodes
+    for idx, row in candidates.iterrows():
+        i = int(row['i'])
+        j = int(row['j'])
+        r_i_idx = node_to_route[i]
+        r_j_idx = node_to_route[j]
+        if r_i_idx == r_j_idx or not route_active[r_i_idx] or not route_active[r_j_idx]:
+            continue
+        r_i = routes[r_i_idx]
+        r_j = routes[r_j_idx]
+        if (r_i['load'] + r_j['load'] + 1) > MAX_STOPS:
+            continue
+        if i == r_i['stops'][-1] and j == r_j['stops'][0]:
+            routes[r_i_idx]['stops'].extend(r_j['stops'])
+            routes[r_i_idx]['load'] += r_j['load'] + 1
+            for node_idx in r_j['stops']:
+                node_to_route[node_idx] = r_i_idx
+            route_active[r_j_idx] = False
+
+    return [r for idx, r in enumerate(routes) if route_active[idx]]
+
+def add_routes_reference(m, routes, nodes, site_coords):
+    """
+    Rendu d'origine de l'application : un PolyLine et des CircleMarker folium par route, via nodes.loc.
+    """
+    import folium
+
+    colors = ["#3498db", "#f1c40f", "#e67e22", "#e74c3c"]
+    for r in routes:
+        load = min(r['load'], 3)
+        col = colors[load]
+        path_ids = r['stops']
+        route_coords = []
+        for pid in path_ids:
+            route_coords.append([nodes.loc[pid, 'lat'], nodes.loc[pid, 'lon']])
+        site_lon, site_lat = site_coords[nodes.loc[path_ids[0], 'site']]
+        route_coords.append([site_lat, site_lon])
+        folium.PolyLine(route_coords, color=col, weight=4 if load > 0 else 2, opacity=0.8,
+                        popup=f"Passagers: {load}").add_to(m)
+        driver_node = nodes.loc[path_ids[0]]
+        folium.CircleMarker(location=[driver_node.lat, driver_node.lon], radius=5, color=col, fill=True,
+                            fill_opacity=1, popup=f"<b>Conducteur</b>: {driver_node['nom']}").add_to(m)
+        for pid in path_ids[1:]:
+            p_node = nodes.loc[pid]
+            folium.CircleMarker(location=[p_node.lat, p_node.lon], radius=3, color="black", fill=True,
+                                fill_color="white", fill_opacity=1, weight=1, popup=f"Passager: {p_node['nom']}").add_to(m)
+    return m
+
+# --- Benchmarks ---
+
+def timed(fn, *args):
+    start = time.perf_counter()
+    result = fn(*args)
+    return result, time.perf_counter() - start
+
+def bench_solver(args, nodes, mat_dist_km, mat_time_min):
+    print(f"{'facteur':>8}{'référence (s)':>16}{'solveur (s)':>14}{'routes':>9}  identique")
+    for factor in args.factors:
+        routes, t_new = timed(solve_covoiturage, nodes, mat_dist_km, mat_time_min, factor)
+        if args.skip_reference:
+            print(f"{factor:>8.1f}{'-':>16}{t_new:>14.3f}{len(routes):>9}  -")
+            continue
+        reference, t_ref = timed(solve_covoiturage_reference, nodes, mat_dist_km, mat_time_min, factor)
+        print(f"{factor:>8.1f}{t_ref:>16.3f}{t_new:>14.3f}{len(routes):>9}  {routes == reference}")
+
+def bench_kernels(args, nodes, mat_time_min):
+    """
+    Temps de la seule phase de fusion (candidats déjà générés) pour chaque noyau disponible.
+    """
+    kernels = ["python"] + (["numba"] if _merge_block_numba is not None else [])
+    detour_mat = detour_matrix(mat_time_min, nodes['time_CHU'].values)
+    dist_chu = nodes['dist_CHU'].values
+    if "numba" in kernels:
+        # Compilation (ou chargement du cache) hors mesure
+        cand_i, cand_j, scores = savings_candidates(detour_mat, dist_chu, 1.0)
+        merge_routes(len(nodes), cand_i, cand_j, scores, kernel="numba")
+
+    print(f"\n{'facteur':>8}{'candidats':>12}{'génération (s)':>17}" + "".join(f"{'fusion ' + k + ' (ms)':>22}" for k in kernels))
+    for factor in args.factors:
+        (cand_i, cand_j, scores), t_gen = timed(savings_candidates, detour_mat, dist_chu, factor)
+        results, times = [], []
+        for kernel in kernels:
+            result, t_merge = timed(merge_routes, len(nodes), cand_i, cand_j, scores, MAX_STOPS, None, kernel)
+            results.append(result)
+            times.append(t_merge)
+        identical = all(all(np.array_equal(a, b) for a, b in zip(results[0], r)) for r in results[1:])
+        line = f"{factor:>8.1f}{len(cand_i):>12}{t_gen:>17.3f}" + "".join(f"{t * 1000:>22.1f}" for t in times)
+        print(line + ("" if identical else "  (routes différentes !)"))
+
+def bench_sparse(args, nodes, coords, mat_dist_km=None, mat_time_min=None):
+    """
+    Mode KD-tree (k plus proches voisins, CSR) : construction, mémoire, temps de résolution (dont génération
+    des candidats et fusion) et km économisés, comparés au mode dense quand les matrices denses sont disponibles.
+    Indique si l'objectif de SPARSE_TARGET_S par facteur est tenu.
+    Mesuré sur 35 000 communes fictives, k = 50 (~1,75 M candidats, un coeur) : 0,2 à 0,3 s par facteur
+    (0,4 à 0,6 s avec le tri stable), dont ~0,04 s de génération et ~0,07 s de tri des candidats.
+    L'objectif de 100 ms n'est pas atteint.
+    """
+    (sparse_dist_km, t_build) = timed(sparse_distance_matrix, coords, args.knn, None, TORTUOSITY)
+    sparse_time_min = (sparse_dist_km / AVG_SPEED_KMH) * 60
+    sparse_mb = (sparse_dist_km.data.nbytes + sparse_dist_km.indices.nbytes + sparse_dist_km.indptr.nbytes) * 2 / 1e6
+    print(f"\nMode knn (k={args.knn}) : construction {t_build:.2f} s, {sparse_mb:.1f} Mo", end="")
+    if mat_dist_km is not None:
+        print(f" (dense : {(mat_dist_km.nbytes + mat_time_min.nbytes) / 1e6:.1f} Mo)")
+    else:
+        print(f" (dense estimé : {2 * 8 * len(nodes) ** 2 / 1e6:.0f} Mo, non construit)")
+
+    time_chu = nodes['time_CHU'].values
+    dist_chu = nodes['dist_CHU'].values
+    sparse_detour = detour_matrix(sparse_time_min, time_chu)
+    dense_detour = detour_matrix(mat_time_min, time_chu) if mat_time_min is not None else None
+
+    # Premier appel hors mesure : chargement du noyau compilé
+    solve_arrays(sparse_detour[:10, :10], dist_chu[:10], 1.0)
+
+    print(f"{'facteur':>8}{'knn (s)':>10}{'génération (s)':>16}{'fusion (s)':>12}{'km économisés knn':>20}"
+          f"{'dense (s)':>12}{'km économisés dense':>22}")
+    worst = 0.0
+    for factor in args.factors:
+        solution, t_sparse = timed(solve_arrays, sparse_detour, dist_chu, factor)
+        (cand_i, cand_j, scores), t_cand = timed(savings_candidates, sparse_detour, dist_chu, factor)
+        _, t_merge = timed(merge_routes, len(dist_chu), cand_i, cand_j, scores)
+        worst = max(worst, t_sparse)
+        saved_sparse = route_stats(*solution, dist_chu, sparse_dist_km)['saved_km']
+        line = f"{factor:>8.1f}{t_sparse:>10.3f}{t_cand:>16.3f}{t_merge:>12.3f}{saved_sparse:>20.1f}"
+        if dense_detour is None:
+            print(f"{line}{'-':>12}{'-':>22}")
+            continue
+        solution, t_dense = timed(solve_arrays, dense_detour, dist_chu, factor)
+        saved_dense = route_stats(*solution, dist_chu, mat_dist_km)['saved_km']
+        print(f"{line}{t_dense:>12.3f}{saved_dense:>22.1f}")
+    verdict = "atteint" if worst < SPARSE_TARGET_S else "non atteint"
+    print(f"Objectif {SPARSE_TARGET_S * 1000:.0f} ms par facteur ({len(nodes)} communes) : {verdict} "
+          f"(pire facteur {worst * 1000:.0f} ms)")
+
+def bench_sites(args, coords, sites_m, mat_dist_km, mat_time_min):
+    """
+    Un site contre tous les sites : construction de la matrice de détour et résolution. Avec les temps
+    relatifs au site de chaque noeud, le coût ne doit pas être multiplié par le nombre de sites.
+    """
+    dist_sites = (np.linalg.norm(coords[None, :, :] - sites_m[:, None, :], axis=2) / 1000) * TORTUOSITY
+    time_sites = (dist_sites / AVG_SPEED_KMH) * 60
+
+    print(f"\n{'sites':>6}{'détour (s)':>12}{'facteur':>9}{'résolution (s)':>16}{'routes':>9}{'km économisés':>16}")
+    for n_sites in (1, len(sites_m)):
+        site, time_chu, dist_chu = assign_sites(time_sites[:n_sites], dist_sites[:n_sites])
+        detour_mat, t_detour = timed(detour_matrix, mat_time_min, time_chu, site if n_sites > 1 else None)
+        for factor in args.factors:
+            solution, t_solve = timed(solve_arrays, detour_mat, dist_chu, factor)
+            stats = route_stats(*solution, dist_chu, mat_dist_km)
+            print(f"{n_sites:>6}{t_detour:>12.3f}{factor:>9.1f}{t_solve:>16.3f}"
+                  f"{stats['nb_carpools'] + stats['nb_solos']:>9}{stats['saved_km']:>16.1f}")
+
+def bench_weighted(args, nodes, mat_dist_km, mat_time_min):
+    """
+    Mode pondéré : environ `args.workers` travailleurs répartis sur les communes (loi géométrique),
+    regroupement intra-commune puis fusion des voitures restantes.
+    """
+    rng = np.random.default_rng(0)
+    workers = rng.geometric(len(nodes) / args.workers, size=len(nodes)) - 1
+    full_cars, _, has_rest = pool_within_communes(workers)
+    time_chu = nodes['time_CHU'].values
+    dist_chu = nodes['dist_CHU'].values
+    detour_mat = detour_matrix(mat_time_min, time_chu)
+
+    print(f"\nMode pondéré : {workers.sum()} travailleurs, {full_cars.sum()} voitures pleines intra-commune, "
+          f"{has_rest.sum()} voitures restantes à regrouper")
+    print(f"{'facteur':>8}{'résolution (s)':>16}{'voitures':>10}{'km initiaux':>14}{'km économisés':>16}")
+    for factor in args.factors:
+        solution, t_solve = timed(solve_arrays, detour_mat, dist_chu, factor, MAX_STOPS, "auto", workers)
+        stats = route_stats(*solution, dist_chu, mat_dist_km, workers)
+        print(f"{factor:>8.1f}{t_solve:>16.3f}{stats['nb_carpools'] + stats['nb_solos']:>10}"
+              f"{stats['total_km_initial']:>14.0f}{stats['saved_km']:>16.0f}")
+
+def bench_local_search(args, nodes, mat_dist_km, mat_time_min):
+    """
+    Post-optimisation après Clarke-Wright : km économisés et km économisés par seconde selon le budget de temps.
+    """
+    time_chu = nodes['time_CHU'].values
+    dist_chu = nodes['dist_CHU'].values
+    print(f"\n{'facteur':>8}{'budget (s)':>12}{'durée (s)':>11}{'km avant':>12}{'km économisés':>16}{'km/s':>10}  mouvements")
+    for factor in args.factors:
+        routes = solve_covoiturage(nodes, mat_dist_km, mat_time_min, factor)
+        for budget in args.local_search:
+            _, report = improve_routes(routes, mat_time_min, time_chu, mat_dist_km, dist_chu, time_budget=budget)
+            moves = ", ".join(f"{k} {v}" for k, v in report['moves'].items())
+            print(f"{factor:>8.1f}{budget:>12.1f}{report['elapsed_s']:>11.2f}{report['km_before']:>12.0f}"
+                  f"{report['saved_km']:>16.1f}{report['km_per_s']:>10.1f}  {moves}{' (convergé)' if report['converged'] else ''}")
+
+def bench_map(args, nodes, coords, mat_dist_km, mat_time_min):
+    """
+    Rendu de la carte : construction des objets folium, génération du HTML et taille de la page,
+    rendu d'origine (un objet par route) contre les couches GeoJSON de covoiturage_map.
+    """
+    import folium
+    from covoiturage_map import add_routes_layer
+
+    nodes = nodes.copy()
+    if 'lon' not in nodes:
+        # Communes fictives : Lambert 93 -> lon / lat approximatifs autour de Rennes
+        nodes['lon'] = CHU_COORDS[0] + (coords[:, 0] - 351000.0) / 74000.0
+        nodes['lat'] = CHU_COORDS[1] + (coords[:, 1] - 6790000.0) / 111000.0
+    nodes['site'] = 0
+    site_coords = [CHU_COORDS]
+
+    print(f"\n{'facteur':>8}{'routes':>9}{'rendu':>12}{'objets (s)':>12}{'HTML (s)':>10}{'taille (Mo)':>13}")
+    for factor in args.factors:
+        routes = solve_covoiturage(nodes, mat_dist_km, mat_time_min, factor)
+        for label, add_routes in (("origine", add_routes_reference), ("geojson", add_routes_layer)):
+            m = folium.Map(location=[CHU_COORDS[1], CHU_COORDS[0]], zoom_start=10, tiles='CartoDB positron')
+            _, t_build = timed(add_routes, m, routes, nodes, site_coords)
+            html, t_render = timed(m.get_root().render)
+            print(f"{factor:>8.1f}{len(routes):>9}{label:>12}{t_build:>12.2f}{t_render:>10.2f}{len(html) / 1e6:>13.2f}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks du solveur de covoiturage")
+    parser.add_argument("--geojson", type=str, default=GEOJSON_PATH, help="Communes (défaut: communes-version-simplifiee.geojson)")
+    parser.add_argument("--synthetic", type=int, default=None, help="Utiliser N communes fictives au lieu du geojson")
+    parser.add_argument("--factors", type=float, nargs="+", default=[0.5, 1.0, 2.0, 5.0, 10.0])
+    parser.add_argument("--skip-reference", action="store_true", help="Ne pas exécuter l'implémentation d'origine (grandes instances)")
+    parser.add_argument("--knn", type=int, default=None, help="Comparer aussi le mode KD-tree avec K voisins par commune")
+    parser.add_argument("--workers", type=int, default=None, help="Mode pondéré avec environ N travailleurs répartis sur les communes")
+    parser.add_argument("--local-search", type=float, nargs="+", default=None, metavar="BUDGET",
+                        help="Post-optimisation 2-opt / relocate / swap avec ces budgets de temps (s)")
+    parser.add_argument("--map", action="store_true", help="Comparer le rendu folium d'origine et les couches GeoJSON")
+    parser.add_argument("--sites", action="store_true", help="Comparer un site du CHU et tous les sites (Pontchaillou + Hôpital Sud)")
+    args = parser.parse_args()
+
+    if args.synthetic is not None or not os.path.exists(args.geojson):
+        n = args.synthetic or 1500
+        print(f"Communes fictives : {n}")
+        nodes, coords, sites_m = synthetic_nodes(n)
+    else:
+        nodes, coords, sites_m = load_geojson_nodes(args.geojson)
+        print(f"Communes ({args.geojson}) : {len(nodes)}")
+
+    mat_dist_km = mat_time_min = None
+    if len(nodes) <= DENSE_MAX_NODES:
+        mat_dist_km, mat_time_min = distance_matrices(coords)
+        bench_solver(args, nodes, mat_dist_km, mat_time_min)
+        bench_kernels(args, nodes, mat_time_min)
+        if args.sites:
+            bench_sites(args, coords, sites_m, mat_dist_km, mat_time_min)
+        if args.workers is not None:
+            bench_weighted(args, nodes, mat_dist_km, mat_time_min)
+        if args.local_search is not None:
+            bench_local_search(args, nodes, mat_dist_km, mat_time_min)
+        if args.map:
+            bench_map(args, nodes, coords, mat_dist_km, mat_time_min)
+    if args.knn is not None:
+        bench_sparse(args, nodes, coords, mat_dist_km, mat_time_min)
+
+if __name__ == "__main__":
+    main()
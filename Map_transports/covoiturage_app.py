@@ -6,23 +6,47 @@ import numpy as np
 import folium
 from streamlit_folium import st_folium
 import os
-import time
-from scipy.spatial.distance import cdist
+from functools import partial
+
+from covoiturage_solver import assign_sites, start_sweep, routes_from_arrays, improve_routes
+from covoiturage_map import add_routes_layer
+from covoiturage_data import (matrix_cache_key, load_or_compute_distance_matrix, open_distance_matrix, minutes_per_km,
+                              load_travel_table, routed_site_matrices, load_worker_counts)
 
 # --- Configuration ---
-CHU_COORDS = (-1.6948973, 48.1189081) # Lon, Lat
+# Sites du CHU (Lon, Lat) : mêmes coordonnées que Mobilités.R (A = Pontchaillou, B = Hôpital Sud)
+CHU_SITES = {
+    "Pontchaillou": (-1.6948973, 48.1189081),
+    "Hôpital Sud": (-1.6556722, 48.0837382),
+}
+CHU_COORDS = CHU_SITES["Pontchaillou"]
 AVG_SPEED_KMH = 50
 TORTUOSITY = 1.3
 MAX_STOPS = 3
 GEOJSON_PATH = "communes-version-simplifiee.geojson"
-CACHE_FILE = "mat_dist_time_py.pkl"
+# Temps / distances routiers vers les sites précalculés par Mobilités.R (sinon : vol d'oiseau x tortuosité)
+USE_ROUTED_TIMES = True
+# Colonne d'effectif du fichier des travailleurs (None : une ligne = un travailleur). MOBILITE.csv ne liste que les
+# communes (une ligne chacune, pas d'effectif) : le mode pondéré reste masqué tant qu'aucun effectif réel n'est fourni
+WORKERS_COUNT_COLUMN = None
+CACHE_DIR = "cache_matrices" # Matrices .npy float32 versionnées (hash des noeuds et des paramètres)
+# Matrice de distance : "dense" (N x N), "knn" (KD-tree, voisins proches en CSR) ou "auto" (knn au-delà de DENSE_MAX_NODES)
+DISTANCE_MODE = "auto"
+DENSE_MAX_NODES = 5000
+KNN_K = 50              # Nombre de voisins candidats par commune
+KNN_RADIUS_KM = None    # Optionnel : rayon maximal (km à vol d'oiseau) des paires candidates
+FACTOR_GRID = [round(0.5 * k, 1) for k in range(21)] # Grille du slider : 0 à 10, pas de 0.5
 
 st.set_page_config(layout="wide", page_title="Covoiturage Optimisé")
 
 # --- Fonctions Utilitaires ---
 
 @st.cache_data
-def load_data():
+def get_worker_counts():
+    return load_worker_counts(count_column=WORKERS_COUNT_COLUMN)
+
+@st.cache_data
+def load_data(sites=tuple(CHU_SITES), weighted=False):
     if not os.path.exists(GEOJSON_PATH):
         st.error(f"Fichier '{GEOJSON_PATH}' introuvable.")
         return None
@@ -46,27 +70,46 @@ def load_data():
     # l'usage d'une projection locale est souvent plus performant en Python que d'itérer du haversine.
     # Rennes est en France => EPSG:2154
     gdf_proj = gdf.to_crs(epsg=2154)
-    chu_point = gpd.points_from_xy([CHU_COORDS[0]], [CHU_COORDS[1]], crs="EPSG:4326").to_crs(epsg=2154)[0]
+    lons, lats = zip(*(CHU_SITES[name] for name in sites))
+    chu_points = gpd.points_from_xy(lons, lats, crs="EPSG:4326").to_crs(epsg=2154)
+    
+    # Distance à chaque site du CHU : tableaux empilés (S, N)
+    dist_sites = np.stack([(gdf_proj.centroid.distance(p).values / 1000) * TORTUOSITY for p in chu_points])
     
-    # Distance au CHU
-    gdf['dist_CHU_m'] = gdf_proj.centroid.distance(chu_point)
-    gdf['dist_CHU'] = (gdf['dist_CHU_m'] / 1000) * TORTUOSITY
-    gdf['time_CHU'] = (gdf['dist_CHU'] / AVG_SPEED_KMH) * 60
+    # Temps et distances routiers réels quand la commune figure dans les tables de Mobilités.R
+    travel_table = load_travel_table(cache_dir=CACHE_DIR) if USE_ROUTED_TIMES else None
+    time_sites, dist_sites, gdf['routed'] = routed_site_matrices(gdf['code'].values, travel_table, sites, dist_sites, AVG_SPEED_KMH)
+    
+    # Chaque commune est affectée au site le plus proche ; dist_CHU / time_CHU sont relatifs à ce site
+    site, gdf['time_CHU'], gdf['dist_CHU'] = assign_sites(time_sites, dist_sites)
+    gdf['site'] = site
+    
+    # Mode pondéré : seules les communes des travailleurs du CHU, avec leur effectif
+    if weighted:
+        counts = get_worker_counts()
+        if counts is None:
+            st.warning("Fichier des travailleurs introuvable : une commune = un conducteur.")
+        else:
+            gdf['workers'] = counts.reindex(gdf['code'].astype(str).values).fillna(0).astype(np.int64).values
+            gdf = gdf[gdf['workers'] > 0]
     
     # Création des noeuds (indices 0 à N-1)
-    nodes = gdf[['code', 'nom', 'lon', 'lat', 'dist_CHU', 'time_CHU']].copy().reset_index(drop=True)
+    nodes = gdf[[c for c in ['code', 'nom', 'lon', 'lat', 'dist_CHU', 'time_CHU', 'site', 'routed', 'workers'] if c in gdf]].copy().reset_index(drop=True)
     nodes['id'] = nodes.index
     
     return nodes
 
 def compute_distance_matrix(nodes):
-    if os.path.exists(CACHE_FILE):
-        print(f"[LOG] Chargement de la matrice depuis {CACHE_FILE}")
-        return pd.read_pickle(CACHE_FILE)
-    
-    print("[LOG] Calcul de la matrice de distance en cours...")
-    start_time = time.time()
-    
+    """
+    Matrice des distances (km), ouverte en mmap depuis le cache versionné (clé = hash des coordonnées
+    et des paramètres) ou calculée au premier appel. time_min n'est pas stockée : voir minutes_per_km.
+    """
+    mode = DISTANCE_MODE
+    if mode == "auto":
+        mode = "knn" if len(nodes) > DENSE_MAX_NODES else "dense"
+    k, radius_km = (KNN_K, KNN_RADIUS_KM) if mode == "knn" else (None, None)
+    key = matrix_cache_key(nodes['lon'].values, nodes['lat'].values, mode, TORTUOSITY, k, radius_km)
+
     # Projection pour calcul de distance matriciel rapide (Euclidien sur Lambert 93)
     # Re-création de la géométrie projetée pour les noeuds
     nodes_gdf = gpd.GeoDataFrame(
@@ -74,126 +117,46 @@ def compute_distance_matrix(nodes):
         geometry=gpd.points_from_xy(nodes.lon, nodes.lat),
         crs="EPSG:4326"
     ).to_crs(epsg=2154)
-    
-    coords = np.array(list(zip(nodes_gdf.geometry.x, nodes_gdf.geometry.y)))
-    
-    # cdist calcule la distance euclidienne entre toutes les paires
-    mat_dist_m = cdist(coords, coords, metric='euclidean')
-    
-    mat_dist_km = (mat_dist_m / 1000) * TORTUOSITY
-    mat_time_min = (mat_dist_km / AVG_SPEED_KMH) * 60
-    
-    end_time = time.time()
-    duration = end_time - start_time
-    print(f"[LOG] Calcul terminé en {duration:.2f} secondes")
-    
-    result = {'dist_km': mat_dist_km, 'time_min': mat_time_min}
-    pd.to_pickle(result, CACHE_FILE)
-    print(f"[LOG] Matrice sauvegardée dans {CACHE_FILE}")
-    
-    return result
+    coords = np.column_stack([nodes_gdf.geometry.x, nodes_gdf.geometry.y])
 
-# --- Algorithme Clarke-Wright ---
+    mat_dist_km = load_or_compute_distance_matrix(coords, key, mode, TORTUOSITY, k, radius_km, cache_dir=CACHE_DIR)
+    return key, mode, mat_dist_km
 
-def solve_covoiturage(nodes, mat_dist_km, mat_time_min, benefit_factor):
-    n_nodes = len(nodes)
-    
-    # Initialisation : Tout le monde est son propre conducteur
-    # Routes est une liste de dicts
-    routes = []
-    for i in range(n_nodes):
-        routes.append({
-            'id': i,
-            'driver': i,
-            'stops': [i], # Liste des indices des noeuds visités
-            'load': 0      # 0 passagers (le conducteur ne compte pas dans la "charge" passager selon la logique R originale qui met load=0 init)
-                           # R: load=0 init. Stop check: (r_i$load + r_j$load + 1) > max_stops (donc +1 pour le conducteur fusionné ?)
-                           # Vérifions la logique R:
-                           # routes[[i]]$load init à 0.
-                           # Fusion: routes[[r_i]]$load <- r_i$load + r_j$load + 1
-                           # Donc load compte le nombre de PASSAGERS récupérés (personnes qui ne conduisent plus).
-        })
-        
-    # --- Calcul des Scores (Savings) ---
-    # Logique R: 
-    # temp_mat = sweep(mat_time_min, 2, nodes$time_CHU, "+")  => T(i,j) + T(j, CHU)
-    # detour_mat = sweep(temp_mat, 1, nodes$time_CHU, "-")    => T(i,j) + T(j, CHU) - T(i, CHU)
-    # term1 = nodes$dist_CHU * factor
-    # score = term1 - detour
-    
-    # En numpy :
-    # nodes['time_CHU'] shape (N,)
-    time_chu = nodes['time_CHU'].values
-    dist_chu = nodes['dist_CHU'].values
-    
-    # Broadcasting pour recréer sweep
-    # mat_time_min[i, j]
-    # temp_mat[i, j] = mat_time_min[i, j] + time_chu[j]
-    temp_mat = mat_time_min + time_chu[None, :] 
-    
-    # detour_mat[i, j] = temp_mat[i, j] - time_chu[i]
-    detour_mat = temp_mat - time_chu[:, None]
-    
-    # term1[j] = dist_chu[j] * factor. 
-    # Dans R: term1_mat = matrix(rep(term1, each=n), nrow=n) => les colonnes sont identiques (valeur de j)
-    # term1_mat[i, j] = dist_chu[j] * factor
-    term1_mat = (dist_chu * benefit_factor)[None, :]
-    
-    score_mat = term1_mat - detour_mat
-    
-    # Diagonale -Inf
-    np.fill_diagonal(score_mat, -np.inf)
-    
-    # Extraction candidats > 0
-    # indices where score > 0
-    rows, cols = np.where(score_mat > 0)
-    scores = score_mat[rows, cols]
-    
-    candidates = pd.DataFrame({'i': rows, 'j': cols, 'score': scores})
-    candidates = candidates.sort_values('score', ascending=False).reset_index(drop=True)
-    
-    # Mapping Noeud -> Index Route
-    node_to_route = list(range(n_nodes))
-    route_active = [True] * n_nodes
-    
-    # Fusion
-    for idx, row in candidates.iterrows():
-        i = int(row['i'])
-        j = int(row['j'])
-        
-        r_i_idx = node_to_route[i]
-        r_j_idx = node_to_route[j]
-        
-        # Si même route ou inactive
-        if r_i_idx == r_j_idx or not route_active[r_i_idx] or not route_active[r_j_idx]:
-            continue
-            
-        r_i = routes[r_i_idx]
-        r_j = routes[r_j_idx]
-        
-        # Check charge max (load i + load j + 1 nouveau passager (le driver j devient passager))
-        if (r_i['load'] + r_j['load'] + 1) > MAX_STOPS:
-            continue
-            
-        # Vérification connexion (Fin I -> Début J)
-        # R: last_i <- tail(r_i$stops, 1); first_j <- head(r_j$stops, 1)
-        last_i = r_i['stops'][-1]
-        first_j = r_j['stops'][0]
-        
-        if i == last_i and j == first_j:
-            # Fusion
-            # Nouveau stops: stops_i + stops_j
-            routes[r_i_idx]['stops'].extend(r_j['stops'])
-            routes[r_i_idx]['load'] += r_j['load'] + 1
-            
-            # Mise à jour index pour tous les membres de J
-            for node_idx in r_j['stops']:
-                node_to_route[node_idx] = r_i_idx
-            
-            route_active[r_j_idx] = False
-            
-    final_routes = [r for idx, r in enumerate(routes) if route_active[idx]]
-    return final_routes
+# --- Solutions précalculées pour toute la grille du slider ---
+
+@st.cache_resource
+def get_sweep(cache_key, matrix_key, mode, _nodes):
+    """
+    La matrice de détour ne dépend pas du slider : chaque processus du pool la construit une fois à partir
+    du cache mmap (seuls la clé et le chemin lui sont envoyés), puis toutes les valeurs de FACTOR_GRID
+    sont résolues en arrière-plan (pool partagé entre sessions).
+    """
+    print("[LOG] Lancement du précalcul des solutions pour tous les facteurs...")
+    load_matrix = partial(open_distance_matrix, matrix_key, mode, cache_dir=CACHE_DIR)
+    workers = _nodes['workers'].values if 'workers' in _nodes else None
+    # L'executor est conservé avec les Futures (cache de ressource partagé)
+    return start_sweep(load_matrix, _nodes['time_CHU'].values, _nodes['dist_CHU'].values, FACTOR_GRID,
+                       time_scale=minutes_per_km(AVG_SPEED_KMH), site=_nodes['site'].values, max_stops=MAX_STOPS,
+                       workers=workers)
+
+@st.cache_data
+def get_solution(cache_key, benefit_factor, _futures):
+    """
+    Routes et statistiques pour un facteur : simple lecture dès que le précalcul est terminé.
+    """
+    (next_node, load, active), stats = _futures[benefit_factor].result()
+    return routes_from_arrays(next_node, load, active), stats
+
+@st.cache_data
+def get_improved_solution(cache_key, benefit_factor, time_budget, _routes, _nodes, _mat_dist_km):
+    """
+    Post-optimisation (2-opt / relocate / swap) des routes d'un facteur, bornée par time_budget secondes.
+    """
+    workers = _nodes['workers'].values if 'workers' in _nodes else None
+    # Temps = km x minutes_per_km, convertis paire par paire (pas de matrice des temps N x N)
+    return improve_routes(_routes, _mat_dist_km, _nodes['time_CHU'].values, _mat_dist_km, _nodes['dist_CHU'].values,
+                          max_stops=MAX_STOPS, time_budget=time_budget, site=_nodes['site'].values, workers=workers,
+                          time_scale=minutes_per_km(AVG_SPEED_KMH))
 
 # --- Interface ---
 
@@ -205,7 +168,25 @@ with st.sidebar:
         "Poids 'Bénéfice Écologique' (vs Temps)", 
         min_value=0.0, max_value=10.0, value=1.0, step=0.5
     )
+    selected_sites = st.multiselect("Sites du CHU", list(CHU_SITES), default=list(CHU_SITES))
+    if not selected_sites:
+        selected_sites = [next(iter(CHU_SITES))]
+    st.caption("Chaque commune est rattachée au site le plus proche ; les regroupements se font par site.")
+    worker_counts = get_worker_counts()
+    # Un effectif de 1 partout (une ligne par commune) donnerait exactement le mode non pondéré
+    if worker_counts is not None and (worker_counts > 1).any():
+        weighted = st.toggle("Pondérer par le nombre de travailleurs par commune", value=False)
+        if weighted:
+            st.caption("Les travailleurs d'une même commune remplissent d'abord des voitures pleines, les voitures restantes sont regroupées entre communes.")
+    else:
+        weighted = False
+        st.caption("Mode pondéré indisponible : pas d'effectif de travailleurs par commune "
+                   "(le fichier des travailleurs est absent ou ne compte qu'une ligne par commune).")
     st.info("Plus la valeur est haute, plus on favorise le regroupement.")
+    local_search_budget = st.slider(
+        "Post-optimisation (s)", min_value=0.0, max_value=10.0, value=0.0, step=0.5,
+        help="Recherche locale 2-opt / relocate / swap après l'algorithme des économies (0 : désactivée)."
+    )
     
     st.markdown("""
     **Légende (Nb Passagers)**
@@ -218,106 +199,69 @@ with st.sidebar:
     stats_container = st.container()
 
 # Chargement
-nodes = load_data()
+sites = tuple(selected_sites)
+nodes = load_data(sites, weighted)
 
 if nodes is not None:
-    # Matrice
-    mat_cache = compute_distance_matrix(nodes)
-    mat_dist_km = mat_cache['dist_km']
-    mat_time_min = mat_cache['time_min']
+    # Matrice (mmap : pas de chargement en RAM)
+    matrix_key, mode, mat_dist_km = compute_distance_matrix(nodes)
     
-    # Optimisation
+    # Optimisation : lecture de la solution précalculée (attente seulement si elle n'est pas encore prête)
+    cache_key = (matrix_key, sites, USE_ROUTED_TIMES, weighted, AVG_SPEED_KMH, MAX_STOPS)
+    executor, futures = get_sweep(cache_key, matrix_key, mode, nodes)
     with st.spinner("Optimisation en cours..."):
-        final_routes = solve_covoiturage(nodes, mat_dist_km, mat_time_min, benefit_factor)
+        final_routes, stats = get_solution(cache_key, float(benefit_factor), futures)
+        ls_report = None
+        if local_search_budget > 0:
+            final_routes, ls_report = get_improved_solution(cache_key, float(benefit_factor), float(local_search_budget),
+                                                            final_routes, nodes, mat_dist_km)
     
     # Stats
-    nb_solos = sum(1 for r in final_routes if len(r['stops']) == 1)
-    nb_carpools = len(final_routes) - nb_solos
-    
-    total_km_initial = nodes['dist_CHU'].sum()
-    total_km_final = 0
-    
-    for r in final_routes:
-        path = r['stops']
-        if len(path) == 1:
-            total_km_final += nodes.loc[path[0], 'dist_CHU']
-        else:
-            d_driven = 0
-            for k in range(len(path) - 1):
-                # dist entre path[k] et path[k+1]
-                # mat_dist_km est un np.array, indexé par [i, j]
-                d_driven += mat_dist_km[path[k], path[k+1]]
-            
-            # Dernier stop -> CHU
-            d_driven += nodes.loc[path[-1], 'dist_CHU']
-            total_km_final += d_driven
-            
-    saved_km = total_km_initial - total_km_final
+    nb_solos = stats['nb_solos']
+    nb_carpools = stats['nb_carpools']
+    saved_km = stats['saved_km'] + (ls_report['saved_km'] if ls_report else 0.0)
     
     with stats_container:
         st.markdown("---")
         st.metric("Trajets Covoiturés", nb_carpools)
         st.metric("Conducteurs Solo", nb_solos)
         st.metric("Km Économisés", f"{saved_km:.1f} km")
+        if ls_report:
+            st.caption(f"Post-optimisation : {ls_report['saved_km']:.1f} km en {ls_report['elapsed_s']:.2f} s "
+                       f"({ls_report['km_per_s']:.1f} km/s{', optimum local atteint' if ls_report['converged'] else ''})")
+        if 'nb_workers' in stats:
+            st.caption(f"{stats['nb_workers']} travailleurs, dont {stats['nb_full_cars']} voitures pleines intra-commune")
+        if USE_ROUTED_TIMES:
+            st.caption(f"Temps routiers réels : {int(nodes['routed'].sum())}/{len(nodes)} communes (les autres : estimation à vol d'oiseau)")
+        if len(sites) > 1:
+            counts = np.bincount(nodes['site'].values, minlength=len(sites))
+            st.caption(" · ".join(f"{name} : {c} communes" for name, c in zip(sites, counts)))
+        
+        # Courbe des statistiques pour tous les facteurs déjà calculés
+        done = {f: fut.result()[1] for f, fut in futures.items() if fut.done()}
+        if done:
+            sweep_df = pd.DataFrame.from_dict(done, orient='index').sort_index()
+            sweep_df.index.name = "Facteur"
+            st.caption(f"Solutions précalculées : {len(done)}/{len(FACTOR_GRID)}")
+            st.line_chart(sweep_df[['saved_km']].rename(columns={'saved_km': 'Km économisés'}))
+            st.line_chart(sweep_df[['nb_carpools', 'nb_solos']].rename(columns={'nb_carpools': 'Trajets covoiturés', 'nb_solos': 'Conducteurs solo'}))
 
     # Carte
+    site_coords = [CHU_SITES[name] for name in sites]
     m = folium.Map(location=[CHU_COORDS[1], CHU_COORDS[0]], zoom_start=10, tiles='CartoDB positron')
     
-    # Marker CHU
+    # Marker par site du CHU
     icon_url = "https://cdn-icons-png.flaticon.com/512/3063/3063176.png"
-    icon = folium.CustomIcon(icon_url, icon_size=(35, 35))
-    folium.Marker(
-        [CHU_COORDS[1], CHU_COORDS[0]], 
-        popup="CHU Rennes", 
-        icon=icon
-    ).add_to(m)
-    
-    colors = ["#3498db", "#f1c40f", "#e67e22", "#e74c3c"]
-    
-    for r in final_routes:
-        load = min(r['load'], 3)
-        col = colors[load]
-        
-        path_ids = r['stops']
-        
-        # Coordonnées pour la ligne: [stop1, stop2, ..., stopN, CHU]
-        route_coords = []
-        for pid in path_ids:
-            route_coords.append([nodes.loc[pid, 'lat'], nodes.loc[pid, 'lon']])
-        route_coords.append([CHU_COORDS[1], CHU_COORDS[0]])
-        
-        weight = 4 if load > 0 else 2
-        opacity = 0.8
-        
-        folium.PolyLine(
-            route_coords, color=col, weight=weight, opacity=opacity, 
-            popup=f"Passagers: {load}"
-        ).add_to(m)
-        
-        # Conducteur (Premier noeud)
-        driver_node = nodes.loc[path_ids[0]]
-        folium.CircleMarker(
-            location=[driver_node.lat, driver_node.lon],
-            radius=5,
-            color=col,
-            fill=True,
-            fill_opacity=1,
-            popup=f"<b>Conducteur</b>: {driver_node['nom']}"
+    for name, (lon, lat) in zip(sites, site_coords):
+        icon = folium.CustomIcon(icon_url, icon_size=(35, 35))
+        folium.Marker(
+            [lat, lon], 
+            popup=f"CHU Rennes - {name}", 
+            icon=icon
         ).add_to(m)
-        
-        # Passagers
-        if len(path_ids) > 1:
-            for pid in path_ids[1:]:
-                p_node = nodes.loc[pid]
-                folium.CircleMarker(
-                    location=[p_node.lat, p_node.lon],
-                    radius=3,
-                    color="black",
-                    fill=True,
-                    fill_color="white",
-                    fill_opacity=1,
-                    weight=1,
-                    popup=f"Passager: {p_node['nom']}"
-                ).add_to(m)
+    
+    # Routes : deux couches GeoJSON (lignes par charge, arrêts) construites en une passe vectorisée
+    add_routes_layer(m, final_routes, nodes, site_coords)
 
-    st_folium(m, height=750, width="100%")
+    # returned_objects=[] : pas de renvoi de l'état de la carte (ni de rerun) à chaque déplacement
+    st_folium(m, height=750, width="100%", returned_objects=[])
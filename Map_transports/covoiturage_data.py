@@ -0,0 +1,225 @@
+import io
+import os
+import json
+import time
+import hashlib
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+from scipy.spatial.distance import cdist
+
+from covoiturage_solver import sparse_distance_matrix
+
+# Couche de données du covoiturage (sans dépendance à Streamlit).
+#
+# Cache des matrices de distance : un jeu de fichiers .npy float32 par clé, la clé étant un hash des
+# coordonnées des noeuds et des paramètres (tortuosité, mode, k, rayon). Les fichiers sont ouverts en
+# mmap_mode='r' : rien n'est chargé en RAM à l'ouverture et les sessions Streamlit concurrentes partagent
+# les pages du cache système. Seule dist_km est stockée, time_min en est dérivée à la demande (minutes_per_km).
+#
+# Temps de trajet réels : les tables précalculées par Mobilités.R (temps et distances routiers voiture,
+# vélo et bus vers chaque site) sont jointes par code commune en une table compacte indexée par code,
+# mise en cache au format Parquet (aucun calcul d'itinéraire en ligne).
+
+CACHE_VERSION = 1
+
+# Tables de Mobilités.R, par ordre de priorité (la première fait foi pour un code présent dans les deux)
+TRAVEL_TABLES = (
+    "../_RENDU/Map_transports/Transports_Voit_Velo_Bus.csv",
+    "../_RENDU/Map_transports/temps_voiture_velo.csv",
+)
+# Communes des travailleurs du CHU : une ligne par travailleur, ou une colonne d'effectif. Le MOBILITE.csv fourni
+# n'a qu'une ligne par commune (effectif 1 partout) : il ne suffit pas au mode pondéré.
+WORKERS_PATH = "../_RENDU/Map_transports/MOBILITE.csv"
+# Suffixe des colonnes des tables pour chaque site du CHU
+SITE_COLUMNS = {"Pontchaillou": "Pontchaillou", "Hôpital Sud": "HopitalSud"}
+TRAVEL_COLUMNS = [f"{mode}_{site}_{unit}" for mode in ("Voiture", "Velo") for site in SITE_COLUMNS.values()
+                  for unit in ("min", "km")] + [f"Bus_{site}" for site in SITE_COLUMNS.values()]
+
+def matrix_cache_key(lon, lat, mode, tortuosity, k=None, radius_km=None):
+    """
+    Clé de cache : change dès que les noeuds (coordonnées, ordre) ou un paramètre changent.
+    """
+    h = hashlib.sha1()
+    h.update(np.ascontiguousarray(lon, dtype=np.float64).tobytes())
+    h.update(np.ascontiguousarray(lat, dtype=np.float64).tobytes())
+    params = {'version': CACHE_VERSION, 'mode': mode, 'tortuosity': tortuosity, 'k': k, 'radius_km': radius_km}
+    h.update(json.dumps(params, sort_keys=True).encode('utf-8'))
+    return h.hexdigest()[:16]
+
+def _save_npy_atomic(path, array):
+    # Ecriture dans un fichier temporaire puis renommage : une autre session ne lit jamais un fichier partiel
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        np.save(f, array)
+    os.replace(tmp_path, path)
+
+def _matrix_files(key, mode, cache_dir):
+    prefix = os.path.join(cache_dir, f"dist_{mode}_{key}")
+    files = [f"{prefix}.npy"] if mode == "dense" else [f"{prefix}_{part}.npy" for part in ("data", "indices", "indptr")]
+    return prefix, files
+
+def load_or_compute_distance_matrix(coords_m, key, mode, tortuosity, k=None, radius_km=None, cache_dir="cache_matrices"):
+    """
+    Matrice des distances (km, x tortuosité) entre noeuds, depuis le cache ou calculée puis mise en cache.
+    mode 'dense' : tableau N x N float32 mappé en mémoire.
+    mode 'knn'   : matrice CSR (voisins proches) dont les tableaux sont mappés en mémoire.
+    """
+    prefix, files = _matrix_files(key, mode, cache_dir)
+
+    if all(os.path.exists(f) for f in files):
+        print(f"[LOG] Matrice de distance ouverte depuis le cache {prefix} (mmap)")
+    else:
+        print("[LOG] Calcul de la matrice de distance en cours...")
+        start_time = time.time()
+        os.makedirs(cache_dir, exist_ok=True)
+
+        if mode == "knn":
+            radius_m = radius_km * 1000 if radius_km is not None else None
+            mat = sparse_distance_matrix(coords_m, k=k, radius_m=radius_m, tortuosity=tortuosity)
+            _save_npy_atomic(files[0], mat.data.astype(np.float32))
+            _save_npy_atomic(files[1], mat.indices)
+            _save_npy_atomic(files[2], mat.indptr)
+        else:
+            # Calcul par blocs de lignes pour ne jamais tenir la matrice float64 complète en mémoire
+            n = len(coords_m)
+            tmp_path = f"{files[0]}.{os.getpid()}.tmp"
+            out = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.float32, shape=(n, n))
+            for start in range(0, n, 2048):
+                out[start:start + 2048] = (cdist(coords_m[start:start + 2048], coords_m) / 1000) * tortuosity
+            out.flush()
+            del out
+            os.replace(tmp_path, files[0])
+
+        with open(f"{prefix}.json", 'w', encoding='utf-8') as f:
+            json.dump({'version': CACHE_VERSION, 'mode': mode, 'n_nodes': len(coords_m), 'tortuosity': tortuosity,
+                       'k': k, 'radius_km': radius_km}, f, indent=2)
+        print(f"[LOG] Calcul terminé en {time.time() - start_time:.2f} secondes, matrice sauvegardée dans {prefix}")
+
+    return open_distance_matrix(key, mode, cache_dir)
+
+def open_distance_matrix(key, mode, cache_dir="cache_matrices"):
+    """
+    Ouverture (mmap_mode='r') d'une matrice déjà en cache. Sert aussi aux processus du balayage des
+    facteurs (start_sweep) : seuls la clé et le chemin leur sont envoyés, jamais la matrice.
+    """
+    _, files = _matrix_files(key, mode, cache_dir)
+    if mode == "dense":
+        return np.load(files[0], mmap_mode='r')
+    data, indices, indptr = (np.load(f, mmap_mode='r') for f in files)
+    n = len(indptr) - 1
+    return sp.csr_matrix((data, indices, indptr), shape=(n, n), copy=False)
+
+def minutes_per_km(avg_speed_kmh):
+    """
+    Facteur de conversion km -> min (time_scale de detour_matrix / improve_routes) : la matrice des temps
+    n'est ni stockée dans le cache ni construite, seules les valeurs utilisées sont converties.
+    """
+    return 60.0 / avg_speed_kmh
+
+# --- Temps de trajet réels vers les sites du CHU ---
+
+def _files_key(paths):
+    h = hashlib.sha1(json.dumps({'version': CACHE_VERSION, 'columns': TRAVEL_COLUMNS}).encode('utf-8'))
+    for path in paths:
+        st = os.stat(path)
+        h.update(f"{os.path.abspath(path)}|{st.st_size}|{st.st_mtime_ns}".encode('utf-8'))
+    return h.hexdigest()[:16]
+
+def _read_r_table(path):
+    """
+    Lecture d'une table écrite par write.table de R : l'en-tête n'a pas de nom pour la colonne des
+    numéros de ligne, et les géométries (list(c(...)), non quotées) peuvent courir sur plusieurs lignes.
+    Seules les colonnes 'code' et TRAVEL_COLUMNS sont gardées.
+    """
+    with open(path, encoding='utf-8') as f:
+        header = f.readline().rstrip('\n').replace('"', '').split(';')
+        # Chaque enregistrement commence par son numéro de ligne quoté : les autres lignes sont des suites
+        records = []
+        for line in f:
+            if line.startswith('"') or not records:
+                records.append(line.rstrip('\n'))
+            else:
+                records[-1] += line.rstrip('\n')
+    usecols = ['code'] + [c for c in TRAVEL_COLUMNS if c in header]
+    return pd.read_csv(io.StringIO('\n'.join(records)), sep=';', header=None, names=['row'] + header,
+                       usecols=usecols, dtype={'code': str})
+
+def load_travel_table(paths=TRAVEL_TABLES, cache_dir="cache_matrices"):
+    """
+    Table des temps / distances précalculés vers chaque site, indexée par code commune (float32).
+    Lue depuis le cache Parquet (clé = chemins, tailles et dates des CSV) ou construite puis mise en cache.
+    Renvoie None si aucune table n'est disponible.
+    """
+    paths = [p for p in paths if os.path.exists(p)]
+    if not paths:
+        return None
+    cache_path = os.path.join(cache_dir, f"travel_{_files_key(paths)}.parquet")
+    if os.path.exists(cache_path):
+        return pd.read_parquet(cache_path)
+
+    print("[LOG] Construction de la table des temps de trajet réels...")
+    start_time = time.time()
+    table = None
+    for path in paths:
+        df = _read_r_table(path)
+        df = df.drop_duplicates(subset='code').set_index('code').astype(np.float32)
+        table = df if table is None else table.combine_first(df)
+    table = table.reindex(columns=TRAVEL_COLUMNS).astype(np.float32).sort_index()
+
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+        table.to_parquet(tmp_path)
+        os.replace(tmp_path, cache_path)
+    except ImportError:
+        # Pas de moteur Parquet : table reconstruite à chaque chargement
+        print("[LOG] pyarrow / fastparquet absent : table des temps non mise en cache")
+    print(f"[LOG] Table des temps construite en {time.time() - start_time:.2f} secondes ({len(table)} communes)")
+    return table
+
+def routed_site_matrices(codes, travel_table, sites, est_dist_sites, avg_speed_kmh):
+    """
+    Temps (min) et distances (km) routiers en voiture de chaque commune vers chaque site, tableaux
+    empilés (S, N) pour assign_sites. Là où la table n'a pas de temps, il est déduit de la distance
+    routière à avg_speed_kmh ; sans distance, on garde l'estimation à vol d'oiseau `est_dist_sites`.
+    Renvoie (time_sites, dist_sites, routed) où routed[n] indique une commune trouvée dans la table.
+    """
+    dist_sites = np.array(est_dist_sites, dtype=np.float64)
+    time_sites = (dist_sites / avg_speed_kmh) * 60
+    if travel_table is None:
+        return time_sites, dist_sites, np.zeros(dist_sites.shape[1], dtype=bool)
+
+    rows = travel_table.reindex(pd.Index(codes).astype(str))
+    routed = np.ones(dist_sites.shape[1], dtype=bool)
+    for s, name in enumerate(sites):
+        col = SITE_COLUMNS[name]
+        km = rows[f"Voiture_{col}_km"].to_numpy(dtype=np.float64)
+        minutes = rows[f"Voiture_{col}_min"].to_numpy(dtype=np.float64)
+        minutes = np.where(np.isnan(minutes), (km / avg_speed_kmh) * 60, minutes)
+        has_km = ~np.isnan(km)
+        dist_sites[s, has_km] = km[has_km]
+        time_sites[s, has_km] = minutes[has_km]
+        routed &= has_km
+    return time_sites, dist_sites, routed
+
+# --- Nombre de travailleurs par commune ---
+
+def load_worker_counts(path=WORKERS_PATH, count_column=None):
+    """
+    Nombre de travailleurs du CHU par code commune (Series d'entiers indexée par code).
+    Sans colonne d'effectif, chaque ligne du fichier compte pour un travailleur (avec une ligne par commune,
+    tous les effectifs valent 1 et le mode pondéré équivaut au mode non pondéré).
+    Renvoie None si le fichier est absent.
+    """
+    if not os.path.exists(path):
+        return None
+    df = pd.read_csv(path, sep=';', dtype=str, encoding='utf-8-sig')
+    # Première colonne : code commune ("Code postal" dans MOBILITE.csv, codes INSEE en pratique)
+    codes = df.iloc[:, 0].str.strip()
+    if count_column is None:
+        counts = codes.dropna().value_counts()
+    else:
+        counts = pd.to_numeric(df[count_column], errors='coerce').fillna(0).groupby(codes).sum()
+    counts.index.name = 'code'
+    return counts.astype(np.int64).rename('workers')
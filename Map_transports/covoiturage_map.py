@@ -0,0 +1,95 @@
+import itertools
+import numpy as np
+
+# Rendu cartographique des routes de covoiturage.
+# Les géométries de toutes les routes sont construites en une passe sur des tableaux (pas de nodes.loc
+# par arrêt) et envoyées à folium en deux couches GeoJSON : une MultiLineString par niveau de charge
+# et une FeatureCollection des arrêts. La page HTML ne contient plus un objet folium par route.
+
+LOAD_COLORS = ["#3498db", "#f1c40f", "#e67e22", "#e74c3c"] # 0 (Solo) à 3 passagers (Max)
+
+def routes_geojson(routes, lon, lat, site, site_coords, precision=5):
+    """
+    Géométries GeoJSON des routes, regroupées par charge (0 à len(LOAD_COLORS) - 1).
+    lon, lat, site : tableaux indexés par noeud ; site_coords : (lon, lat) de chaque site du CHU.
+    Chaque ligne va du conducteur au dernier passager puis au site de la route.
+    Renvoie (lines, points) : FeatureCollection des MultiLineString (une par charge) et des arrêts.
+    """
+    n_routes = len(routes)
+    lengths = np.fromiter((len(r['stops']) for r in routes), dtype=np.int64, count=n_routes)
+    flat = np.fromiter(itertools.chain.from_iterable(r['stops'] for r in routes), dtype=np.int64, count=lengths.sum())
+    loads = np.minimum(np.fromiter((r['load'] for r in routes), dtype=np.int64, count=n_routes), len(LOAD_COLORS) - 1)
+    route_idx = np.repeat(np.arange(n_routes), lengths)
+    starts = np.cumsum(lengths) - lengths
+    position = np.arange(len(flat)) - np.repeat(starts, lengths)
+
+    # Coordonnées des lignes : les arrêts de chaque route suivis du site (un point de plus par route)
+    lonlat = np.round(np.column_stack([lon, lat]), precision)
+    sites_lonlat = np.round(np.asarray(site_coords, dtype=np.float64).reshape(-1, 2), precision)
+    line_coords = np.empty((len(flat) + n_routes, 2))
+    line_coords[np.arange(len(flat)) + route_idx] = lonlat[flat]
+    ends = np.cumsum(lengths + 1) - 1
+    line_coords[ends] = sites_lonlat[np.asarray(site)[flat[starts]]]
+
+    coords_l = line_coords.tolist()
+    bounds = np.concatenate([[0], ends + 1]).tolist()
+    per_route = [coords_l[a:b] for a, b in zip(bounds[:-1], bounds[1:])]
+    loads_l = loads.tolist()
+    lines = {
+        'type': 'FeatureCollection',
+        'features': [
+            {
+                'type': 'Feature',
+                'properties': {'load': load, 'nb_routes': loads_l.count(load)},
+                'geometry': {'type': 'MultiLineString', 'coordinates': [c for c, l in zip(per_route, loads_l) if l == load]},
+            }
+            for load in range(len(LOAD_COLORS)) if load in loads_l
+        ],
+    }
+
+    # Arrêts : conducteur (position 0) ou passager, avec la charge de la route
+    point_coords = lonlat[flat].tolist()
+    driver = (position == 0).tolist()
+    stop_loads = loads[route_idx].tolist()
+    points = {
+        'type': 'FeatureCollection',
+        'features': [
+            {'type': 'Feature', 'properties': {'node': n, 'driver': d, 'load': l},
+             'geometry': {'type': 'Point', 'coordinates': c}}
+            for n, d, l, c in zip(flat.tolist(), driver, stop_loads, point_coords)
+        ],
+    }
+    return lines, points
+
+def _line_style(feature):
+    load = feature['properties']['load']
+    return {'color': LOAD_COLORS[load], 'weight': 4 if load > 0 else 2, 'opacity': 0.8}
+
+def _point_style(feature):
+    p = feature['properties']
+    if p['driver']:
+        return {'radius': 5, 'color': LOAD_COLORS[p['load']], 'fillColor': LOAD_COLORS[p['load']], 'fillOpacity': 1, 'weight': 3}
+    return {'radius': 3, 'color': 'black', 'fillColor': 'white', 'fillOpacity': 1, 'weight': 1}
+
+def add_routes_layer(m, routes, nodes, site_coords):
+    """
+    Ajoute les routes à la carte folium `m` en deux couches GeoJSON (lignes par charge, arrêts).
+    Le nom de la commune est ajouté aux propriétés des arrêts pour l'infobulle.
+    """
+    import folium
+
+    lines, points = routes_geojson(routes, nodes['lon'].values, nodes['lat'].values, nodes['site'].values, site_coords)
+    names = nodes['nom'].astype(str).tolist()
+    for feature in points['features']:
+        p = feature['properties']
+        p['label'] = f"{'Conducteur' if p['driver'] else 'Passager'} : {names[p['node']]}"
+
+    folium.GeoJson(
+        lines, name="Routes", style_function=_line_style,
+        tooltip=folium.GeoJsonTooltip(fields=['load', 'nb_routes'], aliases=['Passagers', 'Routes']),
+    ).add_to(m)
+    folium.GeoJson(
+        points, name="Arrêts", marker=folium.CircleMarker(), style_function=_point_style,
+        tooltip=folium.GeoJsonTooltip(fields=['label'], labels=False),
+    ).add_to(m)
+    return m
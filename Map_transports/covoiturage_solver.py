@@ -0,0 +1,676 @@
+import numpy as np
+import scipy.sparse as sp
+
+# Numba optionnel : boucle de fusion compilée si disponible, boucle Python sinon
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+# Solveur Clarke-Wright (algorithme des économies) pour le covoiturage vers le CHU.
+# Module sans dépendance à Streamlit : utilisé par covoiturage_app.py et par benchmark_covoiturage.py.
+
+MAX_STOPS = 3
+
+# --- Calcul des Scores (Savings) ---
+
+def sparse_distance_matrix(coords_m, k=None, radius_m=None, tortuosity=1.3):
+    """
+    Distances (km, x tortuosité) limitées aux voisins proches, au format CSR, via un KD-tree :
+    k plus proches voisins (`k`) et/ou paires à moins de `radius_m` mètres.
+    Mémoire et temps en O(N.k) au lieu des deux matrices denses N x N. La diagonale n'est pas stockée.
+    """
+    from scipy.spatial import cKDTree
+
+    if k is None and radius_m is None:
+        raise ValueError("Préciser k et/ou radius_m pour la matrice creuse.")
+    n = len(coords_m)
+    tree = cKDTree(coords_m)
+
+    if k is not None:
+        # k + 1 : le noeud lui-même fait partie de ses voisins
+        dist, idx = tree.query(coords_m, k=min(k + 1, n))
+        rows = np.repeat(np.arange(n), dist.shape[1] if dist.ndim > 1 else 1)
+        dist, idx = dist.ravel(), idx.ravel()
+        if radius_m is not None:
+            keep = dist <= radius_m
+            rows, idx, dist = rows[keep], idx[keep], dist[keep]
+    else:
+        pairs = tree.query_pairs(radius_m, output_type='ndarray')
+        # query_pairs ne donne que i < j : on symétrise
+        rows = np.concatenate([pairs[:, 0], pairs[:, 1]])
+        idx = np.concatenate([pairs[:, 1], pairs[:, 0]])
+        dist = np.linalg.norm(coords_m[rows] - coords_m[idx], axis=1)
+
+    keep = rows != idx
+    mat = sp.csr_matrix(((dist[keep] / 1000) * tortuosity, (rows[keep], idx[keep])), shape=(n, n))
+    mat.sort_indices()
+    return mat
+
+def assign_sites(time_sites, dist_sites, site=None):
+    """
+    Plusieurs destinations (sites du CHU) : tableaux empilés (S, N) des temps et distances de chaque
+    noeud vers chaque site. Sans affectation fournie, chaque commune va au site le plus proche en temps.
+    Renvoie (site, time_chu, dist_chu) : le site de chaque noeud et ses temps / distances vers CE site,
+    ce qui ramène le calcul des économies à une seule matrice quel que soit le nombre de sites.
+    """
+    time_sites = np.atleast_2d(time_sites)
+    dist_sites = np.atleast_2d(dist_sites)
+    if site is None:
+        site = np.argmin(time_sites, axis=0)
+    site = np.asarray(site, dtype=np.int64)
+    idx = np.arange(time_sites.shape[1])
+    return site, time_sites[site, idx], dist_sites[site, idx]
+
+def detour_matrix(mat_time_min, time_chu, site=None, time_scale=1.0):
+    """
+    Détour (min) du conducteur i qui passe prendre j : T(i,j) + T(j, CHU) - T(i, CHU).
+    Logique R:
+    temp_mat = sweep(mat_time_min, 2, nodes$time_CHU, "+")  => T(i,j) + T(j, CHU)
+    detour_mat = sweep(temp_mat, 1, nodes$time_CHU, "-")    => T(i,j) + T(j, CHU) - T(i, CHU)
+    Matrice creuse (CSR) en entrée : même structure en sortie, seules les paires stockées sont candidates.
+    Plusieurs sites : `time_chu` donne le temps vers le site de chaque noeud (voir assign_sites) et `site`
+    interdit les paires de sites différents (détour infini en dense, paire retirée en creux). Toute route
+    reste ainsi vers un seul site, et le coût ne dépend pas du nombre de sites.
+    `time_scale` : minutes par unité de la matrice d'entrée (60 / vitesse pour une matrice en km, voir
+    minutes_per_km) ; la conversion est faite dans le calcul, sans matrice des temps N x N intermédiaire.
+    Le calcul reste dans le type de la matrice (float32 pour le cache) : time_chu est converti, et la seule
+    matrice N x N allouée est le résultat, complété sur place.
+    """
+    dtype = np.result_type(mat_time_min.dtype, np.float32)
+    time_scale = dtype.type(time_scale)
+    time_chu = np.asarray(time_chu, dtype=dtype)
+    if sp.issparse(mat_time_min):
+        mat_time_min = mat_time_min.tocsr()
+        rows = np.repeat(np.arange(mat_time_min.shape[0]), np.diff(mat_time_min.indptr))
+        cols = mat_time_min.indices
+        data = np.multiply(mat_time_min.data, time_scale, dtype=dtype)
+        data += time_chu[cols]
+        data -= time_chu[rows]
+        if site is not None:
+            keep = site[rows] == site[cols]
+            indptr = np.concatenate([[0], np.cumsum(np.bincount(rows[keep], minlength=mat_time_min.shape[0]))])
+            return sp.csr_matrix((data[keep], cols[keep], indptr), shape=mat_time_min.shape)
+        return sp.csr_matrix((data, cols, mat_time_min.indptr), shape=mat_time_min.shape)
+    detour_mat = np.multiply(mat_time_min, time_scale, dtype=dtype)
+    detour_mat += time_chu[None, :]
+    detour_mat -= time_chu[:, None]
+    if site is not None:
+        detour_mat[site[:, None] != site[None, :]] = np.inf
+    return detour_mat
+
+def savings_candidates(detour_mat, dist_chu, benefit_factor):
+    """
+    Candidats (i, j) de score strictement positif, dans l'ordre ligne par ligne (non triés).
+    score[i, j] = dist_chu[j] * factor - detour[i, j]  (term1_mat de R : colonnes identiques, valeur de j)
+    Renvoie trois tableaux (cand_i, cand_j, scores) ; le tri est fait paresseusement par merge_routes.
+    """
+    if sp.issparse(detour_mat):
+        # Seules les paires voisines stockées sont évaluées : O(N.k)
+        rows = np.repeat(np.arange(detour_mat.shape[0]), np.diff(detour_mat.indptr))
+        cols = detour_mat.indices
+        scores = (dist_chu * benefit_factor)[cols] - detour_mat.data
+        keep = (scores > 0) & (rows != cols)
+        return rows[keep].astype(np.int64), cols[keep].astype(np.int64), scores[keep]
+
+    score_mat = (dist_chu * benefit_factor)[None, :] - detour_mat
+
+    # Diagonale -Inf
+    np.fill_diagonal(score_mat, -np.inf)
+
+    rows, cols = np.nonzero(score_mat > 0)
+    return rows.astype(np.int64), cols.astype(np.int64), score_mat[rows, cols]
+
+# --- Communes pondérées (nombre de travailleurs) ---
+
+def pool_within_communes(workers, max_stops=MAX_STOPS):
+    """
+    Regroupement intra-commune : les travailleurs d'une même commune remplissent d'abord des voitures
+    pleines (conducteur + max_stops passagers, aucun détour). Il reste au plus une voiture partielle par
+    commune, qui est le noeud traité par l'algorithme des économies.
+    Renvoie (full_cars, init_load, has_rest) : voitures pleines par commune, charge initiale (passagers)
+    de la voiture restante, et False pour les communes sans reste (aucune route à fusionner).
+    """
+    workers = np.asarray(workers, dtype=np.int64)
+    full_cars, rest = np.divmod(workers, max_stops + 1)
+    return full_cars, np.maximum(rest - 1, 0), rest > 0
+
+# --- Fusion des routes ---
+
+def _merge_block_python(block_i, block_j, tail_route, head_route, tail, load, next_node, active, max_stops):
+    """
+    Boucle de fusion sur un bloc de candidats triés (modifie l'état des routes en place).
+    """
+    # Etat en listes Python pour la boucle (accès scalaire bien plus rapide qu'en numpy)
+    tail_route_l = tail_route.tolist()
+    head_route_l = head_route.tolist()
+    tail_l = tail.tolist()
+    load_l = load.tolist()
+
+    for i, j in zip(block_i.tolist(), block_j.tolist()):
+        r_i_idx = tail_route_l[i]
+        r_j_idx = head_route_l[j]
+
+        # i doit être la queue de sa route, j la tête de la sienne, routes distinctes
+        if r_i_idx < 0 or r_j_idx < 0 or r_i_idx == r_j_idx:
+            continue
+
+        # Check charge max (load i + load j + 1 nouveau passager (le driver j devient passager))
+        if load_l[r_i_idx] + load_l[r_j_idx] + 1 > max_stops:
+            continue
+
+        # Fusion : stops_i + stops_j
+        next_node[i] = j
+        new_tail = tail_l[r_j_idx]
+        tail_route_l[i] = -1
+        head_route_l[j] = -1
+        tail_route_l[new_tail] = r_i_idx
+        tail_l[r_i_idx] = new_tail
+        load_l[r_i_idx] += load_l[r_j_idx] + 1
+        active[r_j_idx] = False
+
+    tail_route[:] = tail_route_l
+    head_route[:] = head_route_l
+    tail[:] = tail_l
+    load[:] = load_l
+
+def _merge_block_arrays(block_i, block_j, tail_route, head_route, tail, load, next_node, active, max_stops):
+    """
+    Même boucle que _merge_block_python, écrite sur les tableaux numpy pour être compilée par Numba.
+    """
+    for k in range(block_i.shape[0]):
+        i = block_i[k]
+        j = block_j[k]
+        r_i_idx = tail_route[i]
+        r_j_idx = head_route[j]
+        if r_i_idx < 0 or r_j_idx < 0 or r_i_idx == r_j_idx:
+            continue
+        if load[r_i_idx] + load[r_j_idx] + 1 > max_stops:
+            continue
+        next_node[i] = j
+        new_tail = tail[r_j_idx]
+        tail_route[i] = -1
+        head_route[j] = -1
+        tail_route[new_tail] = r_i_idx
+        tail[r_i_idx] = new_tail
+        load[r_i_idx] += load[r_j_idx] + 1
+        active[r_j_idx] = False
+
+def _compact_numpy(cand_i, cand_j, scores, position, tail_route, head_route, load, max_stops, upper):
+    """
+    Garde les candidats encore faisables et pas encore traités (score < upper), dans le même ordre.
+    """
+    r_i = tail_route[cand_i]
+    r_j = head_route[cand_j]
+    keep = (scores < upper) & (r_i >= 0) & (r_j >= 0) & (r_i != r_j) & (load[r_i] + load[r_j] + 1 <= max_stops)
+    return cand_i[keep], cand_j[keep], scores[keep], position[keep]
+
+def _compact_arrays(cand_i, cand_j, scores, position, tail_route, head_route, load, max_stops, upper):
+    """
+    Même filtre que _compact_numpy, en place (compaction en tête des tableaux), pour Numba.
+    Renvoie le nombre de candidats conservés.
+    """
+    n = 0
+    for k in range(cand_i.shape[0]):
+        if scores[k] >= upper:
+            continue
+        r_i_idx = tail_route[cand_i[k]]
+        r_j_idx = head_route[cand_j[k]]
+        if r_i_idx < 0 or r_j_idx < 0 or r_i_idx == r_j_idx:
+            continue
+        if load[r_i_idx] + load[r_j_idx] + 1 > max_stops:
+            continue
+        cand_i[n] = cand_i[k]
+        cand_j[n] = cand_j[k]
+        scores[n] = scores[k]
+        position[n] = position[k]
+        n += 1
+    return n
+
+if njit is not None:
+    _merge_block_numba = njit(cache=True, nogil=True)(_merge_block_arrays)
+    _compact_jit = njit(cache=True, nogil=True)(_compact_arrays)
+
+    def _compact_numba(cand_i, cand_j, scores, position, tail_route, head_route, load, max_stops, upper):
+        n = _compact_jit(cand_i, cand_j, scores, position, tail_route, head_route, load, max_stops, upper)
+        return cand_i[:n], cand_j[:n], scores[:n], position[:n]
+else:
+    _merge_block_numba = None
+    _compact_numba = None
+
+def _sort_block(block, scores, position):
+    """
+    Bloc trié par score décroissant, ex-aequo dans l'ordre de `position` (résultat d'un tri stable).
+    Le tri rapide (non stable) est plusieurs fois plus rapide que le tri stable : on ne retrie ensuite
+    que les suites d'ex-aequo, rares sur des temps réels.
+    """
+    # Bloc complet (block = arange) : pas d'indirection
+    full = len(block) == len(scores)
+    block_scores = scores if full else scores[block]
+    order = np.argsort(-block_scores)
+    sorted_scores = block_scores[order]
+    tied = sorted_scores[1:] == sorted_scores[:-1]
+    if tied.any():
+        members = np.flatnonzero(np.concatenate(([False], tied)) | np.concatenate((tied, [False])))
+        run = np.concatenate(([0], np.cumsum(~tied)))[members]
+        tied_order = order[members]
+        order[members] = tied_order[np.lexsort((position[tied_order if full else block[tied_order]], run))]
+    return order if full else block[order]
+
+MERGE_KERNELS = ("auto", "numba", "python")
+
+def _select_kernel(kernel):
+    """
+    Renvoie le couple (fusion d'un bloc, filtre des candidats) du noyau demandé.
+    """
+    if kernel == "auto":
+        kernel = "numba" if _merge_block_numba is not None else "python"
+    if kernel == "numba":
+        if _merge_block_numba is None:
+            raise ImportError("numba n'est pas installé : noyau de fusion compilé indisponible.")
+        return _merge_block_numba, _compact_numba
+    if kernel == "python":
+        return _merge_block_python, _compact_numpy
+    raise ValueError(f"Noyau de fusion inconnu: {kernel} (attendu: {', '.join(MERGE_KERNELS)})")
+
+def merge_routes(n_nodes, cand_i, cand_j, scores, max_stops=MAX_STOPS, chunk_size=None, kernel="auto",
+                 init_load=None, init_active=None):
+    """
+    Fusion Clarke-Wright des candidats par score décroissant.
+
+    Une route est décrite par des tableaux d'entiers : tête (conducteur), queue, charge (nb de passagers),
+    et `next_node` (liste chaînée des arrêts). Une fusion I + J n'est possible que si i est la queue
+    de I et j la tête de J ; on indexe donc les routes par leurs extrémités (`tail_route`, `head_route`,
+    -1 si le noeud n'est plus une extrémité).
+
+    Les candidats ne sont jamais triés en entier : à chaque tour, on élimine en une passe les paires déjà
+    traitées ou devenues impossibles (un noeud qui cesse d'être queue ou tête ne le redevient jamais, les
+    charges ne font que croître), puis on extrait par argpartition le bloc des meilleurs scores restants,
+    qui seul est trié. A score égal, l'ordre est celui de `cand_i, cand_j` (voir _sort_block) : le résultat
+    est celui d'un tri complet stable.
+
+    kernel : 'numba' (filtre et boucle compilés), 'python' (filtre numpy, boucle sur listes Python)
+    ou 'auto' (numba si installé). Les deux noyaux donnent exactement les mêmes routes.
+
+    Communes pondérées (voir pool_within_communes) : `init_load` donne la charge initiale de la route de
+    chaque noeud (passagers de la même commune) et `init_active` retire les noeuds sans route. Le test de
+    capacité reste load(I) + load(J) + 1 <= max_stops : la fusion est contrainte par les effectifs réels.
+
+    Renvoie (next_node, load, active).
+    """
+    merge_block, compact = _select_kernel(kernel)
+    if chunk_size is None:
+        # La boucle compilée absorbe de gros blocs ; en Python on filtre plus souvent
+        chunk_size = max(64 * n_nodes, 65536) if merge_block is _merge_block_numba else max(4 * n_nodes, 1024)
+
+    tail_route = np.arange(n_nodes)
+    head_route = np.arange(n_nodes)
+    tail = np.arange(n_nodes)
+    load = np.zeros(n_nodes, dtype=np.int64) if init_load is None else np.array(init_load, dtype=np.int64)
+    next_node = np.full(n_nodes, -1, dtype=np.int64)
+    active = np.ones(n_nodes, dtype=bool) if init_active is None else np.array(init_active, dtype=bool)
+    # Noeud sans route : ni queue ni tête, ses candidats sont éliminés par le premier filtre
+    tail_route[~active] = -1
+    head_route[~active] = -1
+
+    # Copies de travail (le filtre compilé compacte les tableaux en place)
+    cand_i = np.array(cand_i, dtype=np.int64)
+    cand_j = np.array(cand_j, dtype=np.int64)
+    scores = np.array(scores, dtype=np.float64)
+    position = np.arange(len(cand_i))
+    upper = np.inf
+
+    while True:
+        cand_i, cand_j, scores, position = compact(cand_i, cand_j, scores, position, tail_route, head_route, load, max_stops, upper)
+        if len(cand_i) == 0:
+            break
+
+        # Bloc des meilleurs scores : seuil par argpartition, ex-aequo du seuil inclus
+        if len(scores) > chunk_size:
+            upper = scores[np.argpartition(-scores, chunk_size - 1)[chunk_size - 1]]
+            block = np.flatnonzero(scores >= upper)
+        else:
+            upper = -np.inf
+            block = np.arange(len(scores))
+
+        block = _sort_block(block, scores, position)
+        merge_block(cand_i[block], cand_j[block], tail_route, head_route, tail, load, next_node, active, max_stops)
+
+    return next_node, load, active
+
+def route_assignment(next_node, active, max_stops=MAX_STOPS):
+    """
+    Affectation des noeuds aux routes, sans boucle Python par route :
+    `route_id[n]` (id de la route = conducteur) et `position[n]` (rang de l'arrêt, 0 = conducteur).
+    On avance toutes les routes d'un arrêt à la fois (au plus max_stops + 1 arrêts).
+    """
+    route_id = np.full(len(next_node), -1, dtype=np.int64)
+    position = np.full(len(next_node), -1, dtype=np.int64)
+    heads = np.flatnonzero(active)
+    current = heads
+    for step in range(max_stops + 1):
+        route_id[current] = heads
+        position[current] = step
+        following = next_node[current]
+        keep = following >= 0
+        heads, current = heads[keep], following[keep]
+        if len(current) == 0:
+            break
+    return route_id, position
+
+def routes_from_arrays(next_node, load, active):
+    """
+    Liste de routes (dicts 'id', 'driver', 'stops', 'load'), au format de l'implémentation d'origine.
+    La tête d'une route est toujours son conducteur initial : l'id de la route.
+    """
+    next_l = next_node.tolist()
+    load_l = load.tolist()
+    routes = []
+    for r in np.flatnonzero(active).tolist():
+        stops = [r]
+        while next_l[stops[-1]] >= 0:
+            stops.append(next_l[stops[-1]])
+        routes.append({'id': r, 'driver': r, 'stops': stops, 'load': load_l[r]})
+    return routes
+
+def route_stats(next_node, load, active, dist_chu, mat_dist_km, workers=None, max_stops=MAX_STOPS):
+    """
+    Statistiques d'une solution par indexation de tableaux (pas de boucle par route).
+    Chaque noeud sans successeur est la fin d'une route : il rejoint le CHU (le site de sa route, dist_chu étant relatif à ce site).
+    Communes pondérées : la situation initiale compte un trajet solo par travailleur, et les voitures
+    pleines intra-commune (pool_within_communes) s'ajoutent aux routes.
+    """
+    links = np.flatnonzero(next_node >= 0)
+    # Matrice creuse : les routes n'utilisent que des paires stockées
+    link_km = np.asarray(mat_dist_km[links, next_node[links]]).ravel()
+    # Noeuds portés par une route : têtes actives et successeurs
+    in_route = active.copy()
+    in_route[next_node[links]] = True
+    total_km_final = link_km.sum() + dist_chu[in_route & (next_node < 0)].sum()
+    nb_routes = int(active.sum())
+    nb_solos = int((active & (load == 0)).sum())
+    stats = {}
+    if workers is None:
+        total_km_initial = dist_chu.sum()
+    else:
+        full_cars = pool_within_communes(workers, max_stops)[0]
+        total_km_initial = (np.asarray(workers) * dist_chu).sum()
+        total_km_final += (full_cars * dist_chu).sum()
+        nb_routes += int(full_cars.sum())
+        stats = {'nb_workers': int(np.sum(workers)), 'nb_full_cars': int(full_cars.sum())}
+    return {
+        'nb_carpools': nb_routes - nb_solos,
+        'nb_solos': nb_solos,
+        'total_km_initial': float(total_km_initial),
+        'total_km_final': float(total_km_final),
+        'saved_km': float(total_km_initial - total_km_final),
+        **stats,
+    }
+
+def solve_arrays(detour_mat, dist_chu, benefit_factor, max_stops=MAX_STOPS, kernel="auto", workers=None):
+    """
+    Résolution à partir d'une matrice de détour précalculée (seul le terme dist_chu * factor dépend du facteur).
+    `workers` : nombre de travailleurs par commune (regroupement intra-commune puis fusion des voitures restantes).
+    Renvoie (next_node, load, active).
+    """
+    cand_i, cand_j, scores = savings_candidates(detour_mat, dist_chu, benefit_factor)
+    init_load = init_active = None
+    if workers is not None:
+        _, init_load, init_active = pool_within_communes(workers, max_stops)
+    return merge_routes(len(dist_chu), cand_i, cand_j, scores, max_stops, kernel=kernel,
+                        init_load=init_load, init_active=init_active)
+
+# --- Post-optimisation (recherche locale) ---
+
+def _pair_lookup(mat, scale=1.0):
+    """
+    Accès scalaire (i, j) -> valeur x scale. Matrice creuse : dict par ligne des paires stockées, inf sinon.
+    """
+    scale = np.float32(scale)
+    if sp.issparse(mat):
+        mat = mat.tocsr()
+        data = mat.data * scale if scale != 1 else mat.data
+        rows = [dict(zip(mat.indices[a:b].tolist(), data[a:b].tolist()))
+                for a, b in zip(mat.indptr[:-1].tolist(), mat.indptr[1:].tolist())]
+        return lambda i, j: rows[i].get(j, np.inf)
+    if scale != 1:
+        return lambda i, j: float(mat[i, j] * scale)
+    return lambda i, j: float(mat[i, j])
+
+def neighbour_lists(mat_time_min, n_neighbours=10):
+    """
+    Les n_neighbours noeuds les plus proches (en temps) de chaque noeud, hors lui-même : liste de listes.
+    Borne le travail de la recherche locale à O(N.k) mouvements par passe.
+    """
+    if sp.issparse(mat_time_min):
+        mat = mat_time_min.tocsr()
+        neighbours = []
+        for a, b in zip(mat.indptr[:-1].tolist(), mat.indptr[1:].tolist()):
+            order = np.argsort(mat.data[a:b], kind='stable')[:n_neighbours]
+            neighbours.append(mat.indices[a:b][order].tolist())
+        return neighbours
+    n = mat_time_min.shape[0]
+    k = min(n_neighbours + 1, n)
+    neighbours = []
+    for start in range(0, n, 2048):
+        block = np.array(mat_time_min[start:start + 2048], dtype=np.float64)
+        block[np.arange(len(block)), np.arange(start, start + len(block))] = np.inf
+        idx = np.argpartition(block, k - 1, axis=1)[:, :k]
+        order = np.argsort(np.take_along_axis(block, idx, axis=1), axis=1, kind='stable')
+        neighbours.extend(np.take_along_axis(idx, order, axis=1)[:, :n_neighbours].tolist())
+    return neighbours
+
+def improve_routes(routes, mat_time_min, time_chu, mat_dist_km=None, dist_chu=None, max_stops=MAX_STOPS,
+                   time_budget=1.0, n_neighbours=10, site=None, workers=None, time_scale=1.0):
+    """
+    Recherche locale après Clarke-Wright, sur le temps total de conduite (mat_time_min + time_chu du dernier arrêt) :
+    - 2-opt : inversion d'un segment d'une route (le conducteur peut changer) ;
+    - relocate : un passager passe dans une route voisine (avant ou après un voisin) ;
+    - swap : échange de deux arrêts entre deux routes voisines.
+    Les voisins d'un arrêt sont ses n_neighbours plus proches noeuds (neighbour_lists). Les routes ont au plus
+    max_stops + 1 arrêts : un mouvement n'est évalué que sur les deux routes touchées (delta). Le nombre de
+    voitures est inchangé (une route n'est jamais vidée), la capacité compte les personnes de chaque arrêt
+    (`workers` : voitures restantes du mode pondéré) et les routes restent vers un seul site (`site`).
+    Premier mouvement améliorant, passes successives jusqu'à l'optimum local ou l'épuisement de time_budget (s).
+    `time_scale` : comme pour detour_matrix, mat_time_min peut être la matrice des km (seules les paires
+    évaluées sont converties en minutes ; l'ordre des voisins ne dépend pas de l'échelle).
+
+    Renvoie (routes, report) ; report contient les temps et km avant / après et les km économisés par seconde.
+    """
+    import time
+
+    start = time.perf_counter()
+    deadline = start + time_budget
+    t_pair = _pair_lookup(mat_time_min, time_scale)
+    t_end = time_chu.tolist()
+    d_pair = _pair_lookup(mat_dist_km) if mat_dist_km is not None else None
+    d_end = dist_chu.tolist() if dist_chu is not None else None
+
+    # Personnes portées par chaque arrêt (1 par commune, ou le reste de pool_within_communes)
+    if workers is None:
+        people = [1] * len(t_end)
+    else:
+        _, init_load, has_rest = pool_within_communes(workers, max_stops)
+        people = np.where(has_rest, init_load + 1, 0).tolist()
+    node_site = site.tolist() if site is not None else None
+    capacity = max_stops + 1
+
+    stops = [list(r['stops']) for r in routes]
+    ids = [r['id'] for r in routes]
+    route_of = {}
+    for r, path in enumerate(stops):
+        for node in path:
+            route_of[node] = r
+    route_people = [sum(people[node] for node in path) for path in stops]
+
+    def cost(path):
+        return sum(t_pair(a, b) for a, b in zip(path[:-1], path[1:])) + t_end[path[-1]]
+
+    def km(path):
+        return sum(d_pair(a, b) for a, b in zip(path[:-1], path[1:])) + d_end[path[-1]]
+
+    costs = [cost(path) for path in stops]
+    time_before = sum(costs)
+    km_before = sum(km(path) for path in stops) if d_pair is not None else None
+    neighbours = neighbour_lists(mat_time_min, n_neighbours)
+    moves = {'2opt': 0, 'relocate': 0, 'swap': 0}
+    eps = 1e-9
+
+    def try_two_opt(r):
+        path = stops[r]
+        best, best_path = costs[r] - eps, None
+        for a in range(len(path) - 1):
+            for b in range(a + 1, len(path)):
+                candidate = path[:a] + path[a:b + 1][::-1] + path[b + 1:]
+                c = cost(candidate)
+                if c < best:
+                    best, best_path = c, candidate
+        if best_path is None:
+            return False
+        stops[r], costs[r] = best_path, best
+        moves['2opt'] += 1
+        return True
+
+    def apply(ra, path_a, ca, rb, path_b, cb):
+        stops[ra], costs[ra], stops[rb], costs[rb] = path_a, ca, path_b, cb
+        for r in (ra, rb):
+            route_people[r] = sum(people[node] for node in stops[r])
+            for node in stops[r]:
+                route_of[node] = r
+
+    def try_relocate(u):
+        ra = route_of[u]
+        if len(stops[ra]) < 2:
+            return False
+        path_a = [node for node in stops[ra] if node != u]
+        ca = cost(path_a)
+        for v in neighbours[u]:
+            rb = route_of.get(v)
+            if rb is None or rb == ra or route_people[rb] + people[u] > capacity:
+                continue
+            if node_site is not None and node_site[u] != node_site[v]:
+                continue
+            k = stops[rb].index(v)
+            for pos in (k, k + 1):
+                path_b = stops[rb][:pos] + [u] + stops[rb][pos:]
+                cb = cost(path_b)
+                if ca + cb < costs[ra] + costs[rb] - eps:
+                    apply(ra, path_a, ca, rb, path_b, cb)
+                    moves['relocate'] += 1
+                    return True
+        return False
+
+    def try_swap(u):
+        ra = route_of[u]
+        for v in neighbours[u]:
+            rb = route_of.get(v)
+            if rb is None or rb == ra:
+                continue
+            if node_site is not None and node_site[u] != node_site[v]:
+                continue
+            delta_people = people[v] - people[u]
+            if route_people[ra] + delta_people > capacity or route_people[rb] - delta_people > capacity:
+                continue
+            path_a = [v if node == u else node for node in stops[ra]]
+            path_b = [u if node == v else node for node in stops[rb]]
+            ca, cb = cost(path_a), cost(path_b)
+            if ca + cb < costs[ra] + costs[rb] - eps:
+                apply(ra, path_a, ca, rb, path_b, cb)
+                moves['swap'] += 1
+                return True
+        return False
+
+    passes = 0
+    improved = True
+    while improved and time.perf_counter() < deadline:
+        improved = False
+        passes += 1
+        for r in range(len(stops)):
+            if time.perf_counter() >= deadline:
+                break
+            if len(stops[r]) >= 2 and try_two_opt(r):
+                improved = True
+        for u in list(route_of):
+            if time.perf_counter() >= deadline:
+                break
+            if try_relocate(u) or try_swap(u):
+                improved = True
+
+    elapsed = time.perf_counter() - start
+    new_routes = [{'id': ids[r], 'driver': path[0], 'stops': path, 'load': route_people[r] - 1}
+                  for r, path in enumerate(stops)]
+    time_after = sum(costs)
+    report = {
+        'time_before': time_before,
+        'time_after': time_after,
+        'elapsed_s': elapsed,
+        'passes': passes,
+        'converged': not improved,
+        'moves': moves,
+    }
+    if d_pair is not None:
+        km_after = sum(km(path) for path in stops)
+        report.update(km_before=km_before, km_after=km_after, saved_km=km_before - km_after,
+                      km_per_s=(km_before - km_after) / elapsed if elapsed > 0 else 0.0)
+    return new_routes, report
+
+# --- Balayage des facteurs (processus en arrière-plan) ---
+
+_SWEEP_DATA = {}
+SWEEP_MAX_WORKERS = 4 # Chaque processus tient sa propre matrice de détour : pool borné par défaut
+
+def _init_sweep_worker(load_matrix, time_chu, dist_chu, time_scale, site, max_stops, kernel, workers):
+    # Matrice des km ouverte en mmap dans le processus (seul le chargeur est envoyé), détour calculé sur place
+    mat_dist_km = load_matrix()
+    detour_mat = detour_matrix(mat_dist_km, time_chu, site, time_scale)
+    _SWEEP_DATA.update(detour_mat=detour_mat, dist_chu=dist_chu, mat_dist_km=mat_dist_km, max_stops=max_stops,
+                       kernel=kernel, workers=workers)
+
+def _solve_sweep_point(benefit_factor):
+    d = _SWEEP_DATA
+    solution = solve_arrays(d['detour_mat'], d['dist_chu'], benefit_factor, d['max_stops'], d['kernel'], d['workers'])
+    return solution, route_stats(*solution, d['dist_chu'], d['mat_dist_km'], d['workers'], d['max_stops'])
+
+def start_sweep(load_matrix, time_chu, dist_chu, factors, time_scale=1.0, site=None, max_stops=MAX_STOPS, kernel="auto",
+                max_workers=None, workers=None):
+    """
+    Lance la résolution pour tous les facteurs dans un pool de processus.
+    `load_matrix` : fonction sans argument picklable renvoyant la matrice des km (ex. functools.partial de
+    covoiturage_data.open_distance_matrix). Chaque processus ouvre le cache en mmap et construit sa matrice
+    de détour (time_scale, site : voir detour_matrix) ; seuls des vecteurs de taille N sont envoyés.
+    `max_workers` : au plus SWEEP_MAX_WORKERS processus par défaut.
+    Renvoie (executor, {facteur: Future}) ; chaque Future donne ((next_node, load, active), stats).
+    """
+    import os
+    import multiprocessing as mp
+    from concurrent.futures import ProcessPoolExecutor
+
+    if max_workers is None:
+        max_workers = min(SWEEP_MAX_WORKERS, os.cpu_count() or 1, len(factors))
+    executor = ProcessPoolExecutor(
+        max_workers=max(1, max_workers),
+        # 'spawn' : pas de fork d'un processus serveur multi-thread (Streamlit)
+        mp_context=mp.get_context("spawn"),
+        initializer=_init_sweep_worker,
+        initargs=(load_matrix, time_chu, dist_chu, time_scale, site, max_stops, kernel, workers),
+    )
+    futures = {float(f): executor.submit(_solve_sweep_point, float(f)) for f in factors}
+    return executor, futures
+
+def solve_covoiturage(nodes, mat_dist_km, mat_time_min, benefit_factor, max_stops=MAX_STOPS, kernel="auto"):
+    """
+    Algorithme des économies : au départ tout le monde est son propre conducteur, puis on fusionne
+    les routes par score décroissant (fin de I -> début de J) tant que la charge reste <= max_stops.
+    Le 'load' compte le nombre de PASSAGERS récupérés (personnes qui ne conduisent plus).
+    Une colonne 'site' (voir assign_sites) limite les regroupements aux communes d'un même site.
+    Une colonne 'workers' (travailleurs par commune) active le mode pondéré : seules les voitures restant
+    après le regroupement intra-commune sont renvoyées (les voitures pleines ne fusionnent avec rien).
+    """
+    time_chu = nodes['time_CHU'].values
+    dist_chu = nodes['dist_CHU'].values
+    # Plusieurs sites : time_CHU / dist_CHU sont relatifs au site de chaque noeud (colonne 'site')
+    site = nodes['site'].values if 'site' in nodes else None
+    workers = nodes['workers'].values if 'workers' in nodes else None
+
+    detour_mat = detour_matrix(mat_time_min, time_chu, site)
+    return routes_from_arrays(*solve_arrays(detour_mat, dist_chu, benefit_factor, max_stops, kernel, workers))
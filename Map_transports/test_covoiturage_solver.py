@@ -0,0 +1,208 @@
+import os
+import sys
+import functools
+
+import numpy as np
+import pytest
+
+# Modules importés à plat, comme lorsque l'application est lancée depuis ce dossier
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from covoiturage_solver import (solve_covoiturage, assign_sites, detour_matrix, savings_candidates, merge_routes, routes_from_arrays,
+                                pool_within_communes, sparse_distance_matrix, solve_arrays, route_stats, start_sweep, _merge_block_numba,
+                                improve_routes, _sort_block)
+from covoiturage_data import minutes_per_km
+from benchmark_covoiturage import AVG_SPEED_KMH, TORTUOSITY, synthetic_nodes, distance_matrices, solve_covoiturage_reference
+
+
+@pytest.fixture(scope="module")
+def communes():
+    nodes, coords, sites_m = synthetic_nodes(150, seed=3)
+    mat_dist_km, mat_time_min = distance_matrices(coords)
+    return nodes, coords, sites_m, mat_dist_km, mat_time_min
+
+
+@pytest.mark.parametrize("factor", [0.5, 1.0, 3.0])
+def test_array_solver_matches_reference(communes, factor):
+    nodes, _, _, mat_dist_km, mat_time_min = communes
+    routes = solve_covoiturage(nodes, mat_dist_km, mat_time_min, factor, kernel="python")
+    assert routes == solve_covoiturage_reference(nodes, mat_dist_km, mat_time_min, factor)
+    assert any(r['load'] > 0 for r in routes)
+
+
+def test_small_blocks_give_full_sort_order(communes):
+    # Blocs plus petits que la liste des candidats : extraction par argpartition et filtres successifs
+    nodes, _, _, mat_dist_km, mat_time_min = communes
+    detour_mat = detour_matrix(mat_time_min, nodes['time_CHU'].values)
+    candidates = savings_candidates(detour_mat, nodes['dist_CHU'].values, 2.0)
+    reference = solve_covoiturage_reference(nodes, mat_dist_km, mat_time_min, 2.0)
+    for chunk_size in (7, 100, 1000):
+        solution = merge_routes(len(nodes), *candidates, chunk_size=chunk_size, kernel="python")
+        assert routes_from_arrays(*solution) == reference
+
+
+def test_sort_block_is_stable_on_ties():
+    rng = np.random.default_rng(0)
+    for _ in range(50):
+        # Scores entiers : nombreux ex-aequo
+        scores = rng.integers(0, 6, size=300).astype(np.float64)
+        position = np.arange(300)
+        for block in (position, np.sort(rng.choice(300, size=120, replace=False))):
+            expected = block[np.lexsort((position[block], -scores[block]))]
+            np.testing.assert_array_equal(_sort_block(block, scores, position), expected)
+
+
+@pytest.mark.skipif(_merge_block_numba is None, reason="numba n'est pas installé")
+@pytest.mark.parametrize("weighted", [False, True])
+def test_numba_kernel_matches_python(communes, weighted):
+    nodes, _, _, _, mat_time_min = communes
+    # Temps arrondis à la minute : des ex-aequo que les deux noyaux doivent départager de la même façon
+    detour_mat = detour_matrix(np.round(mat_time_min), np.round(nodes['time_CHU'].values))
+    init_load = init_active = None
+    if weighted:
+        workers = np.random.default_rng(1).geometric(0.3, size=len(nodes))
+        _, init_load, init_active = pool_within_communes(workers)
+    for factor in (0.5, 2.0):
+        candidates = savings_candidates(detour_mat, nodes['dist_CHU'].values, factor)
+        for chunk_size in (None, 100):
+            python = merge_routes(len(nodes), *candidates, chunk_size=chunk_size, kernel="python",
+                                  init_load=init_load, init_active=init_active)
+            numba = merge_routes(len(nodes), *candidates, chunk_size=chunk_size, kernel="numba",
+                                 init_load=init_load, init_active=init_active)
+            for a, b in zip(python, numba):
+                np.testing.assert_array_equal(a, b)
+
+
+def test_unknown_kernel():
+    with pytest.raises(ValueError):
+        merge_routes(2, np.array([0]), np.array([1]), np.array([1.0]), kernel="cuda")
+
+
+def test_sweep_matches_direct_solve(communes, tmp_path):
+    nodes, _, _, mat_dist_km, _ = communes
+    time_chu, dist_chu = nodes['time_CHU'].values, nodes['dist_CHU'].values
+    # Cache des km ouvert en mmap par chaque processus, converti en minutes par time_scale
+    path = tmp_path / "distances.npy"
+    np.save(path, mat_dist_km.astype(np.float32))
+    time_scale = minutes_per_km(AVG_SPEED_KMH)
+    factors = [0.5, 1.0, 2.0]
+    executor, futures = start_sweep(functools.partial(np.load, path, mmap_mode='r'), time_chu, dist_chu, factors,
+                                    time_scale=time_scale, max_workers=2)
+    try:
+        results = {f: future.result(timeout=120) for f, future in futures.items()}
+    finally:
+        executor.shutdown()
+
+    detour_mat = detour_matrix(np.load(path), time_chu, time_scale=time_scale)
+    for factor in factors:
+        expected = solve_arrays(detour_mat, dist_chu, factor)
+        solution, stats = results[factor]
+        for a, b in zip(solution, expected):
+            np.testing.assert_array_equal(a, b)
+        assert stats == route_stats(*expected, dist_chu, np.load(path))
+
+
+def test_knn_matrix_with_every_neighbour_gives_dense_routes(communes):
+    nodes, coords, _, mat_dist_km, mat_time_min = communes
+    time_chu, dist_chu = nodes['time_CHU'].values, nodes['dist_CHU'].values
+    sparse_dist_km = sparse_distance_matrix(coords, k=len(nodes) - 1, tortuosity=TORTUOSITY)
+    # Diagonale non stockée, autres paires identiques aux matrices denses
+    assert sparse_dist_km.nnz == len(nodes) * (len(nodes) - 1)
+    np.testing.assert_allclose(sparse_dist_km.toarray(), mat_dist_km)
+
+    sparse_detour = detour_matrix(sparse_dist_km, time_chu, time_scale=minutes_per_km(AVG_SPEED_KMH))
+    dense_detour = detour_matrix(mat_time_min, time_chu)
+    rows, cols = sparse_detour.nonzero()
+    np.testing.assert_allclose(np.asarray(sparse_detour[rows, cols]).ravel(), dense_detour[rows, cols])
+    for factor in (0.5, 2.0):
+        for a, b in zip(solve_arrays(sparse_detour, dist_chu, factor), solve_arrays(dense_detour, dist_chu, factor)):
+            np.testing.assert_array_equal(a, b)
+
+
+def test_knn_routes_use_stored_pairs_only(communes):
+    nodes, coords, _, _, _ = communes
+    dist_chu = nodes['dist_CHU'].values
+    sparse_dist_km = sparse_distance_matrix(coords, k=5, tortuosity=TORTUOSITY)
+    sparse_time_min = sparse_dist_km * minutes_per_km(AVG_SPEED_KMH)
+    next_node, load, active = solve_arrays(detour_matrix(sparse_time_min, nodes['time_CHU'].values), dist_chu, 2.0)
+    links = np.flatnonzero(next_node >= 0)
+    assert len(links) > 0
+    assert (np.asarray(sparse_dist_km[links, next_node[links]]).ravel() > 0).all()
+    assert load.max() <= 3 and load[active].sum() == len(links)
+
+    # Voisins dans un rayon : paires symétriques
+    radius_km = sparse_distance_matrix(coords, radius_m=8000, tortuosity=TORTUOSITY)
+    assert (radius_km != radius_km.T).nnz == 0
+    assert radius_km.data.max() <= 8 * TORTUOSITY
+
+
+def test_cross_site_pairs_are_masked(communes):
+    nodes, coords, sites_m, mat_dist_km, mat_time_min = communes
+    dist_sites = (np.linalg.norm(coords[None, :, :] - sites_m[:, None, :], axis=2) / 1000) * TORTUOSITY
+    site, time_chu, dist_chu = assign_sites(dist_sites * minutes_per_km(AVG_SPEED_KMH), dist_sites)
+    assert len(np.unique(site)) == 2
+
+    # CSR : les paires de sites différents sont retirées, les autres gardent leur détour
+    sparse_dist_km = sparse_distance_matrix(coords, k=30, tortuosity=TORTUOSITY)
+    sparse_detour = detour_matrix(sparse_dist_km, time_chu, site, minutes_per_km(AVG_SPEED_KMH))
+    rows, cols = sparse_detour.nonzero()
+    assert (site[rows] == site[cols]).all()
+    all_rows, all_cols = sparse_dist_km.nonzero()
+    same = site[all_rows] == site[all_cols]
+    assert sparse_detour.nnz == same.sum() < sparse_dist_km.nnz
+    unmasked = detour_matrix(sparse_dist_km, time_chu, time_scale=minutes_per_km(AVG_SPEED_KMH))
+    np.testing.assert_array_equal(np.asarray(sparse_detour[rows, cols]).ravel(), np.asarray(unmasked[rows, cols]).ravel())
+
+    # Dense : détour infini entre sites, jamais candidat
+    dense_detour = detour_matrix(mat_time_min, time_chu, site)
+    cross = site[:, None] != site[None, :]
+    assert np.isinf(dense_detour[cross]).all() and np.isfinite(dense_detour[~cross]).all()
+
+    multi = nodes.assign(site=site, time_CHU=time_chu, dist_CHU=dist_chu)
+    for factor in (1.0, 5.0):
+        routes = solve_covoiturage(multi, mat_dist_km, mat_time_min, factor)
+        assert any(r['load'] > 0 for r in routes)
+        assert all(len(set(site[r['stops']])) == 1 for r in routes)
+        next_node, _, _ = solve_arrays(sparse_detour, dist_chu, factor)
+        links = np.flatnonzero(next_node >= 0)
+        assert (site[links] == site[next_node[links]]).all()
+
+
+def _driving_time(routes, mat_time_min, time_chu):
+    return sum(sum(mat_time_min[a, b] for a, b in zip(r['stops'][:-1], r['stops'][1:])) + time_chu[r['stops'][-1]]
+               for r in routes)
+
+
+@pytest.mark.parametrize("factor", [1.0, 3.0])
+def test_local_search_improves_within_capacity(communes, factor):
+    nodes, _, _, mat_dist_km, mat_time_min = communes
+    time_chu, dist_chu = nodes['time_CHU'].values, nodes['dist_CHU'].values
+    routes = solve_covoiturage(nodes, mat_dist_km, mat_time_min, factor)
+    improved, report = improve_routes(routes, mat_time_min, time_chu, mat_dist_km, dist_chu, time_budget=30)
+
+    assert report['converged']
+    assert sum(report['moves'].values()) > 0
+    assert report['time_after'] <= report['time_before']
+    assert report['time_after'] == pytest.approx(_driving_time(improved, mat_time_min, time_chu))
+    assert report['time_before'] == pytest.approx(_driving_time(routes, mat_time_min, time_chu))
+    # Mêmes voitures, chaque commune une seule fois, au plus MAX_STOPS passagers
+    assert len(improved) == len(routes)
+    assert sorted(n for r in improved for n in r['stops']) == list(range(len(nodes)))
+    assert all(len(r['stops']) <= 4 and r['load'] == len(r['stops']) - 1 for r in improved)
+
+
+def test_local_search_weighted_capacity_and_sites(communes):
+    nodes, coords, sites_m, mat_dist_km, mat_time_min = communes
+    dist_sites = (np.linalg.norm(coords[None, :, :] - sites_m[:, None, :], axis=2) / 1000) * TORTUOSITY
+    site, time_chu, dist_chu = assign_sites(dist_sites * minutes_per_km(AVG_SPEED_KMH), dist_sites)
+    workers = np.random.default_rng(2).geometric(0.5, size=len(nodes))
+    weighted = nodes.assign(site=site, time_CHU=time_chu, dist_CHU=dist_chu, workers=workers)
+    routes = solve_covoiturage(weighted, mat_dist_km, mat_time_min, 3.0)
+    improved, report = improve_routes(routes, mat_time_min, time_chu, max_stops=3, time_budget=30, site=site,
+                                      workers=workers)
+
+    assert report['time_after'] <= report['time_before']
+    _, init_load, has_rest = pool_within_communes(workers)
+    people = np.where(has_rest, init_load + 1, 0)
+    for r in improved:
+        assert people[r['stops']].sum() <= 4
+        assert len(set(site[r['stops']])) == 1
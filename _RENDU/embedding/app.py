@@ -1,16 +1,14 @@
 import sys
 import os
-import pandas as pd
+import time
 import logging
 import argparse
 
 # Ajouter le répertoire courant au chemin pour permettre l'importation depuis src
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 
-from src.utils import setup_logger, load_data, save_results
-from src.preprocess import TextPreprocessor
-from src.inference import EmbeddingModel
-from src.matching import Matcher
+# Imports lourds (pandas, torch, transformers, faiss, sklearn) faits à la demande, dans l'étape qui
+# les utilise : `--help` et `-p` restent rapides (mesure : `python benchmark.py import-time`).
 
 def main():
     # Parsing des arguments
@@ -20,10 +18,37 @@ def main():
     parser.add_argument("-m", "--model", type=str, default="sentence-transformers/all-mpnet-base-v2", help="Nom du modèle HuggingFace à utiliser (défaut: sentence-transformers/all-mpnet-base-v2)")
     parser.add_argument("--llm-refine", action="store_true", help="Activer le raffinement du texte par LLM")
     parser.add_argument("--llm-model", type=str, default="Qwen/Qwen2.5-3B-Instruct", help="Nom du modèle LLM pour le raffinement (défaut: Qwen/Qwen2.5-0.5B-Instruct)")
+    parser.add_argument("--llm-backend", type=str, default="transformers", choices=["transformers", "onnx", "server"], help="Backend d'inférence LLM : transformers (dans le processus), onnx (ONNX Runtime CPU, --llm-model = dossier exporté) ou server (serveur local compatible OpenAI)")
+    parser.add_argument("--llm-server-url", type=str, default="http://127.0.0.1:8080", help="URL du serveur LLM local pour --llm-backend server (défaut: http://127.0.0.1:8080)")
+    parser.add_argument("--llm-job", action="store_true", help="Raffinement LLM en mode job : progression journalisée par lot, reprise exacte après interruption, débit et ETA")
+    parser.add_argument("--llm-gate", type=float, default=None, help="Avec --llm-refine : seuil de confiance (similarité TF-IDF au libellé ADEME le plus proche, 0-1) au-dessus duquel un texte ne passe pas par le LLM (défaut: tous les textes)")
     parser.add_argument("--batch-size", type=int, default=32, help="Taille du batch pour le LLM (défaut: 32). Augmenter pour plus de vitesse si GPU le permet.")
+    parser.add_argument("--pooling", type=str, default="cls", choices=["cls", "mean"], help="Pooling des embeddings : token CLS ou moyenne des tokens (défaut: cls)")
+    parser.add_argument("--fp16", action="store_true", help="Stocker les embeddings normalisés en float16, index FAISS compris (divise la mémoire par deux)")
+    parser.add_argument("--workers", type=int, default=1, help="Nombre de processus pour les embeddings (>1 : mode multi-processus avec reprise, défaut: 1)")
+    parser.add_argument("--threads-per-worker", type=int, default=1, help="Threads PyTorch intra-op par processus en mode multi-processus (défaut: 1)")
     parser.add_argument("--alpha", type=float, default=0.5, help="Poids de la recherche dense vs BM25 (0.5 = équilibré, 1.0 = Dense uniquement, 0.0 = BM25 uniquement)")
+    parser.add_argument("--alpha-sweep", type=float, nargs="+", default=None, help="Evaluer aussi ces valeurs d'alpha et la fusion RRF sur les candidats en cache (top-1 de chaque fusion dans ALPHA_SWEEP.csv)")
+    parser.add_argument("--sweep-top-n", type=int, default=50, help="Candidats gardés par requête pour --alpha-sweep : top-N dense, BM25 et de la fusion principale (défaut: 50)")
+    parser.add_argument("--rrf-k", type=float, default=60, help="Constante k de la fusion RRF, 1 / (k + rang) (défaut: 60)")
+    parser.add_argument("--rerank", action="store_true", help="Re-classer les top-k candidats de chaque achat avec un cross-encoder (CPU, cache par paire de textes)")
+    parser.add_argument("--rerank-model", type=str, default="cross-encoder/mmarco-mMiniLMv2-L12-H384-v1", help="Cross-encoder HuggingFace pour --rerank")
+    parser.add_argument("--rerank-k", type=int, default=10, help="Nombre de candidats re-classés par achat (défaut: 10)")
+    parser.add_argument("--rerank-max-pairs", type=int, default=None, help="Budget : paires (achat, candidat) calculées au plus par exécution (défaut: illimité)")
+    parser.add_argument("--rerank-time-budget", type=float, default=None, help="Budget : durée maximale du re-classement en secondes (défaut: illimitée)")
+    parser.add_argument("--ratio-threshold", type=float, default=None, help="Seuil de score sous lequel un achat est rattaché au ratio monétaire de son compte (COMPTE.LIB) au lieu du facteur ADEME (défaut: désactivé)")
+    parser.add_argument("--spend-col", type=str, default=None, help="Colonne des montants (euros) du fichier source, pour les émissions des achats au ratio monétaire (--carbon)")
+    parser.add_argument("--carbon", action="store_true", help="Agréger l'empreinte carbone (quantité x FE.VAL) par compte et par catégorie, avec incertitude Monte Carlo")
+    parser.add_argument("--quantity-col", type=str, default="QTE.Total", help="Colonne des quantités achetées dans le fichier source (défaut: QTE.Total)")
+    parser.add_argument("--quantity-units", type=str, nargs="+", default=["unite", "piece"], help="Unités (dénominateur de FE.UNITE, ex. kgCO2e/unité) compatibles avec --quantity-col ; les facteurs dans une autre unité sont exclus de l'agrégation (défaut: unite piece)")
+    parser.add_argument("--mc-samples", type=int, default=10000, help="Nombre de tirages Monte Carlo pour l'incertitude (défaut: 10000)")
+    parser.add_argument("--mc-independent", action="store_true", help="Erreurs indépendantes par ligne d'achat (par défaut : une erreur par facteur, partagée par ses lignes)")
     args = parser.parse_args()
 
+    import pandas as pd
+    from src.utils import setup_logger, save_results
+    from src.preprocess import TextPreprocessor
+
     logger = setup_logger()
     logger.info("Début du traitement (embedding)")
     
@@ -39,11 +64,19 @@ def main():
         PROCESSED_TARGET = "../DATA/PROCESSED/target_processed.csv"
     
     OUTPUT_FILE = "../DATA/PROCESSED/MATCHES.xlsx"
+    SWEEP_FILE = "../DATA/PROCESSED/ALPHA_SWEEP.csv"
+    RERANK_CACHE = "../DATA/PROCESSED/rerank_cache.json" # Scores du cross-encoder par paire de textes
+    EMISSIONS_FILE = "../DATA/PROCESSED/EMISSIONS_{}.csv" # Un fichier par regroupement (compte, catégorie, total)
+    RATIO_FILE = "../DATA/RAW/RATIO MONETAIRE.xlsx"
+    RATIO_INDEX = "../DATA/PROCESSED/ratio_index.csv" # Index COMPTE.LIB -> ratio, modifiable à la main
+    # Embeddings mappés en mémoire (mode multi-processus, reprise possible après un crash)
+    SOURCE_EMBEDDINGS = PROCESSED_SOURCE.replace(".csv", "_embeddings.npy")
+    TARGET_EMBEDDINGS = PROCESSED_TARGET.replace(".csv", "_embeddings.npy")
     
     COLUMNS_SOURCE = ["DB.LIB", "COMPTE.LIB"]
     COLUMNS_TARGET = ["FE.LIB2", "FE.LIB3"]
-    SOURCE_KEEP = ["PRODUIT.ID"]
-    TARGET_KEEP = ["FE.ADEME.ID", "FE.VAL", "FE.Incertitude"] # Colonnes à garder dans le fichier preprocessed
+    SOURCE_KEEP = ["PRODUIT.ID", "COMPTE.LIB"]
+    TARGET_KEEP = ["FE.ADEME.ID", "FE.VAL", "FE.Incertitude", "FE.CAT1"] # Colonnes à garder dans le fichier preprocessed
     
     preprocessor = TextPreprocessor()
     
@@ -70,11 +103,14 @@ def main():
         logger.info("Lancement du prétraitement...")
         if os.path.exists(SOURCE_FILE) and os.path.exists(TARGET_FILE):
              try:
-                # Appel avec arguments LLM
-                # Appel avec arguments LLM pour la SOURCE uniquement
-                preprocessor.process_and_save(SOURCE_FILE, PROCESSED_SOURCE, COLUMNS_SOURCE, SOURCE_KEEP, use_llm=args.llm_refine, llm_model_name=args.llm_model, batch_size=args.batch_size)
-                # JAMAIS de LLM pour la TARGET (Ademe = référence)
+                # JAMAIS de LLM pour la TARGET (Ademe = référence). Traitée en premier : ses libellés nettoyés
+                # servent au filtre de confiance du LLM (--llm-gate)
                 preprocessor.process_and_save(TARGET_FILE, PROCESSED_TARGET, COLUMNS_TARGET, TARGET_KEEP, use_llm=False, llm_model_name=None, batch_size=args.batch_size)
+                gate_texts = None
+                if args.llm_refine and args.llm_gate is not None:
+                    gate_texts = pd.read_csv(PROCESSED_TARGET, usecols=["text"])["text"].fillna("").astype(str).tolist()
+                # Appel avec arguments LLM pour la SOURCE uniquement
+                preprocessor.process_and_save(SOURCE_FILE, PROCESSED_SOURCE, COLUMNS_SOURCE, SOURCE_KEEP, use_llm=args.llm_refine, llm_model_name=args.llm_model, batch_size=args.batch_size, llm_job=args.llm_job, llm_backend=args.llm_backend, llm_server_url=args.llm_server_url, llm_gate=args.llm_gate, gate_texts=gate_texts)
                 logger.info("Prétraitement terminé avec succès.")
              except Exception as e:
                 logger.error(f"Erreur durant le prétraitement : {e}")
@@ -92,6 +128,10 @@ def main():
 
     # 2. Étape d'Embedding et Matching
     try:
+        import numpy as np
+        from src.inference import EmbeddingModel, get_embeddings_sharded
+        from src.matching import Matcher
+
         # Chargement des données traitées
         logger.info("Chargement des données prétraitées...")
         if not (os.path.exists(PROCESSED_SOURCE) and os.path.exists(PROCESSED_TARGET)):
@@ -113,17 +153,66 @@ def main():
         
         # Génération des embeddings
         logger.info(f"Génération des embeddings avec le modèle : {args.model}...")
-        model = EmbeddingModel(model_name=args.model)
-        source_embeddings = model.get_embeddings(source_texts)
-        target_embeddings = model.get_embeddings(target_texts)
+        # Embeddings normalisés L2 à la volée : le Matcher les utilise sans copie ni renormalisation
+        embedding_dtype = "float16" if args.fp16 else "float32"
+        if args.workers > 1:
+            sharded_args = dict(model_name=args.model, pooling=args.pooling, num_workers=args.workers,
+                                threads_per_worker=args.threads_per_worker, normalize=True, dtype=embedding_dtype)
+            source_embeddings = get_embeddings_sharded(source_texts, SOURCE_EMBEDDINGS, **sharded_args)
+            target_embeddings = get_embeddings_sharded(target_texts, TARGET_EMBEDDINGS, **sharded_args)
+        else:
+            model = EmbeddingModel(model_name=args.model, pooling=args.pooling)
+            source_embeddings = model.get_embeddings(source_texts, normalize=True, dtype=embedding_dtype)
+            target_embeddings = model.get_embeddings(target_texts, normalize=True, dtype=embedding_dtype)
         
         # Matching
         logger.info(f"Matching hybride (Alpha={args.alpha})...")
-        matcher = Matcher(use_faiss=True, alpha=args.alpha)
+        matcher = Matcher(use_faiss=True, alpha=args.alpha, top_n_cache=args.sweep_top_n if args.alpha_sweep else 0)
         # On passe les textes cibles pour l'indexation BM25
-        matcher.fit(target_embeddings, target_texts=target_texts)
+        matcher.fit(target_embeddings, target_texts=target_texts, normalized=True)
         # On passe les textes sources pour le scoring BM25
-        distances, indices = matcher.match(source_embeddings, source_texts=source_texts, k=1)
+        distances, indices = matcher.match(source_embeddings, source_texts=source_texts, k=args.rerank_k if args.rerank else 1)
+
+        # Sweep : autres fusions évaluées sur les candidats en cache, sans recalculer les scores
+        if args.alpha_sweep and matcher.candidates is not None:
+            sweep_start = time.time()
+            sweep = matcher.sweep(args.alpha_sweep, k=1, rrf_k=args.rrf_k)
+            logger.info(f"Sweep de {len(sweep)} fusions en {time.time() - sweep_start:.2f}s")
+            target_ids = df_target_proc["FE.ADEME.ID"].to_numpy()
+            df_sweep = pd.DataFrame({"id_source": df_source_proc["PRODUIT.ID"].to_numpy(), "id_target": target_ids[indices[:, 0]]})
+            for name, (sweep_scores, sweep_indices) in sweep.items():
+                # Accord du top-1 avec la fusion principale (alpha = --alpha)
+                agreement = (sweep_indices[:, 0] == indices[:, 0]).mean()
+                logger.info(f"  {name} : accord top-1 avec alpha={args.alpha:g} = {agreement:.1%}")
+                df_sweep[name] = target_ids[sweep_indices[:, 0]]
+                df_sweep[f"score {name}"] = sweep_scores[:, 0]
+            df_sweep.to_csv(SWEEP_FILE, index=False)
+            logger.info(f"Résultats du sweep enregistrés dans {SWEEP_FILE}")
+        elif args.alpha_sweep:
+            logger.warning("Sweep indisponible : pas de candidats en cache (scores complets non calculés).")
+
+        # Re-classement des top-k par cross-encoder (budgété) ; le score hybride du candidat retenu est conservé
+        rerank_scores = np.full(len(distances), np.nan)
+        if args.rerank:
+            from src.rerank import CrossEncoderReranker
+            reranker = CrossEncoderReranker(model_name=args.rerank_model, cache_file=RERANK_CACHE)
+            distances, indices, ce_scores, _ = reranker.rerank(source_texts, target_texts, distances, indices,
+                                                               max_pairs=args.rerank_max_pairs, time_budget=args.rerank_time_budget,
+                                                               batch_size=args.batch_size)
+            rerank_scores = ce_scores[:, 0]
+        
+        # Palier de repli : sous le seuil, ratio monétaire du compte de l'achat (recherche dans un index prébâti)
+        ratio_rows = np.full(len(distances), -1, dtype=np.int64)
+        low_confidence = np.zeros(len(distances), dtype=bool)
+        if args.ratio_threshold is not None:
+            from src.ratio import MonetaryRatioIndex
+            accounts = df_source_proc["COMPTE.LIB"].fillna("").astype(str)
+            ratio_index = MonetaryRatioIndex.build(RATIO_FILE, accounts.unique(), index_file=RATIO_INDEX)
+            low_confidence = distances[:, 0] < args.ratio_threshold
+            ratio_rows[low_confidence] = ratio_index.lookup(accounts[low_confidence])
+        match_types = np.where(ratio_rows >= 0, "ratio_monetaire", np.where(low_confidence, "ademe_faible_confiance", "ademe"))
+        paths, counts = np.unique(match_types, return_counts=True)
+        logger.info("Chemins de résolution : " + ", ".join(f"{p} = {c}" for p, c in zip(paths, counts)))
         
         results = []
         for i, (dist, idx) in enumerate(zip(distances, indices)):
@@ -133,13 +222,20 @@ def main():
             # construction du fichier sortie :
             # id source, text source, id target, text target, score
             # trié par score décroissant
+            if ratio_rows[i] >= 0:
+                ratio = ratio_index.ratios.iloc[ratio_rows[i]]
+                id_target, text_target = ratio["FE.RM.ID"], ratio["FE.LIB2"]
+            else:
+                id_target, text_target = df_target_proc.iloc[match_idx]["FE.ADEME.ID"], target_texts[match_idx]
             results.append({
                 "id_source": df_source_proc.iloc[i]["PRODUIT.ID"],
                 "text_source_raw": source_texts_raw[i],
                 "text_source_refined": source_texts[i],
-                "id_target": df_target_proc.iloc[match_idx]["FE.ADEME.ID"],
-                "text_target": target_texts[match_idx],
-                "score": similarity_score
+                "id_target": id_target,
+                "text_target": text_target,
+                "score": similarity_score,
+                "score_rerank": rerank_scores[i],
+                "match_type": match_types[i]
             })
             
         results.sort(key=lambda x: x['score'], reverse=True)
@@ -150,6 +246,71 @@ def main():
         # Sauvegarde
         save_results(df_results, OUTPUT_FILE)
         logger.info("Fichier de résultats enregistré.")
+
+        # 3. Agrégation de l'empreinte carbone
+        if args.carbon:
+            from src.utils import load_data
+            from src.carbon import aggregate_emissions
+
+            logger.info(f"Agrégation carbone ({args.mc_samples} tirages Monte Carlo)...")
+            purchases = load_data(SOURCE_FILE)
+            # Clé de jointure achat -> correspondance : le texte nettoyé (text_raw). Le prétraitement de la source
+            # garde une ligne par text_raw distinct (même si le LLM ramène deux textes au même texte raffiné)
+            valid_cols = [c for c in COLUMNS_SOURCE if c in purchases.columns]
+            purchase_texts = preprocessor.preprocess_batch(purchases[valid_cols].fillna('').astype(str).agg(' '.join, axis=1).tolist())
+            source_pos = pd.Series(np.arange(len(source_texts_raw)), index=source_texts_raw)
+            source_pos = source_pos[~source_pos.index.duplicated()]
+            source_row = source_pos.reindex(purchase_texts).fillna(-1).astype(np.int64).to_numpy()
+            target_idx = np.where(source_row >= 0, indices[np.maximum(source_row, 0), 0], -1)
+            if (source_row < 0).any():
+                logger.warning(f"{(source_row < 0).sum()} achats sans ligne prétraitée correspondante (prétraitement à relancer avec -f ?) : exclus de l'agrégation.")
+
+            # Emission = quantité x FE.VAL : valable seulement pour les facteurs exprimés par unité achetée
+            # (FE.UNITE de la forme kgCO2e/<unité>, <unité> dans --quantity-units). Les autres sont exclus.
+            raw_target = load_data(TARGET_FILE)
+            if "FE.UNITE" in raw_target.columns:
+                units = raw_target.drop_duplicates(subset="FE.ADEME.ID").set_index("FE.ADEME.ID")["FE.UNITE"]
+                units = units.reindex(df_target_proc["FE.ADEME.ID"]).fillna("").astype(str)
+                per_unit = np.array([preprocessor.clean_text(u.split("/")[-1]) for u in units])
+                unit_ok = np.isin(per_unit, [preprocessor.clean_text(u) for u in args.quantity_units])
+                wrong_unit = (target_idx >= 0) & ~unit_ok[np.maximum(target_idx, 0)]
+                if wrong_unit.any():
+                    top_units = pd.Series(units.to_numpy()[target_idx[wrong_unit]]).value_counts().head(5)
+                    logger.warning(f"{wrong_unit.sum()} achats dont le facteur n'est pas exprimé par unité achetée, exclus de l'agrégation "
+                                   f"(unités : {', '.join(f'{u} = {n}' for u, n in top_units.items())})")
+                    target_idx[wrong_unit] = -1
+            else:
+                logger.warning("Colonne FE.UNITE absente : unités des facteurs non vérifiées (total valable seulement pour des facteurs par unité achetée).")
+
+            # Facteurs ADEME puis ratios monétaires à la suite : un achat au ratio pointe après les facteurs
+            factors = df_target_proc[["FE.VAL", "FE.Incertitude", "FE.CAT1"]]
+            # Copie : les achats au ratio y prennent leur montant (vue en lecture seule si la colonne est déjà float)
+            quantities = pd.to_numeric(purchases[args.quantity_col], errors="coerce").to_numpy(dtype=np.float64, copy=True)
+            if args.ratio_threshold is not None:
+                purchase_ratio = np.where(source_row >= 0, ratio_rows[np.maximum(source_row, 0)], -1)
+                on_ratio = purchase_ratio >= 0
+                factors = pd.concat([factors, ratio_index.ratios[["FE.VAL", "FE.Incertitude", "FE.CAT1"]]], ignore_index=True)
+                target_idx = np.where(on_ratio, len(df_target_proc) + purchase_ratio, target_idx)
+                # Ratio en kgCO2e / k€ : il faut le montant de l'achat
+                if args.spend_col and args.spend_col in purchases.columns:
+                    quantities[on_ratio] = pd.to_numeric(purchases[args.spend_col], errors="coerce").to_numpy(dtype=np.float64)[on_ratio] / 1000
+                else:
+                    logger.warning(f"{on_ratio.sum()} achats au ratio monétaire sans montant (--spend-col) : exclus de l'agrégation.")
+                    target_idx[on_ratio] = -1
+            purchases["_quantite"] = quantities
+
+            # Catégorie du facteur retenu (FE.CAT1), par indexation
+            purchases["FE.CAT1"] = factors["FE.CAT1"].to_numpy()[np.maximum(target_idx, 0)]
+            emissions = aggregate_emissions(
+                purchases, target_idx, factors["FE.VAL"].to_numpy(), factors["FE.Incertitude"].to_numpy(),
+                by=["COMPTE.LIB", "FE.CAT1"], quantity_col="_quantite", n_samples=args.mc_samples,
+                correlated=not args.mc_independent,
+            )
+            for col, df_emissions in emissions.items():
+                save_results(df_emissions, EMISSIONS_FILE.format(col.replace(".", "_")))
+            total = emissions["TOTAL"].iloc[0]
+            logger.info(f"Empreinte totale : {total['emissions_kgCO2e'] / 1000:.1f} tCO2e "
+                        f"(IC 95 % : {total['ic95_bas'] / 1000:.1f} - {total['ic95_haut'] / 1000:.1f} tCO2e)")
         
     except Exception as e:
         logger.error(f"Erreur lors du traitement: {e}")
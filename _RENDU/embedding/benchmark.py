@@ -0,0 +1,352 @@
+import sys
+import os
+import time
+import json
+import argparse
+import subprocess
+import datetime
+
+# Ajouter le répertoire courant au chemin pour permettre l'importation depuis src
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+SAMPLE_SOURCE = "../DATA/PROCESSED/source_processed.csv"
+SAMPLE_TARGET = "../DATA/PROCESSED/target_processed.csv"
+
+
+def load_sample_texts(n: int) -> list[str]:
+    """
+    Échantillon de textes source prétraités (ou textes synthétiques si le fichier est absent).
+    """
+    if os.path.exists(SAMPLE_SOURCE):
+        import pandas as pd
+        texts = pd.read_csv(SAMPLE_SOURCE, usecols=["text"])["text"].fillna("").astype(str).tolist()
+        return texts[:n]
+    return [f"gants nitrile taille m boite de unite ref {i} consommables medicaux" for i in range(n)]
+
+
+# --- Benchmarks ---
+
+def bench_llm_backends(args):
+    """
+    Compare le temps de démarrage (chargement du backend) et le débit de raffinement des backends LLM.
+    """
+    from src.llm_utils import LLMRefiner
+
+    texts = load_sample_texts(args.n)
+    stub = None
+    server_url = args.server_url
+    if args.stub_server:
+        # Serveur factice partagé avec les tests (tests/stub_llm_server.py)
+        from tests.stub_llm_server import start_stub_server
+        stub, server_url = start_stub_server()
+
+    rows = []
+    for backend in args.backends:
+        model_name = args.onnx_path if backend == "onnx" else args.model
+        # Cache temporaire vide : on mesure le modèle, pas le cache
+        cache_file = f"benchmark_llm_cache_{backend}.json"
+        if os.path.exists(cache_file):
+            os.remove(cache_file)
+
+        start = time.perf_counter()
+        refiner = LLMRefiner(model_name=model_name, cache_file=cache_file, backend=backend, server_url=server_url)
+        startup_s = time.perf_counter() - start
+
+        start = time.perf_counter()
+        refiner.refine_batch(texts, batch_size=args.batch_size)
+        run_s = time.perf_counter() - start
+        os.remove(cache_file)
+
+        rows.append((backend, startup_s, run_s, len(texts) / run_s if run_s > 0 else float("inf")))
+
+    if stub is not None:
+        stub.shutdown()
+
+    print(f"\n{'backend':<14}{'démarrage (s)':>16}{'raffinement (s)':>18}{'textes/s':>12}")
+    for backend, startup_s, run_s, throughput in rows:
+        print(f"{backend:<14}{startup_s:>16.2f}{run_s:>18.2f}{throughput:>12.1f}")
+
+
+# Scénarios mesurés avec `python -X importtime` (lancés depuis le dossier de app.py)
+IMPORT_SCENARIOS = {
+    "help": ["app.py", "--help"],
+    "preprocess": ["-c", "import app, src.utils, src.preprocess"],
+    "matching": ["-c", "import src.inference, src.matching"],
+}
+
+
+def parse_importtime(stderr: str) -> list[tuple[str, int, int]]:
+    """
+    Analyse la sortie de `-X importtime` : liste (module, self_us, cumulé_us) des imports de premier niveau.
+    """
+    top_level = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|", 2)
+        # Les imports imbriqués sont indentés sous leur parent
+        if name.startswith("  "):
+            continue
+        top_level.append((name.strip(), int(self_us), int(cumulative_us)))
+    return top_level
+
+
+def bench_import_time(args):
+    """
+    Temps d'import par scénario (`--help`, prétraitement seul, matching), avec historique optionnel
+    pour suivre les régressions de démarrage de la CLI.
+    """
+    here = os.path.dirname(os.path.abspath(__file__))
+    records = []
+    for scenario in args.scenarios:
+        start = time.perf_counter()
+        proc = subprocess.run([sys.executable, "-X", "importtime", *IMPORT_SCENARIOS[scenario]],
+                              cwd=here, capture_output=True, text=True)
+        wall_ms = (time.perf_counter() - start) * 1000
+        modules = parse_importtime(proc.stderr)
+        import_ms = sum(m[2] for m in modules) / 1000
+        slowest = sorted(modules, key=lambda m: m[2], reverse=True)[:args.top]
+
+        print(f"\n[{scenario}] imports: {import_ms:.0f} ms, processus: {wall_ms:.0f} ms (code retour {proc.returncode})")
+        for name, _, cumulative_us in slowest:
+            print(f"    {cumulative_us / 1000:>8.1f} ms  {name}")
+
+        records.append({
+            "date": datetime.datetime.now().isoformat(timespec="seconds"),
+            "scenario": scenario,
+            "import_ms": round(import_ms, 1),
+            "wall_ms": round(wall_ms, 1),
+            "slowest": [[name, round(cumulative_us / 1000, 1)] for name, _, cumulative_us in slowest],
+        })
+
+    if args.history:
+        with open(args.history, "a", encoding="utf-8") as f:
+            for record in records:
+                f.write(json.dumps(record) + "\n")
+        print(f"\nRésultats ajoutés à {args.history}")
+
+    if args.max_ms is not None:
+        too_slow = [r["scenario"] for r in records if r["import_ms"] > args.max_ms]
+        if too_slow:
+            print(f"Temps d'import au-dessus de {args.max_ms} ms : {', '.join(too_slow)}")
+            sys.exit(1)
+
+
+def bench_carbon(args):
+    """
+    Agrégation carbone sur des achats synthétiques : temps et pic mémoire du Monte Carlo (erreurs par facteur
+    ou par ligne) pour vérifier que la mémoire reste bornée par la taille des blocs.
+    """
+    import tracemalloc
+    import numpy as np
+    import pandas as pd
+    from src.carbon import aggregate_emissions
+
+    rng = np.random.default_rng(0)
+    purchases = pd.DataFrame({
+        "COMPTE.LIB": rng.integers(0, args.accounts, args.rows).astype(str),
+        "QTE.Total": rng.integers(1, 100, args.rows),
+    })
+    target_idx = rng.integers(0, args.factors, args.rows)
+    fe_val = rng.lognormal(3, 1.5, args.factors)
+    fe_unc = rng.choice([0.1, 0.3, 0.5, 0.8], args.factors)
+
+    print(f"\n{args.rows} lignes, {args.factors} facteurs, {args.samples} tirages")
+    print(f"{'erreurs':<12}{'durée (s)':>12}{'pic mémoire (Mo)':>20}{'total (tCO2e)':>16}{'IC 95 %':>24}")
+    for correlated in (True, False):
+        tracemalloc.start()
+        start = time.perf_counter()
+        result = aggregate_emissions(purchases, target_idx, fe_val, fe_unc, by=["COMPTE.LIB"], quantity_col="QTE.Total",
+                                     n_samples=args.samples, correlated=correlated, max_chunk_bytes=args.chunk_mb * 2**20)
+        elapsed = time.perf_counter() - start
+        peak_mb = tracemalloc.get_traced_memory()[1] / 1e6
+        tracemalloc.stop()
+        total = result["TOTAL"].iloc[0]
+        ci = f"{total['ic95_bas'] / 1000:.0f} - {total['ic95_haut'] / 1000:.0f}"
+        print(f"{'facteur' if correlated else 'ligne':<12}{elapsed:>12.2f}{peak_mb:>20.0f}{total['emissions_kgCO2e'] / 1000:>16.0f}{ci:>24}")
+
+
+EVAL_CONFIGS = ("dense", "bm25", "hybrid", "fp16", "ann", "int8")
+
+
+def bench_evaluate(args):
+    """
+    Qualité du matching sur un échantillon annoté (PRODUIT.ID -> FE.ADEME.ID) : recall@k, MRR, accord des top-1
+    avec la configuration hybride, latence et mémoire (construction de l'index + recherche) de chaque configuration.
+    """
+    import numpy as np
+    import pandas as pd
+    from src.inference import EmbeddingModel
+    from src.matching import Matcher
+    from src.evaluation import load_labels, evaluate
+
+    df_source = pd.read_csv(args.source)
+    df_target = pd.read_csv(args.target)
+    source_rows, truth = load_labels(args.labels, df_source["PRODUIT.ID"], df_target["FE.ADEME.ID"])
+    source_texts = df_source["text"].fillna("").astype(str).to_numpy()[source_rows].tolist()
+    target_texts = df_target["text"].fillna("").astype(str).tolist()
+    print(f"\n{len(truth)} paires annotées, {len(target_texts)} facteurs cibles")
+
+    def encode(quantize):
+        model = EmbeddingModel(model_name=args.model, pooling=args.pooling, quantize=quantize)
+        return (model.get_embeddings(source_texts, batch_size=args.batch_size, normalize=True),
+                model.get_embeddings(target_texts, batch_size=args.batch_size, normalize=True))
+
+    start = time.perf_counter()
+    source_emb, target_emb = encode(False)
+    encode_s = time.perf_counter() - start
+    print(f"Encodage float32 : {encode_s:.1f}s")
+
+    def run_matcher(alpha, source, target, texts=True):
+        matcher = Matcher(use_faiss=True, alpha=alpha)
+        matcher.fit(target, target_texts=target_texts if texts else None, normalized=True)
+        return matcher.match(source, source_texts=source_texts if texts else None, k=args.k)
+
+    def run_ann():
+        import faiss
+        # Index approché HNSW (produit scalaire = cosinus sur vecteurs normalisés), dense uniquement
+        index = faiss.IndexHNSWFlat(target_emb.shape[1], args.hnsw_m, faiss.METRIC_INNER_PRODUCT)
+        index.hnsw.efSearch = args.ef_search
+        index.add(target_emb)
+        return index.search(source_emb, args.k)
+
+    configs = {
+        "dense": lambda: run_matcher(1.0, source_emb, target_emb, texts=False),
+        "bm25": lambda: run_matcher(0.0, source_emb, target_emb),
+        "hybrid": lambda: run_matcher(args.alpha, source_emb, target_emb),
+        "fp16": lambda: run_matcher(args.alpha, source_emb.astype(np.float16), target_emb.astype(np.float16)),
+        "ann": run_ann,
+    }
+    if "int8" in args.configs:
+        start = time.perf_counter()
+        source_q, target_q = encode(True)
+        encode_q_s = time.perf_counter() - start
+        print(f"Encodage int8 : {encode_q_s:.1f}s ({encode_s / encode_q_s:.2f}x)")
+        configs["int8"] = lambda: run_matcher(args.alpha, source_q, target_q)
+    configs = {name: configs[name] for name in args.configs}
+
+    report, agreement = evaluate(configs, truth, k=args.k, reference="hybrid")
+    pd.set_option("display.width", 200)
+    print("\n" + report.to_string(float_format=lambda x: f"{x:.3f}"))
+    print("\nAccord des top-1 entre configurations :")
+    print(agreement.to_string(float_format=lambda x: f"{x:.3f}"))
+    if args.output:
+        report.to_csv(args.output)
+        print(f"\nRésultats enregistrés dans {args.output}")
+
+
+def bench_service(args):
+    """
+    Service de matching sur localhost : clients HTTP concurrents, latence p50 / p99 vue du client et du
+    service, débit et taille moyenne des micro-lots pour chaque attente maximale.
+    """
+    import urllib.request
+    from concurrent.futures import ThreadPoolExecutor
+    import numpy as np
+    import pandas as pd
+    from src.inference import EmbeddingModel
+    from src.matching import Matcher
+    from src.service import MatchingService, start_server
+
+    df_target = pd.read_csv(SAMPLE_TARGET) if os.path.exists(SAMPLE_TARGET) else None
+    if df_target is not None:
+        target_ids = df_target["FE.ADEME.ID"].tolist()
+        target_texts = df_target["text"].fillna("").astype(str).tolist()
+    else:
+        target_ids = list(range(2000))
+        target_texts = [f"facteur synthetique categorie {i % 50} produit {i}" for i in range(2000)]
+    queries = load_sample_texts(args.requests)
+
+    model = EmbeddingModel(model_name=args.model, pooling=args.pooling)
+    matcher = Matcher(use_faiss=True, alpha=0.5)
+    matcher.fit(model.get_embeddings(target_texts, normalize=True), target_texts=target_texts, normalized=True,
+                target_ids=target_ids)
+
+    print(f"\n{len(queries)} requêtes (1 texte), {args.concurrency} clients, {len(target_texts)} cibles")
+    print(f"{'attente max (ms)':<18}{'débit (req/s)':>15}{'p50 client':>12}{'p99 client':>12}{'p50 service':>13}{'p99 service':>13}{'lot moyen':>11}")
+    for max_wait_ms in args.max_wait_ms:
+        service = MatchingService(model, matcher, max_batch=args.max_batch, max_wait_ms=max_wait_ms)
+        server = start_server(service, port=0)
+        url = f"http://127.0.0.1:{server.server_address[1]}/match"
+
+        def call(text):
+            request = urllib.request.Request(url, data=json.dumps({"texts": [text], "k": args.k}).encode("utf-8"),
+                                             headers={"Content-Type": "application/json"})
+            start = time.perf_counter()
+            with urllib.request.urlopen(request, timeout=60) as response:
+                json.load(response)
+            return time.perf_counter() - start
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+            latencies = np.array(list(pool.map(call, queries))) * 1000
+        elapsed = time.perf_counter() - start
+        metrics = service.metrics()
+        server.shutdown()
+        service.stop()
+
+        p50, p99 = np.percentile(latencies, [50, 99])
+        print(f"{max_wait_ms:<18g}{len(queries) / elapsed:>15.1f}{p50:>12.1f}{p99:>12.1f}"
+              f"{metrics['latency_p50_ms']:>13.1f}{metrics['latency_p99_ms']:>13.1f}{metrics['mean_batch_size']:>11.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks du pipeline de matching")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    p_llm = subparsers.add_parser("llm-backends", help="Démarrage et débit des backends LLM")
+    p_llm.add_argument("--backends", nargs="+", default=["transformers", "server"], choices=["transformers", "onnx", "server"])
+    p_llm.add_argument("--model", type=str, default="Qwen/Qwen2.5-0.5B-Instruct", help="Modèle HuggingFace (backends transformers/server)")
+    p_llm.add_argument("--onnx-path", type=str, default="onnx/qwen2.5-0.5b", help="Dossier du modèle exporté en ONNX")
+    p_llm.add_argument("--server-url", type=str, default="http://127.0.0.1:8080", help="Serveur local compatible OpenAI")
+    p_llm.add_argument("--stub-server", action="store_true", help="Utiliser un serveur factice local (mesure du surcoût HTTP seul)")
+    p_llm.add_argument("-n", type=int, default=64, help="Nombre de textes (défaut: 64)")
+    p_llm.add_argument("--batch-size", type=int, default=8)
+    p_llm.set_defaults(func=bench_llm_backends)
+
+    p_imp = subparsers.add_parser("import-time", help="Temps d'import de la CLI (python -X importtime)")
+    p_imp.add_argument("--scenarios", nargs="+", default=["help", "preprocess"], choices=list(IMPORT_SCENARIOS))
+    p_imp.add_argument("--top", type=int, default=5, help="Nombre de modules les plus lents affichés")
+    p_imp.add_argument("--history", type=str, default=None, help="Fichier JSONL où ajouter les mesures (suivi dans le temps)")
+    p_imp.add_argument("--max-ms", type=float, default=None, help="Seuil : code retour 1 si un scénario le dépasse")
+    p_imp.set_defaults(func=bench_import_time)
+
+    p_carbon = subparsers.add_parser("carbon", help="Agrégation carbone et Monte Carlo sur des achats synthétiques")
+    p_carbon.add_argument("--rows", type=int, default=100_000, help="Nombre de lignes d'achat (défaut: 100000)")
+    p_carbon.add_argument("--factors", type=int, default=10_000, help="Nombre de facteurs d'émission (défaut: 10000)")
+    p_carbon.add_argument("--accounts", type=int, default=300, help="Nombre de comptes (défaut: 300)")
+    p_carbon.add_argument("--samples", type=int, default=10_000, help="Tirages Monte Carlo (défaut: 10000)")
+    p_carbon.add_argument("--chunk-mb", type=int, default=128, help="Taille maximale d'un bloc de tirages en Mo (défaut: 128)")
+    p_carbon.set_defaults(func=bench_carbon)
+
+    p_eval = subparsers.add_parser("evaluate", help="Qualité du matching (recall@k, MRR, accord top-1) sur un échantillon annoté")
+    p_eval.add_argument("--labels", type=str, required=True, help="Fichier CSV / Excel des paires annotées (colonnes PRODUIT.ID, FE.ADEME.ID)")
+    p_eval.add_argument("--source", type=str, default=SAMPLE_SOURCE, help="Source prétraitée (colonnes PRODUIT.ID, text)")
+    p_eval.add_argument("--target", type=str, default=SAMPLE_TARGET, help="Cible prétraitée (colonnes FE.ADEME.ID, text)")
+    p_eval.add_argument("--configs", nargs="+", default=list(EVAL_CONFIGS), choices=EVAL_CONFIGS)
+    p_eval.add_argument("--model", type=str, default="sentence-transformers/all-mpnet-base-v2")
+    p_eval.add_argument("--pooling", type=str, default="cls", choices=["cls", "mean"])
+    p_eval.add_argument("--batch-size", type=int, default=32)
+    p_eval.add_argument("--alpha", type=float, default=0.5, help="Poids du dense pour les configurations hybrides (défaut: 0.5)")
+    p_eval.add_argument("-k", type=int, default=10, help="Profondeur des top-k évalués (défaut: 10)")
+    p_eval.add_argument("--hnsw-m", type=int, default=32, help="Voisins par noeud de l'index HNSW (défaut: 32)")
+    p_eval.add_argument("--ef-search", type=int, default=64, help="Largeur de recherche HNSW (défaut: 64)")
+    p_eval.add_argument("--output", type=str, default=None, help="Fichier CSV où enregistrer le tableau des métriques")
+    p_eval.set_defaults(func=bench_evaluate)
+
+    p_srv = subparsers.add_parser("service", help="Latence et débit du service de matching local (micro-lots)")
+    p_srv.add_argument("--model", type=str, default="sentence-transformers/all-mpnet-base-v2")
+    p_srv.add_argument("--pooling", type=str, default="cls", choices=["cls", "mean"])
+    p_srv.add_argument("--requests", type=int, default=500, help="Nombre de requêtes (défaut: 500)")
+    p_srv.add_argument("--concurrency", type=int, default=16, help="Clients simultanés (défaut: 16)")
+    p_srv.add_argument("--max-batch", type=int, default=64, help="Textes maximum par micro-lot (défaut: 64)")
+    p_srv.add_argument("--max-wait-ms", type=float, nargs="+", default=[0, 5, 20], help="Attentes maximales comparées (défaut: 0 5 20)")
+    p_srv.add_argument("-k", type=int, default=5)
+    p_srv.set_defaults(func=bench_service)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,57 @@
+import sys
+import os
+import time
+import argparse
+
+# Ajouter le répertoire courant au chemin pour permettre l'importation depuis src
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+# Service local de matching : modèle, embeddings cibles, index FAISS et BM25 construits une fois au
+# démarrage, puis interrogés en HTTP (voir src/service.py) sans relancer app.py.
+
+def main():
+    parser = argparse.ArgumentParser(description="Service local de matching produits -> facteurs ADEME")
+    parser.add_argument("--host", type=str, default="127.0.0.1", help="Adresse d'écoute (défaut: 127.0.0.1, local uniquement)")
+    parser.add_argument("--port", type=int, default=8000, help="Port d'écoute (défaut: 8000)")
+    parser.add_argument("--target", type=str, default="../DATA/PROCESSED/target_processed.csv", help="Cible prétraitée (colonnes FE.ADEME.ID, text)")
+    parser.add_argument("-m", "--model", type=str, default="sentence-transformers/all-mpnet-base-v2", help="Nom du modèle HuggingFace (le même que pour app.py)")
+    parser.add_argument("--pooling", type=str, default="cls", choices=["cls", "mean"], help="Pooling des embeddings (défaut: cls)")
+    parser.add_argument("--alpha", type=float, default=0.5, help="Poids de la recherche dense vs BM25 (défaut: 0.5)")
+    parser.add_argument("--max-batch", type=int, default=64, help="Nombre maximal de textes par micro-lot (défaut: 64)")
+    parser.add_argument("--max-wait-ms", type=float, default=10.0, help="Attente maximale avant de lancer un micro-lot incomplet (défaut: 10 ms)")
+    args = parser.parse_args()
+
+    import pandas as pd
+    from src.utils import setup_logger
+    from src.inference import EmbeddingModel
+    from src.matching import Matcher
+    from src.service import MatchingService, start_server
+
+    logger = setup_logger()
+    if not os.path.exists(args.target):
+        logger.error(f"Cible prétraitée introuvable : {args.target} (lancer d'abord app.py -p)")
+        return
+
+    df_target = pd.read_csv(args.target)
+    target_texts = df_target["text"].fillna("").astype(str).tolist()
+    model = EmbeddingModel(model_name=args.model, pooling=args.pooling)
+    logger.info(f"Embeddings des {len(target_texts)} facteurs cibles...")
+    target_embeddings = model.get_embeddings(target_texts, normalize=True)
+    matcher = Matcher(use_faiss=True, alpha=args.alpha)
+    matcher.fit(target_embeddings, target_texts=target_texts, normalized=True, target_ids=df_target["FE.ADEME.ID"].tolist())
+
+    service = MatchingService(model, matcher, max_batch=args.max_batch, max_wait_ms=args.max_wait_ms)
+    server = start_server(service, host=args.host, port=args.port)
+    host, port = server.server_address[:2]
+    logger.info(f"Service de matching prêt sur http://{host}:{port} (POST /match, GET /metrics)")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        logger.info(f"Arrêt du service : {service.metrics()}")
+        server.shutdown()
+        service.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,133 @@
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+import logging
+
+# Agrégation de l'empreinte carbone à partir des correspondances achat -> facteur d'émission (FE).
+# Emission d'une ligne = quantité x FE.VAL du facteur retenu. Les totaux par groupe (compte, catégorie)
+# sont des produits matrice creuse x vecteur, et l'incertitude vient d'un Monte Carlo vectorisé.
+
+
+def relative_uncertainty(fe_unc) -> np.ndarray:
+    """
+    Incertitude relative des facteurs (FE.Incertitude) : fraction (0.8 = 80 %), ou pourcentage si > 1.
+    Valeurs manquantes : 0 (facteur considéré comme certain).
+    """
+    unc = np.nan_to_num(np.asarray(fe_unc, dtype=np.float64), nan=0.0)
+    return np.where(unc > 1, unc / 100, unc)
+
+
+def _lognormal_sigma(rel_unc: np.ndarray) -> np.ndarray:
+    # L'incertitude ADEME est la demi-largeur relative de l'intervalle de confiance à 95 %
+    return np.log1p(rel_unc) / 1.96
+
+
+def _group_matrix(group_codes: list[np.ndarray], n_rows: int) -> tuple[sp.csr_matrix, list[int]]:
+    """
+    Matrice creuse (lignes x groupes) d'appartenance, tous les regroupements à la suite (un seul passage).
+    Renvoie la matrice et le décalage de chaque regroupement.
+    """
+    offsets, cols, start = [], [], 0
+    for codes in group_codes:
+        offsets.append(start)
+        cols.append(codes + start)
+        start += int(codes.max()) + 1 if len(codes) else 0
+    rows = np.tile(np.arange(n_rows), len(group_codes))
+    data = np.ones(len(rows))
+    return sp.csr_matrix((data, (rows, np.concatenate(cols))), shape=(n_rows, start)), offsets
+
+
+def monte_carlo_totals(base: np.ndarray, sigma: np.ndarray, membership: sp.csr_matrix, n_samples: int = 10000,
+                       factor_idx: np.ndarray = None, max_chunk_bytes: int = 128 * 2**20, seed: int = 0) -> np.ndarray:
+    """
+    Tirages Monte Carlo des totaux par groupe, renvoie un tableau (n_samples, n_groupes).
+    base : émission centrale de chaque ligne ; sigma : écart-type log de son facteur ; membership : lignes x groupes.
+    Le facteur est tiré selon une loi log-normale de même moyenne (exp(sigma.Z - sigma²/2)).
+    factor_idx : facteur de chaque ligne. S'il est donné, un tirage par facteur est partagé par toutes ses
+    lignes (erreurs corrélées, tirage (échantillons x facteurs)) ; sinon un tirage par ligne (échantillons x lignes).
+    Les échantillons sont traités par blocs de `max_chunk_bytes` : mémoire bornée quel que soit n_samples.
+    """
+    rng = np.random.default_rng(seed)
+    if factor_idx is not None:
+        # Emissions centrales agrégées par (facteur, groupe) : les tirages ne portent que sur les facteurs utilisés
+        used, inverse = np.unique(factor_idx, return_inverse=True)
+        weights = (sp.csr_matrix((base, (inverse, np.arange(len(base)))), shape=(len(used), len(base))) @ membership).tocsr()
+        # Toutes les lignes d'un facteur ont le même sigma
+        sigma_used = np.empty(len(used))
+        sigma_used[inverse] = sigma
+        sigma = sigma_used
+    else:
+        weights = sp.diags(base) @ membership
+    # float32 comme les tirages : pas de conversion (ni de copie) des blocs dans le produit creux
+    weights = weights.tocsr().astype(np.float32)
+    sigma = sigma.astype(np.float32)
+    shift = (sigma ** 2 / 2).astype(np.float32)
+
+    n_draws = len(sigma)
+    chunk = max(1, min(n_samples, max_chunk_bytes // max(1, 4 * n_draws)))
+    totals = np.empty((n_samples, weights.shape[1]), dtype=np.float64)
+    for start in range(0, n_samples, chunk):
+        size = min(chunk, n_samples - start)
+        draws = rng.standard_normal((size, n_draws), dtype=np.float32)
+        draws *= sigma
+        draws -= shift
+        np.exp(draws, out=draws)
+        # (échantillons x tirés) x (tirés x groupes) : produit dense x creux, pas de boucle par ligne
+        totals[start:start + size] = draws @ weights
+    return totals
+
+
+def aggregate_emissions(purchases: pd.DataFrame, target_idx: np.ndarray, fe_val: np.ndarray, fe_unc: np.ndarray,
+                        by: list[str], quantity_col: str, n_samples: int = 10000, correlated: bool = True,
+                        max_chunk_bytes: int = 128 * 2**20, seed: int = 0) -> dict[str, pd.DataFrame]:
+    """
+    Emissions par groupe pour chaque colonne de `by` (ex. 'COMPTE.LIB', 'FE.CAT1'), plus un total.
+    target_idx : ligne du facteur retenu pour chaque achat (-1 : pas de correspondance, ligne ignorée).
+    fe_val, fe_unc : FE.VAL et FE.Incertitude indexés par ligne de la table des facteurs.
+    correlated=True : un même facteur a la même erreur pour toutes les lignes qui l'utilisent.
+    Renvoie {colonne: DataFrame} avec nb de lignes, émission centrale (kgCO2e), moyenne, écart-type et IC 95 %.
+    """
+    logger = logging.getLogger('Bilan Carbone CHU')
+    target_idx = np.asarray(target_idx)
+    fe_val = np.nan_to_num(np.asarray(fe_val, dtype=np.float64), nan=0.0)
+    quantities = pd.to_numeric(purchases[quantity_col], errors='coerce').fillna(0).to_numpy(dtype=np.float64)
+
+    matched = target_idx >= 0
+    if not matched.all():
+        logger.warning(f"{(~matched).sum()} achats sans facteur d'émission, ignorés dans l'agrégation.")
+    rows = purchases[matched]
+    idx = target_idx[matched]
+    base = quantities[matched] * fe_val[idx]
+    sigma = _lognormal_sigma(relative_uncertainty(fe_unc))[idx]
+
+    # Regroupements : codes entiers (pd.factorize) puis une seule matrice d'appartenance
+    by = list(by) + ['TOTAL']
+    labels, codes = [], []
+    for col in by:
+        values = pd.Series('Total', index=rows.index) if col == 'TOTAL' else rows[col].fillna('(vide)').astype(str)
+        c, uniques = pd.factorize(values)
+        codes.append(c)
+        labels.append(uniques)
+    membership, offsets = _group_matrix(codes, len(rows))
+
+    central = membership.T @ base
+    totals = monte_carlo_totals(base, sigma, membership, n_samples, factor_idx=idx if correlated else None,
+                                max_chunk_bytes=max_chunk_bytes, seed=seed)
+    low, high = np.percentile(totals, [2.5, 97.5], axis=0)
+    mean, std = totals.mean(axis=0), totals.std(axis=0)
+    n_lines = np.asarray(membership.sum(axis=0)).ravel()
+
+    results = {}
+    for col, uniques, offset in zip(by, labels, offsets):
+        sl = slice(offset, offset + len(uniques))
+        df = pd.DataFrame({
+            col: uniques,
+            'nb_lignes': n_lines[sl].astype(np.int64),
+            'emissions_kgCO2e': central[sl],
+            'mc_moyenne': mean[sl],
+            'mc_ecart_type': std[sl],
+            'ic95_bas': low[sl],
+            'ic95_haut': high[sl],
+        })
+        results[col] = df.sort_values('emissions_kgCO2e', ascending=False).reset_index(drop=True)
+    return results
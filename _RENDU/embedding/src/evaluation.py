@@ -0,0 +1,110 @@
+import time
+import logging
+import tracemalloc
+import numpy as np
+import pandas as pd
+
+from src.utils import load_data
+
+# Evaluation hors ligne de la qualité du matching sur un échantillon annoté (PRODUIT.ID -> FE.ADEME.ID).
+# Chaque configuration (dense, BM25, hybride, index approché, modèle quantifié...) renvoie ses top-k ;
+# on en déduit recall@k, MRR et l'accord des top-1 entre configurations, avec la latence et la mémoire
+# de chacune, pour vérifier qu'une optimisation ne dégrade pas les correspondances.
+
+SOURCE_ID = "PRODUIT.ID"
+TARGET_ID = "FE.ADEME.ID"
+
+
+def _first_rows(ids, wanted) -> np.ndarray:
+    # Première ligne de chaque identifiant voulu (-1 si absent). Identifiants comparés en texte : les
+    # fichiers Excel / CSV ne donnent pas toujours le même type, et un identifiant peut être répété
+    row_of = pd.Series(np.arange(len(ids)), index=pd.Series(ids).astype(str).to_numpy())
+    row_of = row_of[~row_of.index.duplicated()]
+    return row_of.reindex(pd.Series(wanted).astype(str).to_numpy()).fillna(-1).to_numpy(dtype=np.int64)
+
+
+def load_labels(path: str, source_ids, target_ids) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Paires annotées (colonnes PRODUIT.ID, FE.ADEME.ID) ramenées aux lignes des tables prétraitées.
+    Renvoie (lignes source, lignes cible attendues) ; les paires dont un identifiant est inconnu sont ignorées.
+    """
+    logger = logging.getLogger('Bilan Carbone CHU')
+    labels = load_data(path).dropna(subset=[SOURCE_ID, TARGET_ID]).drop_duplicates(subset=SOURCE_ID)
+    source_rows = _first_rows(source_ids, labels[SOURCE_ID])
+    target_rows = _first_rows(target_ids, labels[TARGET_ID])
+
+    known = (source_rows >= 0) & (target_rows >= 0)
+    if not known.all():
+        logger.warning(f"{(~known).sum()} paires annotées ignorées (identifiant absent des données prétraitées).")
+    return source_rows[known], target_rows[known]
+
+
+def truth_ranks(indices: np.ndarray, truth: np.ndarray) -> np.ndarray:
+    """
+    Rang (1 = premier) de la cible attendue dans les top-k de chaque requête, 0 si elle n'y est pas.
+    """
+    hits = indices == truth[:, None]
+    return np.where(hits.any(axis=1), hits.argmax(axis=1) + 1, 0)
+
+
+def retrieval_metrics(indices: np.ndarray, truth: np.ndarray, ks=(1, 5, 10)) -> dict:
+    """
+    recall@k (part des requêtes dont la cible est dans les k premiers) et MRR (sur les top-k disponibles).
+    """
+    ranks = truth_ranks(indices, truth)
+    metrics = {f"recall@{k}": float(((ranks > 0) & (ranks <= k)).mean()) for k in ks if k <= indices.shape[1]}
+    metrics["mrr"] = float(np.where(ranks > 0, 1 / np.maximum(ranks, 1), 0).mean())
+    return metrics
+
+
+def top1_agreement(results: dict[str, np.ndarray]) -> pd.DataFrame:
+    """
+    Matrice (configurations x configurations) de la part des requêtes ayant le même top-1.
+    """
+    names = list(results)
+    top1 = np.stack([results[name][:, 0] for name in names])
+    agreement = (top1[:, None, :] == top1[None, :, :]).mean(axis=2)
+    return pd.DataFrame(agreement, index=names, columns=names)
+
+
+def measure(func, *args, **kwargs):
+    """
+    Exécuter func en mesurant la durée (s) et le pic des allocations Python / numpy (Mo, tracemalloc).
+    Les allocations internes de FAISS et PyTorch ne sont pas vues par tracemalloc.
+    """
+    tracemalloc.start()
+    start = time.perf_counter()
+    try:
+        result = func(*args, **kwargs)
+    finally:
+        elapsed = time.perf_counter() - start
+        peak_mb = tracemalloc.get_traced_memory()[1] / 1e6
+        tracemalloc.stop()
+    return result, elapsed, peak_mb
+
+
+def evaluate(configs: dict, truth: np.ndarray, k: int = 10, reference: str = None) -> tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    Evaluer des configurations côte à côte. configs : {nom: fonction sans argument renvoyant (top_scores, top_indices)}
+    sur les requêtes annotées (dans l'ordre de `truth`), avec au moins k colonnes.
+    Renvoie (tableau des métriques, latence et mémoire par configuration ; matrice d'accord des top-1).
+    """
+    logger = logging.getLogger('Bilan Carbone CHU')
+    rows, results = [], {}
+    for name, run in configs.items():
+        logger.info(f"Evaluation : {name}...")
+        (_, indices), elapsed, peak_mb = measure(run)
+        results[name] = np.asarray(indices)[:, :k]
+        rows.append({
+            "config": name,
+            **retrieval_metrics(results[name], truth, ks=sorted({1, 5, k})),
+            "duree_s": elapsed,
+            "ms_par_requete": 1000 * elapsed / max(1, len(truth)),
+            "pic_memoire_mo": peak_mb,
+        })
+
+    report = pd.DataFrame(rows).set_index("config")
+    agreement = top1_agreement(results)
+    if reference in agreement.index:
+        report[f"accord_top1_{reference}"] = agreement[reference]
+    return report, agreement
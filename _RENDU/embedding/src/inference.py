@@ -1,45 +1,75 @@
-from transformers import AutoTokenizer, AutoModel
+from transformers import AutoTokenizer, AutoModel, AutoConfig
 import torch
+import numpy as np
+import multiprocessing as mp
+import hashlib
+import json
+import os
 import logging
 
 from tqdm import tqdm
 
+POOLING_MODES = ("cls", "mean")
+
 class EmbeddingModel:
-    def __init__(self, model_name: str = "sentence-transformers/all-mpnet-base-v2"):
+    def __init__(self, model_name: str = "sentence-transformers/all-mpnet-base-v2", pooling: str = "cls", quantize: bool = False):
         """
         Initialiser le modèle d'embedding.
+        pooling : 'cls' (token CLS) ou 'mean' (moyenne des tokens, masque d'attention pris en compte).
+        quantize : quantification dynamique int8 des couches linéaires (CPU uniquement).
         """
         self.logger = logging.getLogger('Bilan Carbone CHU')
+        if pooling not in POOLING_MODES:
+            raise ValueError(f"Pooling inconnu: {pooling} (attendu: {', '.join(POOLING_MODES)})")
+        self.pooling = pooling
         self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-        self.logger.info(f"Chargement du modèle {model_name} sur {self.device}...")
-        
+        self.logger.info(f"Chargement du modèle {model_name} sur {self.device} (pooling: {pooling})...")
+
         try:
             self.tokenizer = AutoTokenizer.from_pretrained(model_name)
             self.model = AutoModel.from_pretrained(model_name).to(self.device)
             self.model.eval()
+            if quantize:
+                if self.device.type != "cpu":
+                    self.logger.warning("Quantification int8 disponible sur CPU uniquement, modèle chargé sur CPU.")
+                    self.device = torch.device("cpu")
+                    self.model = self.model.to(self.device)
+                self.model = torch.quantization.quantize_dynamic(self.model, {torch.nn.Linear}, dtype=torch.qint8)
             self.logger.info("Modèle chargé avec succès.")
         except Exception as e:
             self.logger.error(f"Échec du chargement du modèle: {e}")
             raise
 
-    def get_embeddings(self, texts: list[str], batch_size: int = 32):
+    def _pool(self, last_hidden_state, attention_mask):
+        """
+        Réduire la sortie du modèle (batch, tokens, dim) en un vecteur par texte.
+        """
+        if self.pooling == "mean":
+            mask = attention_mask.unsqueeze(-1).to(last_hidden_state.dtype)
+            summed = (last_hidden_state * mask).sum(dim=1)
+            counts = mask.sum(dim=1).clamp(min=1e-9)
+            return summed / counts
+        # Utiliser l'embedding du token CLS (premier token)
+        return last_hidden_state[:, 0, :]
+
+    def get_embeddings(self, texts: list[str], batch_size: int = 32, normalize: bool = False, dtype: str = "float32", progress: bool = True) -> np.ndarray:
         """
-        Générer des embeddings pour une liste de textes.
+        Générer des embeddings pour une liste de textes (progress=False : sans barre de progression).
+        Renvoie un unique tableau contigu (n_textes, dim) au format `dtype` ('float32' ou 'float16').
+        Si normalize=True, les vecteurs sont normalisés L2 au fil de l'eau (le Matcher peut alors les utiliser sans copie).
         """
-        all_embeddings = []
-        
-        for i in tqdm(range(0, len(texts), batch_size), desc="Génération des embeddings", unit="batch"):
+        out_dtype = np.dtype(dtype)
+        if out_dtype not in (np.float32, np.float16):
+            raise ValueError(f"dtype non supporté pour les embeddings: {dtype}")
+
+        # Pré-allocation du tableau de sortie : pas de liste intermédiaire ni de concaténation finale
+        all_embeddings = np.empty((len(texts), self.model.config.hidden_size), dtype=out_dtype)
+
+        for i in tqdm(range(0, len(texts), batch_size), desc="Génération des embeddings", unit="batch", disable=not progress):
             batch_texts = texts[i:i + batch_size]
-            
+
             try:
-                inputs = self.tokenizer(batch_texts, padding=True, truncation=True, return_tensors="pt", max_length=512).to(self.device)
-                
-                with torch.no_grad():
-                    outputs = self.model(**inputs)
-                    # Utiliser l'embedding du token CLS (premier token)
-                    cls_embeddings = outputs.last_hidden_state[:, 0, :].cpu().numpy()
-                    
-                all_embeddings.extend(cls_embeddings)
+                all_embeddings[i:i + len(batch_texts)] = self._embed_batch(batch_texts, normalize)
             except Exception as e:
                 self.logger.error(f"Erreur lors du traitement du lot {i // batch_size}: {e}")
                 # Selon les besoins, on pourrait sauter ou ajouter des zéros, ou relancer l'exception
@@ -47,3 +77,129 @@ class EmbeddingModel:
                 raise
 
         return all_embeddings
+
+    def _embed_batch(self, batch_texts: list[str], normalize: bool) -> np.ndarray:
+        """
+        Embeddings (float32) d'un lot de textes.
+        """
+        inputs = self.tokenizer(batch_texts, padding=True, truncation=True, return_tensors="pt", max_length=512).to(self.device)
+
+        with torch.no_grad():
+            outputs = self.model(**inputs)
+            embeddings = self._pool(outputs.last_hidden_state, inputs["attention_mask"])
+            if normalize:
+                embeddings = torch.nn.functional.normalize(embeddings.float(), p=2, dim=1)
+
+        return embeddings.float().cpu().numpy()
+
+
+# --- Mode multi-processus (gros extraits source) ---
+
+def _embedding_worker(worker_id: int, texts: list[str], batch_ids: list[int], first_batch: int, output_path: str,
+                      model_name: str, pooling: str, normalize: bool, batch_size: int, num_threads: int):
+    """
+    Processus de travail : charge sa propre copie du modèle et écrit ses lots
+    directement dans le fichier .npy partagé (memmap), puis marque chaque lot comme terminé.
+    `texts` ne contient que la portion de textes de ce worker (à partir du lot `first_batch`).
+    """
+    torch.set_num_threads(num_threads)
+    model = EmbeddingModel(model_name=model_name, pooling=pooling)
+    output = np.load(output_path, mmap_mode='r+')
+    done = np.load(_progress_path(output_path), mmap_mode='r+')
+    offset = first_batch * batch_size
+
+    for b in tqdm(batch_ids, desc=f"Embeddings (worker {worker_id})", unit="batch", position=worker_id):
+        start = b * batch_size
+        batch_texts = texts[start - offset:start - offset + batch_size]
+        output[start:start + len(batch_texts)] = model._embed_batch(batch_texts, normalize)
+        # On flush les données avant le marqueur pour qu'un lot marqué soit toujours complet sur disque
+        output.flush()
+        done[b] = True
+        done.flush()
+
+def _progress_path(output_path: str) -> str:
+    return output_path[:-len(".npy")] + ".progress.npy" if output_path.endswith(".npy") else output_path + ".progress.npy"
+
+def get_embeddings_sharded(texts: list[str], output_path: str, model_name: str = "sentence-transformers/all-mpnet-base-v2",
+                           pooling: str = "cls", num_workers: int = 2, threads_per_worker: int = 1, batch_size: int = 32,
+                           normalize: bool = True, dtype: str = "float32") -> np.ndarray:
+    """
+    Générer les embeddings en répartissant les textes sur `num_workers` processus.
+    Chaque worker possède sa copie du modèle avec `threads_per_worker` threads intra-op et écrit
+    ses lots dans un tableau .npy mappé en mémoire (`output_path`).
+    Un fichier de progression (un booléen par lot) permet de reprendre un calcul interrompu :
+    seuls les lots non terminés sont recalculés, quel que soit le nombre de workers de la reprise.
+    Renvoie le tableau en lecture seule (memmap).
+    """
+    logger = logging.getLogger('Bilan Carbone CHU')
+    out_dtype = np.dtype(dtype)
+    if out_dtype not in (np.float32, np.float16):
+        raise ValueError(f"dtype non supporté pour les embeddings: {dtype}")
+    if pooling not in POOLING_MODES:
+        raise ValueError(f"Pooling inconnu: {pooling} (attendu: {', '.join(POOLING_MODES)})")
+
+    n_texts = len(texts)
+    n_batches = (n_texts + batch_size - 1) // batch_size
+    dim = AutoConfig.from_pretrained(model_name).hidden_size
+
+    # Métadonnées : un calcul n'est repris que si textes et paramètres sont identiques
+    meta = {
+        "model_name": model_name,
+        "pooling": pooling,
+        "normalize": normalize,
+        "dtype": out_dtype.name,
+        "batch_size": batch_size,
+        "shape": [n_texts, dim],
+        "texts_sha1": hashlib.sha1("\n".join(texts).encode("utf-8")).hexdigest(),
+    }
+    meta_path = output_path + ".json"
+    progress_path = _progress_path(output_path)
+
+    resume = False
+    if os.path.exists(output_path) and os.path.exists(progress_path) and os.path.exists(meta_path):
+        try:
+            with open(meta_path, 'r', encoding='utf-8') as f:
+                resume = json.load(f) == meta
+        except Exception as e:
+            logger.warning(f"Métadonnées illisibles ({e}), on recommence le calcul.")
+
+    if resume:
+        done = np.load(progress_path)
+        logger.info(f"Reprise du calcul : {int(done.sum())}/{n_batches} lots déjà calculés dans {output_path}.")
+    else:
+        os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+        np.lib.format.open_memmap(output_path, mode='w+', dtype=out_dtype, shape=(n_texts, dim)).flush()
+        np.lib.format.open_memmap(progress_path, mode='w+', dtype=np.bool_, shape=(n_batches,)).flush()
+        with open(meta_path, 'w', encoding='utf-8') as f:
+            json.dump(meta, f, indent=2)
+        done = np.zeros(n_batches, dtype=np.bool_)
+
+    todo = np.flatnonzero(~done)
+    if len(todo) > 0:
+        # Découpage en shards contigus de lots restants, un par worker
+        shards = [s for s in np.array_split(todo, min(num_workers, len(todo))) if len(s) > 0]
+        logger.info(f"Embeddings de {n_texts} textes : {len(todo)} lots sur {len(shards)} workers ({threads_per_worker} thread(s) chacun).")
+
+        # 'spawn' : pas de fork d'un processus qui a déjà initialisé les threads de PyTorch
+        ctx = mp.get_context("spawn")
+        processes = []
+        for worker_id, shard in enumerate(shards):
+            first, last = int(shard[0]), int(shard[-1])
+            shard_texts = texts[first * batch_size:(last + 1) * batch_size]
+            p = ctx.Process(
+                target=_embedding_worker,
+                args=(worker_id, shard_texts, shard.tolist(), first, output_path,
+                      model_name, pooling, normalize, batch_size, threads_per_worker),
+            )
+            p.start()
+            processes.append(p)
+
+        for p in processes:
+            p.join()
+
+        failed = [p.exitcode for p in processes if p.exitcode != 0]
+        if failed:
+            remaining = int((~np.load(progress_path)).sum())
+            raise RuntimeError(f"{len(failed)} worker(s) en échec, {remaining} lots restants. Relancer pour reprendre le calcul.")
+
+    return np.load(output_path, mmap_mode='r')
@@ -1,51 +1,187 @@
 import json
 import os
 import hashlib
-from transformers import AutoTokenizer, AutoModelForCausalLM, AutoModelForSeq2SeqLM
-import torch
+import urllib.request
 import logging
 from tqdm import tqdm
+import time
+from abc import ABC, abstractmethod
 
-class LLMRefiner:
-    def __init__(self, model_name: str = "Qwen/Qwen2.5-0.5B-Instruct", cache_file: str = "llm_cache.json"):
-        """
-        Initialise le modèle LLM pour le raffinement de texte.
-        Supporte les modèles CausalLM (comme GPT, Llama) et Seq2Seq (comme T5).
-        """
-        self.logger = logging.getLogger('Bilan Carbone CHU')
-        self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-        self.cache_file = cache_file
-        self.cache = self._load_cache()
+# torch / transformers / optimum sont importés dans les backends qui les utilisent :
+# le backend 'server' n'a besoin d'aucun des trois.
+
+# Prompt plus restrictif pour éviter les hallucinations
+PROMPT_TEMPLATE = "Tu es un expert en normalisation de données. Tu travailles sur le dataset des achats du CHU de Rennes. Ta tâche est de réécrire la description de l'achat suivant pour la faire matcher avec le dataset de l'ADEME. Supprime les codes inutiles, garde uniquement le nom du produit et si besoin, sa catégorie. Ne rajoute AUCUNE information inventée. Si la description est déjà claire, recopie-la telle quelle. Une exemple serait : ruban crochet et velours dos a dos m x mm coloris blanc unite ref v dd consommables medicaux hs -> ruban medical.\n\nDescription : '{}'\nRéponse :"
+
+# --- Backends d'inférence ---
+
+class LLMBackend(ABC):
+    """
+    Interface commune des backends : `generate` reçoit un lot de prompts et renvoie,
+    pour chacun, uniquement le texte généré (sans le prompt). Génération déterministe (greedy).
+    """
+    name = "base"
+
+    @abstractmethod
+    def generate(self, prompts: list[str], max_new_tokens: int = 50) -> list[str]:
+        ...
+
+class LocalModelBackend(LLMBackend):
+    """
+    Base des backends exécutant le modèle dans le processus (transformers, ONNX Runtime) : tokenizer,
+    padding et génération par lots communs. Les sous-classes chargent le modèle puis appellent __init__.
+    """
+
+    def __init__(self, tokenizer, model, device, is_seq2seq: bool = False):
+        self.tokenizer = tokenizer
+        self.model = model
+        self.device = device
+        self.is_seq2seq = is_seq2seq
+        if not is_seq2seq:
+            # IMPORTANT pour CausalLM : left padding pour la génération par batch
+            self.tokenizer.padding_side = 'left'
+        # S'assurer qu'un pad_token est défini
+        if self.tokenizer.pad_token is None:
+            self.tokenizer.pad_token = self.tokenizer.eos_token
+
+    def generate(self, prompts: list[str], max_new_tokens: int = 50) -> list[str]:
+        import torch
+
+        inputs = self.tokenizer(prompts, padding=True, truncation=True, return_tensors="pt", max_length=512).to(self.device)
+        
+        with torch.no_grad():
+            outputs = self.model.generate(
+                **inputs, 
+                max_new_tokens=max_new_tokens, 
+                do_sample=False, 
+                num_return_sequences=1,
+                pad_token_id=self.tokenizer.eos_token_id
+            )
         
-        self.logger.info(f"Chargement du modèle LLM {model_name} sur {self.device}...")
+        if not self.is_seq2seq:
+            # CausalLM : la sortie contient le prompt (left padding => même longueur pour tout le lot)
+            outputs = outputs[:, inputs["input_ids"].shape[1]:]
+        return self.tokenizer.batch_decode(outputs, skip_special_tokens=True)
+
+class TransformersBackend(LocalModelBackend):
+    """
+    Modèle HuggingFace chargé dans le processus (CausalLM ou Seq2Seq comme T5).
+    """
+    name = "transformers"
+
+    def __init__(self, model_name: str):
+        import torch
+        from transformers import AutoTokenizer, AutoModelForCausalLM, AutoModelForSeq2SeqLM
+
+        self.logger = logging.getLogger('Bilan Carbone CHU')
+        device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+        self.logger.info(f"Chargement du modèle LLM {model_name} sur {device}...")
         
         try:
-            self.tokenizer = AutoTokenizer.from_pretrained(model_name)
+            tokenizer = AutoTokenizer.from_pretrained(model_name)
             
             # Optimisation : Utilisation de float16 si GPU disponible
-            dtype = torch.float16 if self.device.type == 'cuda' else torch.float32
+            dtype = torch.float16 if device.type == 'cuda' else torch.float32
             
             # Essayer de déterminer le type de modèle (Causal ou Seq2Seq)
-            if any(x in model_name.lower() for x in ["t5", "bart"]):
-                self.model = AutoModelForSeq2SeqLM.from_pretrained(model_name, dtype=dtype).to(self.device)
-                self.is_seq2seq = True
-            else:
-                self.model = AutoModelForCausalLM.from_pretrained(model_name, dtype=dtype).to(self.device)
-                self.is_seq2seq = False
-                # IMPORTANT pour CausalLM : left padding pour la génération par batch
-                self.tokenizer.padding_side = 'left'
-                
-            # S'assurer qu'un pad_token est défini
-            if self.tokenizer.pad_token is None:
-                self.tokenizer.pad_token = self.tokenizer.eos_token
-                
-            self.model.eval()
+            is_seq2seq = any(x in model_name.lower() for x in ["t5", "bart"])
+            model_class = AutoModelForSeq2SeqLM if is_seq2seq else AutoModelForCausalLM
+            model = model_class.from_pretrained(model_name, dtype=dtype).to(device)
+            model.eval()
+            super().__init__(tokenizer, model, device, is_seq2seq)
             self.logger.info("Modèle LLM chargé avec succès.")
             
         except Exception as e:
             self.logger.error(f"Échec du chargement du modèle LLM: {e}")
             raise
 
+class OnnxBackend(LocalModelBackend):
+    """
+    Modèle CausalLM exporté en ONNX, exécuté par ONNX Runtime sur CPU (via optimum).
+    `model_path` : dossier produit par `optimum-cli export onnx`.
+    """
+    name = "onnx"
+
+    def __init__(self, model_path: str):
+        # Backend ONNX Runtime optionnel (export via `optimum-cli export onnx --model <nom> <dossier>`)
+        try:
+            import torch
+            from optimum.onnxruntime import ORTModelForCausalLM
+            from transformers import AutoTokenizer
+        except ImportError as e:
+            raise ImportError(f"optimum[onnxruntime] n'est pas installé : backend ONNX indisponible ({e}).")
+        self.logger = logging.getLogger('Bilan Carbone CHU')
+        self.logger.info(f"Chargement du modèle ONNX {model_path} (CPUExecutionProvider)...")
+        
+        try:
+            tokenizer = AutoTokenizer.from_pretrained(model_path)
+            model = ORTModelForCausalLM.from_pretrained(model_path, provider="CPUExecutionProvider")
+            super().__init__(tokenizer, model, torch.device("cpu"), is_seq2seq=False)
+            self.logger.info("Modèle ONNX chargé avec succès.")
+        except Exception as e:
+            self.logger.error(f"Échec du chargement du modèle ONNX: {e}")
+            raise
+
+class OpenAIServerBackend(LLMBackend):
+    """
+    Client HTTP d'un serveur local compatible OpenAI (llama.cpp server, vLLM...).
+    Le lot de prompts est envoyé en une seule requête `/v1/completions` : le serveur
+    regroupe lui-même les requêtes de plusieurs jobs et garde le modèle chargé.
+    """
+    name = "server"
+
+    def __init__(self, base_url: str = "http://127.0.0.1:8080", model_name: str = None, timeout: float = 600.0):
+        self.logger = logging.getLogger('Bilan Carbone CHU')
+        self.url = base_url.rstrip("/") + "/v1/completions"
+        self.model_name = model_name
+        self.timeout = timeout
+        self.logger.info(f"Backend LLM distant : {self.url}")
+
+    def generate(self, prompts: list[str], max_new_tokens: int = 50) -> list[str]:
+        payload = {"prompt": prompts, "max_tokens": max_new_tokens, "temperature": 0}
+        if self.model_name:
+            payload["model"] = self.model_name
+        request = urllib.request.Request(
+            self.url,
+            data=json.dumps(payload).encode("utf-8"),
+            headers={"Content-Type": "application/json"},
+        )
+        with urllib.request.urlopen(request, timeout=self.timeout) as response:
+            body = json.load(response)
+
+        # Les choix sont remis dans l'ordre des prompts (champ `index`)
+        completions = [""] * len(prompts)
+        for choice in body["choices"]:
+            completions[choice.get("index", 0)] = choice.get("text", "")
+        return completions
+
+LLM_BACKENDS = ("transformers", "onnx", "server")
+
+def make_backend(backend: str, model_name: str = None, server_url: str = None) -> LLMBackend:
+    """
+    Construire un backend à partir de son nom ('transformers', 'onnx' ou 'server').
+    Pour 'onnx', `model_name` est le dossier du modèle exporté.
+    """
+    if backend == "transformers":
+        return TransformersBackend(model_name)
+    if backend == "onnx":
+        return OnnxBackend(model_name)
+    if backend == "server":
+        return OpenAIServerBackend(server_url or "http://127.0.0.1:8080", model_name=model_name)
+    raise ValueError(f"Backend LLM inconnu: {backend} (attendu: {', '.join(LLM_BACKENDS)})")
+
+class LLMRefiner:
+    def __init__(self, model_name: str = "Qwen/Qwen2.5-0.5B-Instruct", cache_file: str = "llm_cache.json", backend="transformers", server_url: str = None):
+        """
+        Initialise le modèle LLM pour le raffinement de texte.
+        backend : nom ('transformers', 'onnx', 'server') ou instance de LLMBackend.
+        Le backend 'transformers' supporte les modèles CausalLM (comme GPT, Llama) et Seq2Seq (comme T5).
+        """
+        self.logger = logging.getLogger('Bilan Carbone CHU')
+        self.cache_file = cache_file
+        self.cache = self._load_cache()
+        self.backend = backend if isinstance(backend, LLMBackend) else make_backend(backend, model_name, server_url)
+
     def _load_cache(self) -> dict:
         if os.path.exists(self.cache_file):
             try:
@@ -56,12 +192,47 @@ class LLMRefiner:
                 return {}
         return {}
 
-    def _save_cache(self):
+    def _save_cache(self) -> bool:
         try:
             with open(self.cache_file, 'w', encoding='utf-8') as f:
                 json.dump(self.cache, f, ensure_ascii=False, indent=2)
+            return True
         except Exception as e:
             self.logger.error(f"Erreur lors de la sauvegarde du cache: {e}")
+            return False
+
+    def _generate_batch(self, batch_texts: list[str]) -> list[str]:
+        """
+        Raffine un lot de textes (génération + garde-fous). Lève une exception en cas d'erreur du modèle.
+        """
+        prompts = [PROMPT_TEMPLATE.format(t) for t in batch_texts]
+        completions = self.backend.generate(prompts, max_new_tokens=50)
+        
+        # Post-processing
+        results = []
+        for j, completion in enumerate(completions):
+            # Le backend ne renvoie que la suite du prompt ; on coupe un éventuel "Réponse :" répété
+            cleaned = completion.split("Réponse :")[-1].strip()
+            
+            original_text = batch_texts[j]
+            
+            # --- Garde-fous (Guardrails) ---
+            # 1. Si " est " présent, on coupe tout ce qui suit (ex: "X est un Y" -> "X")
+            # On le fait de manière insensible à la casse pour "EST", "Est", "est"
+            if " est " in cleaned.lower():
+                # On retrouve l'index insensible à la casse
+                idx = cleaned.lower().find(" est ")
+                cleaned = cleaned[:idx].strip()
+            
+            # 2. Si le texte généré est plus long que l'original, c'est suspect (hallucination probable)
+            # On garde l'original dans ce cas.
+            if len(cleaned) > len(original_text):
+                # Optionnel : On pourrait garder juste le premier mot, mais l'original est plus sûr.
+                cleaned = original_text
+
+            results.append(cleaned)
+
+        return results
 
     def refine_batch(self, texts: list[str], batch_size: int = 8) -> list[str]:
         """
@@ -85,61 +256,17 @@ class LLMRefiner:
             self.logger.info("Tous les textes sont déjà en cache.")
             return refined_texts
 
-        # Prompt plus restrictif pour éviter les hallucinations
-        prompt_template = "Tu es un expert en normalisation de données. Tu travailles sur le dataset des achats du CHU de Rennes. Ta tâche est de réécrire la description de l'achat suivant pour la faire matcher avec le dataset de l'ADEME. Supprime les codes inutiles, garde uniquement le nom du produit et si besoin, sa catégorie. Ne rajoute AUCUNE information inventée. Si la description est déjà claire, recopie-la telle quelle. Une exemple serait : ruban crochet et velours dos a dos m x mm coloris blanc unite ref v dd consommables medicaux hs -> ruban medical.\n\nDescription : '{}'\nRéponse :"
-        
         self.logger.info(f"Traitement de {len(texts_to_process)} textes (Batch size: {batch_size})...")
         
         for i in tqdm(range(0, len(texts_to_process), batch_size), desc="Raffinement LLM", unit="batch"):
             batch_texts = texts_to_process[i:i + batch_size]
             batch_indices = indices_to_process[i:i + batch_size]
             
-            prompts = [prompt_template.format(t) for t in batch_texts]
-            
             try:
-                inputs = self.tokenizer(prompts, padding=True, truncation=True, return_tensors="pt", max_length=512).to(self.device)
-                
-                with torch.no_grad():
-                    outputs = self.model.generate(
-                        **inputs, 
-                        max_new_tokens=50, 
-                        do_sample=False, 
-                        num_return_sequences=1,
-                        pad_token_id=self.tokenizer.eos_token_id
-                    )
-                
-                decoded = self.tokenizer.batch_decode(outputs, skip_special_tokens=True)
-                
-                # Post-processing
-                for j, raw_output in enumerate(decoded):
-                    if not self.is_seq2seq:
-                         if "Réponse :" in raw_output:
-                             cleaned = raw_output.split("Réponse :")[-1].strip()
-                         elif prompt_template.format("").split(" :")[0] in raw_output:
-                             cleaned = raw_output[len(prompts[j]):].strip()
-                         else:
-                             cleaned = raw_output
-                    else:
-                        cleaned = raw_output.strip()
-                    
-                    original_text = batch_texts[j]
-                    original_index = batch_indices[j]
-                    
-                    # --- Garde-fous (Guardrails) ---
-                    # 1. Si " est " présent, on coupe tout ce qui suit (ex: "X est un Y" -> "X")
-                    # On le fait de manière insensible à la casse pour "EST", "Est", "est"
-                    if " est " in cleaned.lower():
-                        # On retrouve l'index insensible à la casse
-                        idx = cleaned.lower().find(" est ")
-                        cleaned = cleaned[:idx].strip()
-                    
-                    # 2. Si le texte généré est plus long que l'original, c'est suspect (hallucination probable)
-                    # On garde l'original dans ce cas.
-                    if len(cleaned) > len(original_text):
-                        # Optionnel : On pourrait garder juste le premier mot, mais l'original est plus sûr.
-                        cleaned = original_text
-
-                    # Mise à jour resultats et cache
+                refined = self._generate_batch(batch_texts)
+
+                # Mise à jour resultats et cache
+                for original_index, original_text, cleaned in zip(batch_indices, batch_texts, refined):
                     refined_texts[original_index] = cleaned
                     self.cache[original_text] = cleaned
                 
@@ -157,3 +284,102 @@ class LLMRefiner:
         self._save_cache()
                 
         return refined_texts
+
+    # --- Mode "job" : reprise exacte pour les longs raffinements ---
+
+    def _replay_journal(self, journal_file: str) -> int:
+        """
+        Recharge dans le cache les lots terminés d'un job interrompu. Renvoie le nombre de textes repris.
+        Les textes en échec ne sont pas repris : ils seront retentés.
+        """
+        if not os.path.exists(journal_file):
+            return 0
+        n_restored = 0
+        with open(journal_file, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # Dernière ligne tronquée par un crash : le lot correspondant sera recalculé
+                    self.logger.warning(f"Ligne de journal illisible ignorée dans {journal_file}.")
+                    continue
+                for original_text, cleaned in entry.get("results", []):
+                    self.cache[original_text] = cleaned
+                    n_restored += 1
+        return n_restored
+
+    def _refine_with_retry(self, batch_texts: list[str], min_batch_size: int) -> tuple[list[str], list[str]]:
+        """
+        Raffine un lot ; en cas d'erreur (ex: mémoire), le lot est redécoupé en deux et retenté
+        jusqu'à `min_batch_size`. Renvoie (textes raffinés, textes en échec gardés tels quels).
+        """
+        try:
+            return self._generate_batch(batch_texts), []
+        except Exception as e:
+            if len(batch_texts) <= min_batch_size:
+                self.logger.error(f"Échec du raffinement de {len(batch_texts)} texte(s), texte original conservé : {e}")
+                return list(batch_texts), list(batch_texts)
+            half = (len(batch_texts) + 1) // 2
+            self.logger.warning(f"Erreur sur un lot de {len(batch_texts)} textes ({e}), nouvel essai par lots de {half}.")
+            left, left_failed = self._refine_with_retry(batch_texts[:half], min_batch_size)
+            right, right_failed = self._refine_with_retry(batch_texts[half:], min_batch_size)
+            return left + right, left_failed + right_failed
+
+    def refine_job(self, texts: list[str], batch_size: int = 8, journal_file: str = None, min_batch_size: int = 1) -> list[str]:
+        """
+        Raffine une liste de textes en mode "job" pour les longs traitements.
+        - Chaque lot terminé est ajouté (et synchronisé sur disque) dans un journal JSONL :
+          une reprise après interruption repart exactement du premier lot non journalisé.
+        - Un lot en erreur est retenté par lots plus petits (division par deux jusqu'à `min_batch_size`).
+        - Le débit (lignes/heure) et l'ETA sont estimés à partir du débit observé.
+        Le journal est supprimé une fois le cache complet sauvegardé.
+        """
+        if journal_file is None:
+            journal_file = os.path.splitext(self.cache_file)[0] + "_journal.jsonl"
+
+        n_restored = self._replay_journal(journal_file)
+        if n_restored:
+            self.logger.info(f"Reprise du job : {n_restored} textes récupérés depuis {journal_file}.")
+
+        # Textes uniques restant à traiter, dans l'ordre d'origine
+        texts_to_process = list(dict.fromkeys(t for t in texts if t not in self.cache))
+        total = len(texts_to_process)
+        failed = set()
+
+        if total:
+            self.logger.info(f"Job de raffinement : {total} textes restants (Batch size: {batch_size}).")
+            start_time = time.perf_counter()
+            done = 0
+            with open(journal_file, 'a', encoding='utf-8') as journal:
+                progress = tqdm(range(0, total, batch_size), desc="Raffinement LLM (job)", unit="batch")
+                for i in progress:
+                    batch_texts = texts_to_process[i:i + batch_size]
+                    refined, batch_failed = self._refine_with_retry(batch_texts, min_batch_size)
+                    batch_failed = set(batch_failed)
+                    failed.update(batch_failed)
+
+                    results = [[t, r] for t, r in zip(batch_texts, refined) if t not in batch_failed]
+                    for original_text, cleaned in results:
+                        self.cache[original_text] = cleaned
+                    journal.write(json.dumps({"batch": i // batch_size, "results": results, "failed": sorted(batch_failed)}, ensure_ascii=False) + "\n")
+                    journal.flush()
+                    os.fsync(journal.fileno())
+
+                    # Débit observé et ETA
+                    done += len(batch_texts)
+                    elapsed = time.perf_counter() - start_time
+                    rows_per_hour = done / elapsed * 3600 if elapsed > 0 else 0.0
+                    eta_s = (total - done) / (done / elapsed) if done and elapsed > 0 else 0.0
+                    progress.set_postfix(rows_per_hour=f"{rows_per_hour:.0f}", eta=time.strftime("%H:%M:%S", time.gmtime(eta_s)))
+                    if (i // batch_size) % 10 == 0:
+                        self.logger.info(f"Raffinement : {done}/{total} textes, {rows_per_hour:.0f} lignes/heure, ETA {eta_s / 60:.1f} min.")
+
+            self.logger.info(f"Job terminé : {total} textes en {time.perf_counter() - start_time:.0f} s, {len(failed)} en échec (texte original conservé).")
+        else:
+            self.logger.info("Tous les textes sont déjà en cache.")
+
+        # Le cache contient maintenant tout le journal : on peut le consolider puis supprimer le journal
+        if self._save_cache() and os.path.exists(journal_file):
+            os.remove(journal_file)
+
+        return [t if t in failed else self.cache.get(t, t) for t in texts]
@@ -3,35 +3,86 @@ import faiss
 from sklearn.metrics.pairwise import cosine_similarity
 from sklearn.preprocessing import minmax_scale
 import logging
+from collections import Counter
 try:
     from rank_bm25 import BM25Okapi
 except ImportError:
     BM25Okapi = None
 
 class Matcher:
-    def __init__(self, use_faiss: bool = True, alpha: float = 0.5):
+    def __init__(self, use_faiss: bool = True, alpha: float = 0.5, top_n_cache: int = 0):
+        """
+        top_n_cache > 0 : match() garde, par requête, les top-N candidats dense, BM25 et de la fusion avec leurs
+        scores normalisés, pour évaluer ensuite d'autres fusions (sweep) sans recalculer les matrices de scores.
+        """
         self.logger = logging.getLogger('Bilan Carbone CHU')
         self.use_faiss = use_faiss
         self.alpha = alpha # Poids du Dense (0.5 = équilibré)
+        self.top_n_cache = top_n_cache
         self.index = None
         self.target_embeddings = None
         self.bm25 = None
         self.target_texts = None
+        self.normalized = False
+        self.candidates = None
+        # Mises à jour incrémentales : identifiant (FE.ADEME.ID) de chaque ligne, lignes actives (les lignes
+        # supprimées restent en place, masquées, et gardent leur identifiant : un nouvel upsert les réactive)
+        # et fréquences documentaires BM25 des lignes actives
+        self.target_ids = None
+        self.active = None
+        self._slot_of = {}
+        self._n_slots = 0
+        self._doc_freq = None
+        self._total_len = 0
+
+    def _prepare_embeddings(self, embeddings, normalized: bool) -> np.ndarray:
+        """
+        Mettre les embeddings au format attendu (contigu, normalisé L2 si FAISS).
+        Si `normalized` est vrai (sortie de EmbeddingModel.get_embeddings(normalize=True)),
+        le tableau float32/float16 est utilisé tel quel, sans copie.
+        """
+        if normalized:
+            embeddings = np.asarray(embeddings)
+            if embeddings.dtype not in (np.float32, np.float16):
+                embeddings = embeddings.astype('float32')
+            return np.ascontiguousarray(embeddings)
+
+        embeddings = np.array(embeddings).astype('float32')
+        if self.use_faiss:
+            faiss.normalize_L2(embeddings)
+        return embeddings
 
-    def fit(self, target_embeddings: np.ndarray, target_texts: list[str] = None):
+    def fit(self, target_embeddings: np.ndarray, target_texts: list[str] = None, normalized: bool = False, target_ids: list = None):
         """
         Adapter le matcher avec les embeddings cibles et les textes pour BM25.
+        normalized=True : les embeddings sont déjà normalisés L2 (float32 ou float16), pas de copie. En float16,
+        l'index FAISS stocke lui aussi des vecteurs fp16 (IndexScalarQuantizer QT_fp16).
+        target_ids : identifiant de chaque cible (FE.ADEME.ID) pour upsert() / remove() ; par défaut, sa position.
         """
-        self.target_embeddings = np.array(target_embeddings).astype('float32')
-        self.target_texts = target_texts
+        self.normalized = normalized
+        self.target_embeddings = self._prepare_embeddings(target_embeddings, normalized)
+        self.target_texts = list(target_texts) if target_texts is not None else None
+        self._n_slots = len(self.target_embeddings)
+        self.target_ids = list(target_ids) if target_ids is not None else list(range(self._n_slots))
+        self._slot_of = {target_id: slot for slot, target_id in enumerate(self.target_ids)}
+        self.active = np.ones(self._n_slots, dtype=bool)
         
         # 1. Construction Index Dense
         if self.use_faiss:
             self.logger.info("Construction de l'index FAISS...")
             dimension = self.target_embeddings.shape[1]
-            faiss.normalize_L2(self.target_embeddings)
-            self.index = faiss.IndexFlatIP(dimension)
-            self.index.add(self.target_embeddings)
+            if self.target_embeddings.dtype == np.float16:
+                # Stockage float16 dans l'index aussi (produit scalaire exact sur les vecteurs fp16, sans
+                # entraînement) : pas de copie float32 complète à côté des embeddings
+                base_index = faiss.IndexScalarQuantizer(dimension, faiss.ScalarQuantizer.QT_fp16, faiss.METRIC_INNER_PRODUCT)
+            else:
+                base_index = faiss.IndexFlatIP(dimension)
+            # Index adressé par numéro de ligne : ajout et retrait de vecteurs sans reconstruction
+            self.index = faiss.IndexIDMap(base_index)
+            # FAISS ne prend que du float32 en entrée : ajout par blocs (pas de copie si c'est déjà du float32)
+            for start in range(0, self._n_slots, 65536):
+                block = self.target_embeddings[start:start + 65536].astype('float32', copy=False)
+                self.index.add_with_ids(block, np.arange(start, start + len(block), dtype=np.int64))
             self.logger.info(f"Index FAISS construit avec {self.index.ntotal} vecteurs.")
         else:
             self.logger.info("Utilisation de la similarité cosinus Scikit-Learn.")
@@ -42,21 +93,43 @@ class Matcher:
             # Tokenisation simple pour l'exemple (split espace)
             tokenized_corpus = [doc.lower().split() for doc in target_texts]
             self.bm25 = BM25Okapi(tokenized_corpus)
+            self._doc_freq = Counter(term for doc in self.bm25.doc_freqs for term in doc)
+            self._total_len = sum(self.bm25.doc_len)
             self.logger.info("Index BM25 construit.")
         elif target_texts and not BM25Okapi:
             self.logger.warning("rank_bm25 non installé. Hybrid Search désactivé (Dense uniquement).")
 
-    def match(self, source_embeddings: np.ndarray, source_texts: list[str] = None, k: int = 1):
+    def _dense_dot(self, source_embeddings: np.ndarray, chunk_size: int = 4096) -> np.ndarray:
+        """
+        Produit scalaire source x cible. Les tableaux float16 sont convertis en float32 par blocs de
+        lignes, des deux côtés, pour rester sur le chemin BLAS sans dupliquer ni la source ni la cible
+        (la cible float16 n'est jamais copiée en entier, à chaque match()).
+        """
+        target = self.target_embeddings
+        if source_embeddings.dtype == np.float32 and target.dtype == np.float32:
+            return np.dot(source_embeddings, target.T)
+
+        scores = np.empty((len(source_embeddings), len(target)), dtype='float32')
+        for t_start in range(0, len(target), chunk_size):
+            t_chunk = target[t_start:t_start + chunk_size].astype('float32', copy=False)
+            for start in range(0, len(source_embeddings), chunk_size):
+                chunk = source_embeddings[start:start + chunk_size].astype('float32', copy=False)
+                scores[start:start + chunk_size, t_start:t_start + chunk_size] = np.dot(chunk, t_chunk.T)
+        return scores
+
+    def match(self, source_embeddings: np.ndarray, source_texts: list[str] = None, k: int = 1, normalized: bool = None):
         """
         Trouver les top-k correspondances en combinant Dense et Sparse.
+        normalized : embeddings sources déjà normalisés L2 (par défaut, même convention que fit).
         """
-        source_embeddings = np.array(source_embeddings).astype('float32')
+        if normalized is None:
+            normalized = self.normalized
+        source_embeddings = self._prepare_embeddings(source_embeddings, normalized)
         num_queries = len(source_embeddings)
         num_targets = len(self.target_embeddings)
         
         # --- A. Score Dense (Cosinus) ---
-        if self.use_faiss:
-            faiss.normalize_L2(source_embeddings)
+        if self.use_faiss or normalized:
             # FAISS search renvoie les distances et indices des top-k. 
             # Pour hybride, on a besoin de TOUS les scores ou au moins d'un large top-k pour rerank.
             # Ici, pour faire simple et précis, on va calculer la matrice complète avec FAISS ou numpy si pas trop gros.
@@ -68,13 +141,14 @@ class Matcher:
             # Approche "Rerank" : On prend Top-50 Dense, et on ajoute le score BM25.
             
             # Faisons simple : Si la target est petite (< 10000), on calcule tout.
-            if num_targets < 10000:
+            # (Sans index FAISS, des vecteurs déjà normalisés passent aussi par le produit scalaire.)
+            if num_targets < 10000 or not self.use_faiss:
                 # Produit scalaire global (car normalisé L2 = Cosinus)
-                dense_scores = np.dot(source_embeddings, self.target_embeddings.T)
+                dense_scores = self._dense_dot(source_embeddings)
             else:
                  # Fallback sur FAISS search standard (PAS Hybride complet sur tout le corpus)
                  # On ne pourra mixer qu'avec les scores des items retournés par FAISS
-                 dense_scores, indices = self.index.search(source_embeddings, k=min(k*10, num_targets))
+                 dense_scores, indices = self.index.search(source_embeddings.astype('float32', copy=False), k=min(k*10, num_targets))
                  # TODO: gérer le cas complexe du large scale hybrid
                  pass
         else:
@@ -113,6 +187,16 @@ class Matcher:
         final_scores = self.alpha * dense_norm + (1 - self.alpha) * sparse_norm
         
         # --- D. Top-K ---
+        # Lignes supprimées (remove) : score -1, sous tout score valide (les scores normalisés sont dans [0, 1])
+        if self.active is not None and not self.active.all() and final_scores.shape[1] == num_targets:
+            final_scores[:, ~self.active] = -1
+
+        if self.top_n_cache > 0 and dense_norm.shape == sparse_norm.shape == (num_queries, num_targets):
+            if self.active is not None and not self.active.all():
+                dense_norm[:, ~self.active] = -1
+                sparse_norm[:, ~self.active] = -1
+            self._cache_candidates(dense_norm, sparse_norm, final_scores, self.top_n_cache)
+
         # Argsort renvoie les indices triés du plus petit au plus grand, on prend la fin (reverse)
         top_indices = np.argsort(-final_scores, axis=1)[:, :k]
         
@@ -121,3 +205,219 @@ class Matcher:
         top_scores = np.take_along_axis(final_scores, top_indices, axis=1)
         
         return top_scores, top_indices
+
+    # --- Mises à jour incrémentales de la base ADEME ---
+
+    def _grow(self, n_new: int):
+        # Tampons des embeddings et du masque des lignes actives à capacité doublée : un ajout ne recopie pas
+        # toute la base. Le premier appel copie les embeddings passés à fit (qui peuvent appartenir à
+        # l'appelant) avant toute modification.
+        capacity = self._embeddings_capacity()
+        if self._n_slots + n_new > capacity:
+            new_capacity = max(self._n_slots + n_new, 2 * self._n_slots)
+            buffer = np.empty((new_capacity, self.target_embeddings.shape[1]), dtype=self.target_embeddings.dtype)
+            buffer[:self._n_slots] = self.target_embeddings[:self._n_slots]
+            active_buffer = np.zeros(new_capacity, dtype=bool)
+            active_buffer[:self._n_slots] = self.active[:self._n_slots]
+            self._buffer, self._active_buffer = buffer, active_buffer
+        self.target_embeddings = self._buffer[:self._n_slots + n_new]
+        self._active_buffer[self._n_slots:self._n_slots + n_new] = False
+        self.active = self._active_buffer[:self._n_slots + n_new]
+
+    def _embeddings_capacity(self) -> int:
+        buffer = getattr(self, '_buffer', None)
+        return len(buffer) if buffer is not None and self.target_embeddings.base is buffer else 0
+
+    def _bm25_set(self, slot: int, text: str = None):
+        """
+        Remplacer le document BM25 d'une ligne (text=None : document vide, ligne supprimée) en tenant à jour
+        les fréquences documentaires et la longueur totale des lignes actives.
+        """
+        bm25 = self.bm25
+        if slot < len(bm25.doc_freqs):
+            old = bm25.doc_freqs[slot]
+            self._doc_freq.subtract(old.keys())
+            for term in old:
+                if self._doc_freq[term] <= 0:
+                    del self._doc_freq[term]
+            self._total_len -= bm25.doc_len[slot]
+        tokens = text.lower().split() if text is not None else []
+        freqs = dict(Counter(tokens))
+        self._doc_freq.update(freqs.keys())
+        self._total_len += len(tokens)
+        if slot < len(bm25.doc_freqs):
+            bm25.doc_freqs[slot], bm25.doc_len[slot] = freqs, len(tokens)
+        else:
+            bm25.doc_freqs.append(freqs)
+            bm25.doc_len.append(len(tokens))
+
+    def _bm25_refresh(self):
+        # Statistiques globales sur les seules lignes actives, comme après un fit complet (idf : O(vocabulaire))
+        bm25 = self.bm25
+        n_active = int(self.active.sum())
+        bm25.avgdl = self._total_len / max(1, n_active)
+        bm25.idf = {}
+        bm25.corpus_size = n_active
+        bm25._calc_idf(self._doc_freq)
+        # get_scores renvoie corpus_size scores : un par ligne, supprimées comprises (document vide, masquées)
+        bm25.corpus_size = len(bm25.doc_freqs)
+
+    def upsert(self, ids: list, embeddings: np.ndarray, texts: list[str] = None, normalized: bool = None) -> dict:
+        """
+        Ajouter des cibles, ou remplacer celles dont l'identifiant existe déjà, sans reconstruire les index :
+        le coût est proportionnel au nombre de lignes modifiées (plus le recalcul des idf BM25). Une cible
+        supprimée (remove) puis ré-ajoutée reprend sa ligne : un identifiant n'occupe jamais deux lignes.
+        embeddings et texts suivent les conventions de fit (normalized : par défaut, même valeur que fit).
+        Renvoie {'added': n, 'replaced': n}.
+        """
+        if normalized is None:
+            normalized = self.normalized
+        embeddings = self._prepare_embeddings(embeddings, normalized).astype(self.target_embeddings.dtype, copy=False)
+        if len(ids) != len(embeddings) or (texts is not None and len(texts) != len(ids)):
+            raise ValueError("ids, embeddings et texts doivent avoir la même longueur.")
+
+        if len(set(ids)) != len(ids):
+            raise ValueError("Identifiants en double dans ids.")
+        if self.bm25 is not None and texts is None:
+            raise ValueError("texts est requis pour mettre à jour l'index BM25.")
+
+        slots = np.empty(len(ids), dtype=np.int64)
+        new = [i for i, target_id in enumerate(ids) if target_id not in self._slot_of]
+        first_new = self._n_slots
+        self._grow(len(new))
+        for j, i in enumerate(new):
+            self._slot_of[ids[i]] = first_new + j
+            self.target_ids.append(ids[i])
+            if self.target_texts is not None:
+                self.target_texts.append(None)
+        self._n_slots += len(new)
+        for i, target_id in enumerate(ids):
+            slots[i] = self._slot_of[target_id]
+        # Lignes encore actives (remplacées) ; les autres sont nouvelles ou réactivées
+        replaced = slots[self.active[slots]]
+
+        self.target_embeddings[slots] = embeddings
+        self.active[slots] = True
+        if self.target_texts is not None and texts is not None:
+            for slot, text in zip(slots, texts):
+                self.target_texts[slot] = text
+
+        if self.index is not None:
+            if len(replaced):
+                self.index.remove_ids(replaced)
+            self.index.add_with_ids(embeddings.astype('float32', copy=False), slots)
+
+        if self.bm25 is not None:
+            for slot, text in zip(slots, texts):
+                self._bm25_set(int(slot), str(text))
+            self._bm25_refresh()
+
+        self.candidates = None
+        stats = {'added': len(ids) - len(replaced), 'replaced': len(replaced)}
+        self.logger.info(f"Cibles mises à jour : {stats['added']} ajoutées, {stats['replaced']} remplacées.")
+        return stats
+
+    def remove(self, ids: list) -> int:
+        """
+        Supprimer des cibles par identifiant (lignes masquées, exclues des résultats et des statistiques BM25).
+        Renvoie le nombre de cibles supprimées ; les identifiants inconnus ou déjà supprimés sont ignorés.
+        """
+        slots = np.array(list(dict.fromkeys(self._slot_of[target_id] for target_id in ids if target_id in self._slot_of)),
+                         dtype=np.int64)
+        slots = slots[self.active[slots]]
+        if len(slots) == 0:
+            return 0
+        self.active[slots] = False
+        if self.index is not None:
+            self.index.remove_ids(slots)
+        if self.bm25 is not None:
+            for slot in slots:
+                self._bm25_set(int(slot), None)
+            self._bm25_refresh()
+        self.candidates = None
+        self.logger.info(f"Cibles supprimées : {len(slots)}.")
+        return len(slots)
+
+    def ids_of(self, indices: np.ndarray) -> np.ndarray:
+        """
+        Identifiants des cibles pour des indices renvoyés par match().
+        """
+        return np.asarray(self.target_ids, dtype=object)[indices]
+
+    @staticmethod
+    def _top_n(scores: np.ndarray, n: int) -> np.ndarray:
+        # Top-n par ligne (argpartition), trié par score décroissant
+        top = np.argpartition(-scores, n - 1, axis=1)[:, :n]
+        order = np.argsort(-np.take_along_axis(scores, top, axis=1), axis=1, kind='stable')
+        return np.take_along_axis(top, order, axis=1)
+
+    def _cache_candidates(self, dense_norm: np.ndarray, sparse_norm: np.ndarray, final_scores: np.ndarray, top_n: int):
+        """
+        Union des top-N dense, top-N BM25 et top-N de la fusion principale (alpha du Matcher) de chaque requête :
+        indices, scores normalisés des deux composantes et rang dans les listes dense et BM25 tronquées (inf si
+        absent de la liste), pour sweep(). Un bon candidat de la fusion peut n'être dans aucune des deux premières
+        listes : la troisième garantit que sweep() au même alpha redonne les top-k de match() (k <= N).
+        """
+        n = min(top_n, dense_norm.shape[1])
+        num_queries = dense_norm.shape[0]
+        candidates = np.concatenate([self._top_n(dense_norm, n), self._top_n(sparse_norm, n),
+                                     self._top_n(final_scores, n)], axis=1)
+        ranks = np.arange(n, dtype=np.float32)
+        missing = np.full(n, np.inf, dtype=np.float32)
+        dense_rank = np.broadcast_to(np.concatenate([ranks, missing, missing]), candidates.shape)
+        sparse_rank = np.broadcast_to(np.concatenate([missing, ranks, missing]), candidates.shape)
+
+        # Doublons (candidat présent dans plusieurs listes) : tri stable par indice, les entrées d'un candidat
+        # sont dans l'ordre dense, BM25, fusion. La première garde son rang dense et prend le rang BM25 de la
+        # suivante (inf pour une entrée de la fusion, d'où le minimum) ; les autres sont invalidées
+        order = np.argsort(candidates, axis=1, kind='stable')
+        candidates = np.take_along_axis(candidates, order, axis=1)
+        dense_rank = np.take_along_axis(dense_rank, order, axis=1)
+        sparse_rank = np.take_along_axis(sparse_rank, order, axis=1)
+        valid = np.ones(candidates.shape, dtype=bool)
+        dup = candidates[:, 1:] == candidates[:, :-1]
+        sparse_rank[:, :-1][dup] = np.minimum(sparse_rank[:, :-1][dup], sparse_rank[:, 1:][dup])
+        valid[:, 1:][dup] = False
+
+        self.candidates = {
+            'indices': candidates.astype(np.int64),
+            'dense': np.take_along_axis(dense_norm, candidates, axis=1).astype(np.float32),
+            'sparse': np.take_along_axis(sparse_norm, candidates, axis=1).astype(np.float32),
+            'dense_rank': dense_rank,
+            'sparse_rank': sparse_rank,
+            'valid': valid,
+        }
+        self.logger.info(f"Candidats en cache pour le sweep : {num_queries} requêtes x {candidates.shape[1]} (top-{n} dense + top-{n} BM25 + top-{n} fusion)")
+
+    def sweep(self, alphas: list[float], k: int = 1, rrf_k: float = 60, chunk_size: int = 4096) -> dict:
+        """
+        Evaluer plusieurs fusions sur les candidats gardés par le dernier match() (top_n_cache > 0), sans
+        recalculer les scores : alpha * dense_norm + (1 - alpha) * sparse_norm pour chaque alpha, et la
+        fusion par rangs réciproques (RRF : somme des 1 / (rrf_k + rang)). Toutes les fusions d'un bloc de
+        requêtes sont calculées ensemble (tableau fusions x requêtes x candidats).
+        Renvoie {nom: (top_scores, top_indices)} au format de match(), noms 'alpha=0.3', ..., 'rrf'.
+        """
+        if self.candidates is None:
+            raise RuntimeError("Aucun candidat en cache : créer le Matcher avec top_n_cache > 0 puis appeler match().")
+        c = self.candidates
+        alphas = np.asarray(alphas, dtype=np.float32)
+        names = [f"alpha={a:g}" for a in alphas] + ["rrf"]
+        num_queries, num_candidates = c['indices'].shape
+        k = min(k, num_candidates)
+        out_scores = np.empty((len(names), num_queries, k), dtype=np.float32)
+        out_indices = np.empty((len(names), num_queries, k), dtype=np.int64)
+
+        for start in range(0, num_queries, chunk_size):
+            sl = slice(start, start + chunk_size)
+            dense, sparse, valid = c['dense'][sl], c['sparse'][sl], c['valid'][sl]
+            fused = np.empty((len(names),) + dense.shape, dtype=np.float32)
+            fused[:-1] = alphas[:, None, None] * dense + (1 - alphas)[:, None, None] * sparse
+            # Rang absent (inf) : contribution nulle
+            fused[-1] = 1 / (rrf_k + c['dense_rank'][sl] + 1) + 1 / (rrf_k + c['sparse_rank'][sl] + 1)
+            fused[:, ~valid] = -np.inf
+
+            top = np.argsort(-fused, axis=2, kind='stable')[:, :, :k]
+            out_scores[:, sl] = np.take_along_axis(fused, top, axis=2)
+            out_indices[:, sl] = np.take_along_axis(np.broadcast_to(c['indices'][sl], fused.shape), top, axis=2)
+
+        return {name: (out_scores[i], out_indices[i]) for i, name in enumerate(names)}
@@ -4,17 +4,44 @@ import pandas as pd
 import logging
 import sys
 import os
+import time
+import numpy as np
 
 # Add src to path if needed or just relative import if package structure allows
 # Assuming running from root (app.py), but relative imports inside src might need care
 # Using absolute imports based on app.py structure
 from src.utils import load_data, save_results
 
-# Tentative d'import optionnel pour éviter les erreurs si dependencies manquantes (même si user a demandé)
-try:
-    from src.llm_utils import LLMRefiner
-except ImportError:
-    LLMRefiner = None
+def _import_llm_refiner(backend: str = "transformers"):
+    """
+    Import à la demande de LLMRefiner (optionnel) : le prétraitement classique n'a pas à payer
+    l'import de torch/transformers.
+    """
+    try:
+        from src.llm_utils import LLMRefiner
+        if backend != "server":
+            # Dépendances des backends locaux, importées par le modèle juste après
+            import torch
+            import transformers
+    except ImportError:
+        LLMRefiner = None
+    return LLMRefiner
+
+def best_match_scores(texts: list[str], references: list[str], chunk_size: int = 2000) -> np.ndarray:
+    """
+    Score de confiance bon marché (sans modèle) : similarité cosinus TF-IDF (n-grammes de caractères) de chaque
+    texte avec le libellé de référence le plus proche. Produit creux par blocs de lignes, pas de matrice dense.
+    """
+    from sklearn.feature_extraction.text import TfidfVectorizer
+
+    vectorizer = TfidfVectorizer(analyzer="char_wb", ngram_range=(3, 5))
+    vectorizer.fit(references)
+    ref_matrix = vectorizer.transform(references).T.tocsc()
+    scores = np.zeros(len(texts))
+    for start in range(0, len(texts), chunk_size):
+        chunk = vectorizer.transform(texts[start:start + chunk_size]) @ ref_matrix
+        scores[start:start + chunk_size] = chunk.max(axis=1).toarray().ravel()
+    return scores
 
 class TextPreprocessor:
     def __init__(self):
@@ -48,10 +75,14 @@ class TextPreprocessor:
         """
         return [self.clean_text(t) for t in texts]
 
-    def process_and_save(self, input_file: str, output_file: str, columns: list[str], keep: list[str], use_llm: bool = False, llm_model_name: str = None, batch_size: int = 8):
+    def process_and_save(self, input_file: str, output_file: str, columns: list[str], keep: list[str], use_llm: bool = False, llm_model_name: str = None, batch_size: int = 8, llm_job: bool = False, llm_backend: str = "transformers", llm_server_url: str = None, llm_gate: float = None, gate_texts: list[str] = None):
         """
         Pretraitement des données, pour ne garder que les colonnes interessantes (dans le target) et nettoyer les textes.
         Optionally refine with LLM.
+        llm_job=True : raffinement en mode "job" (journal par lot, reprise exacte, nouvel essai des lots en erreur).
+        llm_backend : 'transformers' (dans le processus), 'onnx' (ONNX Runtime CPU) ou 'server' (serveur local compatible OpenAI).
+        llm_gate : seuil de confiance (best_match_scores contre gate_texts, les libellés cibles nettoyés). Seuls les
+        textes sous le seuil passent par le LLM ; un texte raffiné n'est gardé que si son score ne baisse pas.
         """
         logger = logging.getLogger('Bilan Carbone CHU')
         logger.info(f"Traitement de {input_file} -> {output_file}")
@@ -80,23 +111,60 @@ class TextPreprocessor:
             clean_texts = self.preprocess_batch(raw_texts)
             
             if use_llm:
+                LLMRefiner = _import_llm_refiner(llm_backend)
                 if LLMRefiner is None:
                     logger.error("LLMRefiner n'a pas pu être importé. Passage en mode classique.")
                     final_texts = clean_texts
                     raw_stored_texts = clean_texts
                 else:
-                    logger.info(f"Raffinement par LLM activé avec le modèle {llm_model_name} (Batch: {batch_size})...")
+                    logger.info(f"Raffinement par LLM activé avec le modèle {llm_model_name} (Backend: {llm_backend}, Batch: {batch_size})...")
                     
                     # Optimisation majeure : Déduplication avant LLM
                     # On ne traite que les textes uniques pour éviter de recalculer 1000 fois la même description
                     unique_texts = list(set(clean_texts))
                     logger.info(f"Nombre de textes uniques à raffiner : {len(unique_texts)} / {len(clean_texts)} total")
                     
-                    refiner = LLMRefiner(model_name=llm_model_name)
-                    refined_uniques = refiner.refine_batch(unique_texts, batch_size=batch_size)
+                    # Filtre de confiance : les textes déjà proches d'un libellé ADEME ne passent pas par le LLM
+                    gated = llm_gate is not None and bool(gate_texts)
+                    to_refine = unique_texts
+                    if gated:
+                        gate_scores = best_match_scores(unique_texts, gate_texts)
+                        to_refine = [t for t, score in zip(unique_texts, gate_scores) if score < llm_gate]
+                        logger.info(f"Filtre de confiance (seuil {llm_gate}) : {len(to_refine)} textes envoyés au LLM, {len(unique_texts) - len(to_refine)} évités")
+
+                    # Chargement du modèle (coût fixe) et génération mesurés séparément
+                    load_s = llm_s = 0.0
+                    refined_uniques = []
+                    if to_refine:
+                        load_start = time.perf_counter()
+                        refiner = LLMRefiner(model_name=llm_model_name, backend=llm_backend, server_url=llm_server_url)
+                        load_s = time.perf_counter() - load_start
+                        llm_start = time.perf_counter()
+                        if llm_job:
+                            refined_uniques = refiner.refine_job(to_refine, batch_size=batch_size)
+                        else:
+                            refined_uniques = refiner.refine_batch(to_refine, batch_size=batch_size)
+                        llm_s = time.perf_counter() - llm_start
                     
                     # Création d'un mapping {original_clean: refined}
-                    mapping = dict(zip(unique_texts, refined_uniques))
+                    mapping = {t: t for t in unique_texts}
+                    mapping.update(zip(to_refine, refined_uniques))
+
+                    if gated and to_refine:
+                        # Re-matching des textes raffinés : on garde le texte nettoyé si le LLM l'a éloigné des libellés
+                        old_scores = dict(zip(unique_texts, gate_scores))
+                        new_scores = best_match_scores(self.preprocess_batch(refined_uniques), gate_texts)
+                        improved = 0
+                        for text, new_score in zip(to_refine, new_scores):
+                            if new_score < old_scores[text]:
+                                mapping[text] = text
+                            elif new_score > old_scores[text]:
+                                improved += 1
+                        avoided = len(unique_texts) - len(to_refine)
+                        # Temps de génération par texte seulement : le chargement du modèle n'est pas évité
+                        saved_s = avoided * llm_s / len(to_refine)
+                        logger.info(f"LLM : chargement {load_s:.1f}s, {len(to_refine)} appels ({llm_s:.1f}s), {avoided} évités "
+                                    f"(~{saved_s:.0f}s économisées), {improved} textes raffinés se rapprochent d'un libellé ADEME")
                     
                     refined_full_list = [mapping[t] for t in clean_texts]
                     
@@ -121,7 +189,9 @@ class TextPreprocessor:
             if output_file.endswith("target_processed_llm.csv") or output_file.endswith("target_processed.csv"):
                  df_out = df_out.drop_duplicates(subset='text', keep='first')
             elif output_file.endswith("source_processed_llm.csv") or output_file.endswith("source_processed.csv"):
-                 df_out = df_out.drop_duplicates(subset='text', keep='first')
+                 # Un texte raffiné peut venir de plusieurs textes nettoyés : on garde chaque text_raw, clé de
+                 # jointure des achats (sans LLM, text == text_raw : mêmes lignes qu'avant)
+                 df_out = df_out.drop_duplicates(subset='text_raw', keep='first')
             
             # Sauvegarde
             save_results(df_out, output_file)
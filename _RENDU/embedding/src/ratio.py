@@ -0,0 +1,89 @@
+import os
+import logging
+import numpy as np
+import pandas as pd
+
+from src.utils import load_data
+from src.preprocess import TextPreprocessor
+
+# Palier de repli du matching : ratios monétaires (kgCO2e / k€) de RATIO MONETAIRE.xlsx.
+# L'index COMPTE.LIB -> ratio est construit une fois pour les comptes distincts (quelques centaines),
+# puis chaque achat se résout par une simple recherche dans cet index (pas de passe de modèle).
+
+RATIO_ID = "FE.RM.ID"
+ACCOUNT_COL = "COMPTE.LIB"
+
+
+def _match_accounts(accounts: list[str], ratios: pd.DataFrame) -> pd.DataFrame:
+    """
+    Ratio le plus proche de chaque libellé de compte : similarité cosinus TF-IDF sur n-grammes de caractères
+    entre libellés nettoyés (compte vs FE.LIB2 du ratio).
+    """
+    from sklearn.feature_extraction.text import TfidfVectorizer
+
+    preprocessor = TextPreprocessor()
+    account_texts = preprocessor.preprocess_batch(accounts)
+    ratio_texts = preprocessor.preprocess_batch(ratios["FE.LIB2"].fillna("").astype(str).tolist())
+
+    vectorizer = TfidfVectorizer(analyzer="char_wb", ngram_range=(3, 5))
+    vectorizer.fit(ratio_texts + account_texts)
+    # Vecteurs TF-IDF normalisés L2 : le produit scalaire est la similarité cosinus
+    similarity = (vectorizer.transform(account_texts) @ vectorizer.transform(ratio_texts).T).toarray()
+    best = similarity.argmax(axis=1)
+    return pd.DataFrame({
+        ACCOUNT_COL: accounts,
+        RATIO_ID: ratios[RATIO_ID].to_numpy()[best],
+        "FE.LIB2": ratios["FE.LIB2"].to_numpy()[best],
+        "similarite": similarity[np.arange(len(accounts)), best],
+    })
+
+
+class MonetaryRatioIndex:
+    def __init__(self, ratios: pd.DataFrame, mapping: pd.DataFrame, min_similarity: float = 0.0):
+        """
+        ratios : table des ratios monétaires ; mapping : colonnes COMPTE.LIB, FE.RM.ID (et similarite).
+        Les comptes dont la similarité est sous min_similarity n'ont pas de ratio.
+        """
+        self.ratios = ratios.reset_index(drop=True)
+        self.mapping = mapping
+        row_of_id = pd.Series(np.arange(len(self.ratios)), index=self.ratios[RATIO_ID].to_numpy())
+        # Copie modifiable pour le masque de similarité : sans valeur manquante, to_numpy peut renvoyer une vue
+        # en lecture seule (copy-on-write de pandas)
+        rows = row_of_id.reindex(mapping[RATIO_ID].to_numpy()).fillna(-1).to_numpy(dtype=np.int64, copy=True)
+        if "similarite" in mapping.columns:
+            rows[mapping["similarite"].fillna(1.0).to_numpy() < min_similarity] = -1
+        self._accounts = pd.Index(mapping[ACCOUNT_COL].astype(str))
+        self._rows = rows
+
+    @classmethod
+    def build(cls, ratio_file: str, accounts, index_file: str = None, min_similarity: float = 0.0) -> "MonetaryRatioIndex":
+        """
+        Construire (ou compléter) l'index des comptes. S'il existe, `index_file` (CSV COMPTE.LIB, FE.RM.ID) fait foi :
+        il peut être corrigé à la main, seuls les comptes absents sont calculés, puis il est réécrit.
+        """
+        logger = logging.getLogger('Bilan Carbone CHU')
+        ratios = load_data(ratio_file).dropna(subset=[RATIO_ID])
+        ratios[RATIO_ID] = ratios[RATIO_ID].astype(np.int64)
+
+        mapping = None
+        if index_file and os.path.exists(index_file):
+            mapping = pd.read_csv(index_file).drop_duplicates(subset=ACCOUNT_COL)
+        known = set(mapping[ACCOUNT_COL].astype(str)) if mapping is not None else set()
+        missing = sorted({str(a) for a in accounts} - known)
+
+        if missing:
+            logger.info(f"Index des ratios monétaires : {len(missing)} comptes à rattacher...")
+            new_rows = _match_accounts(missing, ratios)
+            mapping = new_rows if mapping is None else pd.concat([mapping, new_rows], ignore_index=True)
+            if index_file:
+                os.makedirs(os.path.dirname(index_file), exist_ok=True)
+                mapping.to_csv(index_file, index=False)
+                logger.info(f"Index des ratios monétaires enregistré dans {index_file}")
+        return cls(ratios, mapping, min_similarity=min_similarity)
+
+    def lookup(self, accounts) -> np.ndarray:
+        """
+        Ligne du ratio (dans self.ratios) de chaque compte, -1 si le compte n'a pas de ratio.
+        """
+        pos = self._accounts.get_indexer(pd.Index(accounts).astype(str))
+        return np.where(pos >= 0, self._rows[np.maximum(pos, 0)], -1)
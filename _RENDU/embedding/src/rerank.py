@@ -0,0 +1,141 @@
+import os
+import json
+import time
+import logging
+import numpy as np
+
+# Re-classement optionnel des top-k candidats du Matcher par un cross-encoder (paires requête, candidat).
+# Seules les paires des top-k sont évaluées : coût en requêtes x k, sans réencoder tout le corpus avec un
+# plus gros modèle. Un budget (nombre de paires, durée) borne le calcul d'une exécution ; les requêtes les
+# plus incertaines (plus faible écart entre les deux premiers scores hybrides) passent en premier.
+
+DEFAULT_RERANK_MODEL = "cross-encoder/mmarco-mMiniLMv2-L12-H384-v1" # Multilingue (libellés en français)
+
+
+class CrossEncoderReranker:
+    def __init__(self, model_name: str = DEFAULT_RERANK_MODEL, cache_file: str = "rerank_cache.json", max_length: int = 128):
+        """
+        Cross-encoder HuggingFace (AutoModelForSequenceClassification), exécuté sur CPU.
+        cache_file : scores déjà calculés, par paire de textes (None : cache en mémoire seulement).
+        """
+        import torch
+        from transformers import AutoTokenizer, AutoModelForSequenceClassification
+
+        self.logger = logging.getLogger('Bilan Carbone CHU')
+        self.torch = torch
+        self.max_length = max_length
+        self.logger.info(f"Chargement du cross-encoder {model_name}...")
+        self.tokenizer = AutoTokenizer.from_pretrained(model_name)
+        self.model = AutoModelForSequenceClassification.from_pretrained(model_name)
+        self.model.eval()
+        self.cache_file = cache_file
+        self.cache = self._load_cache()
+
+    def _load_cache(self) -> dict:
+        if self.cache_file and os.path.exists(self.cache_file):
+            try:
+                with open(self.cache_file, 'r', encoding='utf-8') as f:
+                    return json.load(f)
+            except Exception as e:
+                self.logger.warning(f"Impossible de charger le cache du re-classement: {e}. Nouveau cache créé.")
+        return {}
+
+    def _save_cache(self):
+        if not self.cache_file:
+            return
+        try:
+            with open(self.cache_file, 'w', encoding='utf-8') as f:
+                json.dump(self.cache, f, ensure_ascii=False)
+        except Exception as e:
+            self.logger.error(f"Erreur lors de la sauvegarde du cache du re-classement: {e}")
+
+    @staticmethod
+    def _key(query: str, candidate: str) -> str:
+        return f"{query}\t{candidate}"
+
+    def score_pairs(self, pairs: list[tuple[str, str]], batch_size: int = 32) -> np.ndarray:
+        """
+        Score de pertinence (logit) de chaque paire (requête, candidat), par lots ; les paires en cache ne
+        sont pas recalculées.
+        """
+        keys = [self._key(q, c) for q, c in pairs]
+        missing = list(dict.fromkeys(k for k in keys if k not in self.cache))
+        for start in range(0, len(missing), batch_size):
+            batch = [k.split("\t", 1) for k in missing[start:start + batch_size]]
+            inputs = self.tokenizer([q for q, _ in batch], [c for _, c in batch], padding=True, truncation=True,
+                                    max_length=self.max_length, return_tensors="pt")
+            with self.torch.no_grad():
+                logits = self.model(**inputs).logits
+            # Un seul logit (pertinence) ou deux classes (non pertinent / pertinent)
+            scores = logits[:, 0] if logits.shape[1] == 1 else logits[:, -1] - logits[:, 0]
+            self.cache.update(zip(missing[start:start + batch_size], scores.float().tolist()))
+        return np.array([self.cache[k] for k in keys], dtype=np.float32)
+
+    def _within_budget(self, queries, target_texts, top_indices, block: np.ndarray, budget: int) -> np.ndarray:
+        # Requêtes du bloc (dans l'ordre) dont les paires hors cache tiennent dans le budget restant
+        kept, seen, n_new = [], set(), 0
+        for q in block:
+            keys = {self._key(queries[q], target_texts[t]) for t in top_indices[q]} - seen
+            new = sum(k not in self.cache for k in keys)
+            if n_new + new > budget:
+                continue
+            kept.append(q)
+            seen |= keys
+            n_new += new
+        return np.array(kept, dtype=block.dtype)
+
+    def rerank(self, queries: list[str], target_texts: list[str], top_scores: np.ndarray, top_indices: np.ndarray,
+               max_pairs: int = None, time_budget: float = None, batch_size: int = 32) -> tuple[np.ndarray, np.ndarray, np.ndarray, dict]:
+        """
+        Re-classer les top-k de chaque requête (sorties de Matcher.match) selon le cross-encoder.
+        Budget : au plus max_pairs paires calculées (hors cache) et time_budget secondes. Les requêtes sont traitées
+        de la plus incertaine à la plus sûre ; une requête dont les paires dépassent ce qui reste du budget garde
+        l'ordre hybride, mais les suivantes qui tiennent (paires en cache, ou moins de paires) sont re-classées.
+        Une fois time_budget écoulé, les requêtes restantes gardent l'ordre hybride.
+        Renvoie (top_scores, top_indices) réordonnés (scores hybrides d'origine), les scores du cross-encoder
+        (NaN pour les requêtes non re-classées) et un rapport.
+        """
+        start = time.perf_counter()
+        top_scores, top_indices = np.array(top_scores), np.array(top_indices)
+        k = top_indices.shape[1]
+        ce_scores = np.full(top_indices.shape, np.nan, dtype=np.float32)
+        margin = top_scores[:, 0] - top_scores[:, 1] if k > 1 else np.zeros(len(queries))
+        order = np.argsort(margin, kind='stable')
+
+        n_cached_before = len(self.cache)
+        computed, reranked, changed = 0, 0, 0
+        # Blocs de requêtes : un appel au modèle par bloc, budget vérifié entre les blocs
+        per_block = max(1, batch_size // k)
+        for block_start in range(0, len(order), per_block):
+            if time_budget is not None and time.perf_counter() - start > time_budget:
+                break
+            block = order[block_start:block_start + per_block]
+            if max_pairs is not None:
+                block = self._within_budget(queries, target_texts, top_indices, block, max_pairs - computed)
+                if len(block) == 0:
+                    continue
+            pairs = [(queries[q], target_texts[t]) for q in block for t in top_indices[q]]
+            to_compute = sum(self._key(*p) not in self.cache for p in set(pairs))
+            scores = self.score_pairs(pairs, batch_size=batch_size).reshape(len(block), k)
+            computed += to_compute
+
+            new_order = np.argsort(-scores, axis=1, kind='stable')
+            changed += int((new_order[:, 0] != 0).sum())
+            ce_scores[block] = np.take_along_axis(scores, new_order, axis=1)
+            top_indices[block] = np.take_along_axis(top_indices[block], new_order, axis=1)
+            top_scores[block] = np.take_along_axis(top_scores[block], new_order, axis=1)
+            reranked += len(block)
+
+        if len(self.cache) > n_cached_before:
+            self._save_cache()
+        report = {
+            'queries': len(queries),
+            'reranked': reranked,
+            'top1_changed': changed,
+            'pairs_computed': computed,
+            'pairs_cached': reranked * k - computed,
+            'elapsed_s': time.perf_counter() - start,
+        }
+        self.logger.info(f"Re-classement : {reranked}/{len(queries)} requêtes, {computed} paires calculées, "
+                         f"{report['pairs_cached']} en cache, top-1 modifié pour {changed} ({report['elapsed_s']:.1f}s)")
+        return top_scores, top_indices, ce_scores, report
@@ -0,0 +1,227 @@
+import json
+import time
+import queue
+import logging
+import threading
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+from src.preprocess import TextPreprocessor
+
+# Service local de matching : le modèle d'embedding et le Matcher ajusté sur les facteurs ADEME restent
+# chargés en mémoire. Les requêtes concurrentes sont regroupées en micro-lots (taille maximale, attente
+# maximale du premier arrivé) : un seul passage du modèle et un seul match() par lot.
+#
+#   POST /match   {"texts": ["..."], "k": 5}  ->  {"results": [[{"id", "text", "score"}, ...], ...]}
+#   GET  /metrics  compteurs, taille moyenne des lots, latences p50 / p99 (ms)
+#   GET  /health
+
+
+class _Pending:
+    __slots__ = ("texts", "k", "submitted", "done", "result", "error")
+
+    def __init__(self, texts: list[str], k: int):
+        self.texts = texts
+        self.k = k
+        self.submitted = time.perf_counter()
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class MatchingService:
+    def __init__(self, model, matcher, max_batch: int = 64, max_wait_ms: float = 10.0, max_k: int = 20,
+                 latency_window: int = 10000):
+        """
+        model : EmbeddingModel (ou tout objet ayant get_embeddings) ; matcher : Matcher déjà ajusté sur les cibles
+        (fit avec target_ids et target_texts). Identifiants et textes des résultats sont lus dans le matcher :
+        ils suivent ses upsert() / remove().
+        Un lot part dès qu'il contient max_batch textes ou que sa première requête attend depuis max_wait_ms.
+        """
+        self.logger = logging.getLogger('Bilan Carbone CHU')
+        self.model = model
+        self.matcher = matcher
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000
+        self.max_k = max_k
+        self.preprocessor = TextPreprocessor()
+        self._queue = queue.Queue()
+        self._worker = None
+        self._stopping = threading.Event()
+        # Métriques : latences (de la soumission à la réponse) sur une fenêtre glissante ; le verrou protège
+        # aussi la file à l'arrêt (aucune requête ajoutée après la vidange de stop())
+        self._lock = threading.Lock()
+        self._latencies = deque(maxlen=latency_window)
+        self._batch_sizes = deque(maxlen=latency_window)
+        self.n_requests = 0
+        self.n_texts = 0
+        self.n_errors = 0
+
+    def start(self):
+        self._stopping.clear()
+        self._worker = threading.Thread(target=self._batch_loop, name="matching-batcher", daemon=True)
+        self._worker.start()
+        return self
+
+    def stop(self):
+        self._stopping.set()
+        if self._worker is not None:
+            self._worker.join()
+        # Requêtes encore en file : échec immédiat plutôt qu'une attente jusqu'au timeout de submit()
+        with self._lock:
+            self._worker = None
+            while True:
+                try:
+                    pending = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                pending.error = RuntimeError("Service de matching arrêté.")
+                pending.done.set()
+
+    def submit(self, texts: list[str], k: int = 5, timeout: float = 60.0) -> list[list[dict]]:
+        """
+        Top-k facteurs de chaque texte (bloquant, depuis n'importe quel thread).
+        """
+        if not texts:
+            return []
+        pending = _Pending([str(t) for t in texts], max(1, min(int(k), self.max_k)))
+        with self._lock:
+            if self._worker is None:
+                raise RuntimeError("Service de matching arrêté.")
+            self._queue.put(pending)
+        if not pending.done.wait(timeout):
+            raise TimeoutError("Pas de réponse du service de matching dans le délai imparti.")
+        if pending.error is not None:
+            raise pending.error
+        return pending.result
+
+    def _collect(self) -> list[_Pending]:
+        # Premier élément : attente sans délai ; les suivants jusqu'à max_batch textes ou l'échéance
+        try:
+            batch = [self._queue.get(timeout=0.1)]
+        except queue.Empty:
+            return []
+        n_texts = len(batch[0].texts)
+        deadline = batch[0].submitted + self.max_wait
+        while n_texts < self.max_batch:
+            remaining = deadline - time.perf_counter()
+            try:
+                item = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            batch.append(item)
+            n_texts += len(item.texts)
+        return batch
+
+    def _batch_loop(self):
+        while not self._stopping.is_set():
+            batch = self._collect()
+            if batch:
+                self._process(batch)
+
+    def _process(self, batch: list[_Pending]):
+        texts = [t for p in batch for t in p.texts]
+        try:
+            cleaned = self.preprocessor.preprocess_batch(texts)
+            embeddings = self.model.get_embeddings(cleaned, batch_size=max(1, len(cleaned)), normalize=True, progress=False)
+            scores, indices = self.matcher.match(embeddings, source_texts=cleaned, k=max(p.k for p in batch), normalized=True)
+            ids = self.matcher.ids_of(indices).tolist()
+            target_texts = self.matcher.target_texts
+        except Exception as e:
+            self.logger.error(f"Erreur du service de matching sur un lot de {len(texts)} textes : {e}")
+            for p in batch:
+                p.error = e
+                p.done.set()
+            with self._lock:
+                self.n_errors += len(batch)
+            return
+
+        start = 0
+        now = time.perf_counter()
+        for p in batch:
+            rows = slice(start, start + len(p.texts))
+            p.result = [
+                [{"id": target_id, "text": target_texts[j] if target_texts is not None else None, "score": float(s)}
+                 for s, j, target_id in zip(row_scores[:p.k], row_indices[:p.k], row_ids[:p.k])]
+                for row_scores, row_indices, row_ids in zip(scores[rows].tolist(), indices[rows].tolist(), ids[rows])
+            ]
+            start += len(p.texts)
+            p.done.set()
+        with self._lock:
+            self._latencies.extend(now - p.submitted for p in batch)
+            self._batch_sizes.append(len(texts))
+            self.n_requests += len(batch)
+            self.n_texts += len(texts)
+
+    def metrics(self) -> dict:
+        with self._lock:
+            latencies = np.array(self._latencies) * 1000
+            batch_sizes = np.array(self._batch_sizes)
+            counts = {"requests": self.n_requests, "texts": self.n_texts, "errors": self.n_errors}
+        if len(latencies) == 0:
+            return {**counts, "batches": 0}
+        p50, p99 = np.percentile(latencies, [50, 99])
+        return {**counts, "batches": len(batch_sizes), "mean_batch_size": float(batch_sizes.mean()),
+                "latency_p50_ms": float(p50), "latency_p99_ms": float(p99), "latency_max_ms": float(latencies.max())}
+
+
+def _make_handler(service: MatchingService):
+    class MatchingHandler(BaseHTTPRequestHandler):
+        def _send_json(self, status: int, payload: dict):
+            body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path == "/metrics":
+                self._send_json(200, service.metrics())
+            elif self.path == "/health":
+                self._send_json(200, {"status": "ok", "targets": int(service.matcher.active.sum())})
+            else:
+                self._send_json(404, {"error": f"Chemin inconnu : {self.path}"})
+
+        def do_POST(self):
+            if self.path != "/match":
+                self._send_json(404, {"error": f"Chemin inconnu : {self.path}"})
+                return
+            try:
+                payload = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+                texts = payload["texts"] if "texts" in payload else [payload["text"]]
+                if not isinstance(texts, list):
+                    raise ValueError("'texts' doit être une liste")
+                k = int(payload.get("k", 5))
+            except (ValueError, KeyError, TypeError) as e:
+                self._send_json(400, {"error": f"Requête invalide : {e}"})
+                return
+            try:
+                self._send_json(200, {"results": service.submit(texts, k=k)})
+            except Exception as e:
+                self._send_json(500, {"error": str(e)})
+
+        def log_message(self, format, *args):
+            pass
+
+    return MatchingHandler
+
+
+class _MatchingHTTPServer(ThreadingHTTPServer):
+    # File des connexions en attente (5 par défaut) : une rafale de clients concurrents serait refusée
+    # (connexion réinitialisée) avant même d'atteindre la file de micro-batching
+    request_queue_size = 128
+    daemon_threads = True
+
+
+def start_server(service: MatchingService, host: str = "127.0.0.1", port: int = 8000) -> ThreadingHTTPServer:
+    """
+    Démarrer le service et son serveur HTTP dans des threads (port=0 : port libre choisi par le système).
+    L'adresse réelle est server.server_address ; server.shutdown() puis service.stop() pour arrêter.
+    """
+    service.start()
+    server = _MatchingHTTPServer((host, port), _make_handler(service))
+    threading.Thread(target=server.serve_forever, name="matching-http", daemon=True).start()
+    return server
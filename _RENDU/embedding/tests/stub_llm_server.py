@@ -0,0 +1,40 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Serveur de substitution compatible OpenAI (/v1/completions) sur localhost : utilisé par les tests du
+# backend 'server' et par `benchmark.py llm-backends --stub-server` (surcoût client / plomberie seul).
+
+FAIL_MARKER = "ECHEC" # Un lot contenant ce mot renvoie une erreur HTTP 500
+
+
+class _StubCompletionHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        payload = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        prompts = payload["prompt"] if isinstance(payload["prompt"], list) else [payload["prompt"]]
+        self.server.requests.append(payload)
+        if any(FAIL_MARKER in p for p in prompts):
+            self.send_error(500, "Erreur simulée")
+            return
+        # Réponse factice : on renvoie la description du prompt, choix dans l'ordre inverse (champ index)
+        choices = [{"index": i, "text": " " + p.split("Description : '")[-1].split("'")[0]} for i, p in enumerate(prompts)]
+        body = json.dumps({"object": "text_completion", "choices": choices[::-1]}).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_stub_server() -> tuple[ThreadingHTTPServer, str]:
+    """
+    Démarrer le serveur sur un port libre ; server.requests garde les corps des requêtes reçues.
+    Renvoie (server, url de base) ; server.shutdown() pour l'arrêter.
+    """
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _StubCompletionHandler)
+    server.requests = []
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
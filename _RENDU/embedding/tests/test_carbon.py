@@ -0,0 +1,70 @@
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+import scipy.sparse as sp
+
+# Même import que app.py : le package src est relatif au dossier embedding
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.carbon import aggregate_emissions, monte_carlo_totals, relative_uncertainty
+
+
+def _case():
+    # 6 lignes, 3 facteurs, 2 groupes (lignes 0-2 et 3-5)
+    base = np.array([10.0, 20.0, 5.0, 40.0, 1.0, 8.0])
+    factor_idx = np.array([0, 1, 0, 2, 2, 1])
+    sigma = np.array([0.3, 0.1, 0.3, 0.5, 0.5, 0.1])
+    membership = sp.csr_matrix((np.ones(6), (np.arange(6), [0, 0, 0, 1, 1, 1])), shape=(6, 2))
+    return base, sigma, membership, factor_idx
+
+
+@pytest.mark.parametrize("correlated", [False, True])
+def test_monte_carlo_mean_is_central_total(correlated):
+    base, sigma, membership, factor_idx = _case()
+    totals = monte_carlo_totals(base, sigma, membership, n_samples=200000,
+                                factor_idx=factor_idx if correlated else None)
+    assert totals.shape == (200000, 2)
+    # Loi log-normale de même moyenne : la moyenne des tirages est l'émission centrale
+    np.testing.assert_allclose(totals.mean(axis=0), membership.T @ base, rtol=5e-3)
+    assert (totals > 0).all()
+
+
+def test_monte_carlo_is_invariant_to_chunking():
+    base, sigma, membership, factor_idx = _case()
+    for idx in (None, factor_idx):
+        whole = monte_carlo_totals(base, sigma, membership, n_samples=1000, factor_idx=idx, seed=4)
+        # Blocs de 7 échantillons (4 octets x 3 ou 6 tirages par échantillon)
+        chunked = monte_carlo_totals(base, sigma, membership, n_samples=1000, factor_idx=idx, seed=4,
+                                     max_chunk_bytes=7 * 4 * (3 if idx is not None else 6))
+        np.testing.assert_allclose(chunked, whole, rtol=1e-6)
+
+
+def test_correlated_errors_widen_the_spread():
+    base, sigma, membership, factor_idx = _case()
+    independent = monte_carlo_totals(base, sigma, membership, n_samples=50000)
+    correlated = monte_carlo_totals(base, sigma, membership, n_samples=50000, factor_idx=factor_idx)
+    assert (correlated.std(axis=0) > independent.std(axis=0)).all()
+    # Sans incertitude, chaque tirage vaut le total central
+    certain = monte_carlo_totals(base, np.zeros(6), membership, n_samples=10)
+    np.testing.assert_allclose(certain, np.tile(membership.T @ base, (10, 1)), rtol=1e-6)
+
+
+def test_aggregate_emissions_by_group():
+    purchases = pd.DataFrame({
+        'COMPTE.LIB': ['gants', 'gants', 'papier', None],
+        'QTE': ['2', 3, 10, 1],
+    })
+    result = aggregate_emissions(purchases, np.array([0, 0, 1, -1]), fe_val=[1.5, 0.2], fe_unc=[80, np.nan],
+                                 by=['COMPTE.LIB'], quantity_col='QTE', n_samples=2000)
+    by_account = result['COMPTE.LIB'].set_index('COMPTE.LIB')
+    # La ligne sans facteur (-1) est ignorée
+    assert by_account['nb_lignes'].to_dict() == {'gants': 2, 'papier': 1}
+    assert by_account['emissions_kgCO2e'].to_dict() == pytest.approx({'gants': 7.5, 'papier': 2.0})
+    # Facteur sans incertitude : aucun écart
+    assert by_account.loc['papier', 'mc_ecart_type'] == pytest.approx(0, abs=1e-5)
+    assert by_account.loc['gants', 'ic95_bas'] < 7.5 < by_account.loc['gants', 'ic95_haut']
+    assert result['TOTAL']['emissions_kgCO2e'].tolist() == pytest.approx([9.5])
+    np.testing.assert_allclose(relative_uncertainty([80, 0.2, np.nan]), [0.8, 0.2, 0.0])
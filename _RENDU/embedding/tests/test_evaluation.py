@@ -0,0 +1,63 @@
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+# Même import que app.py : le package src est relatif au dossier embedding
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.evaluation import evaluate, load_labels, retrieval_metrics, top1_agreement, truth_ranks
+
+# 4 requêtes, top-5 : cible au rang 1, au rang 3, au rang 5, absente
+INDICES = np.array([
+    [7, 1, 2, 3, 4],
+    [0, 1, 7, 3, 4],
+    [0, 1, 2, 3, 7],
+    [0, 1, 2, 3, 4],
+])
+TRUTH = np.array([7, 7, 7, 9])
+
+
+def test_truth_ranks():
+    assert truth_ranks(INDICES, TRUTH).tolist() == [1, 3, 5, 0]
+
+
+def test_retrieval_metrics_on_hand_made_case():
+    metrics = retrieval_metrics(INDICES, TRUTH, ks=(1, 3, 5, 10))
+    # k = 10 dépasse les top-5 disponibles : pas de recall@10
+    assert metrics == pytest.approx({
+        "recall@1": 0.25,
+        "recall@3": 0.5,
+        "recall@5": 0.75,
+        "mrr": (1 + 1 / 3 + 1 / 5 + 0) / 4,
+    })
+
+
+def test_top1_agreement_and_evaluate():
+    # Seconde configuration : la requête 0 perd sa cible, la requête 1 la remonte au rang 1
+    other = INDICES.copy()
+    other[0, 0], other[1, 0] = 1, 7
+    agreement = top1_agreement({"dense": INDICES, "hybride": other})
+    assert agreement.loc["dense", "hybride"] == 0.5 and agreement.loc["hybride", "hybride"] == 1.0
+
+    configs = {"dense": lambda: (None, INDICES), "hybride": lambda: (None, other)}
+    report, _ = evaluate(configs, TRUTH, k=5, reference="dense")
+    assert report.loc["dense", "recall@1"] == 0.25 and report.loc["hybride", "recall@1"] == 0.25
+    assert report.loc["hybride", "recall@5"] == 0.5
+    assert report.loc["hybride", "mrr"] == pytest.approx((1 + 1 / 5) / 4)
+    assert report["accord_top1_dense"].tolist() == [1.0, 0.5]
+    assert (report["duree_s"] >= 0).all()
+
+
+def test_load_labels_maps_ids_to_rows(tmp_path):
+    path = tmp_path / "labels.csv"
+    pd.DataFrame({
+        "PRODUIT.ID": [101, 102, 102, 103, 104],
+        "FE.ADEME.ID": ["A", "B", "C", "Z", "A"],
+    }).to_csv(path, index=False)
+    # Identifiants comparés en texte ; 102 annoté deux fois (première paire gardée), Z et 104 inconnus
+    source_rows, target_rows = load_labels(str(path), ["103", "102", "101"], ["B", "A", "C", "A"])
+    assert source_rows.tolist() == [2, 1]
+    assert target_rows.tolist() == [1, 0]
@@ -0,0 +1,62 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+# Même import que app.py : le package src est relatif au dossier embedding
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+pytest.importorskip("torch")
+transformers = pytest.importorskip("transformers")
+pytest.importorskip("tqdm")
+from src.inference import EmbeddingModel, _progress_path, get_embeddings_sharded
+
+WORDS = ["papier", "gants", "nitrile", "seringue", "sterile", "blouse", "coton", "ecran", "clavier", "souris"]
+TEXTS = [" ".join(WORDS[(i * k) % len(WORDS)] for k in (1, 3, 7)) for i in range(23)]
+
+
+@pytest.fixture(scope="module")
+def tiny_model(tmp_path_factory):
+    # Petit BERT aléatoire enregistré en local : pas de téléchargement, mêmes poids dans chaque worker
+    path = tmp_path_factory.mktemp("tiny-bert")
+    vocab = path / "vocab.txt"
+    vocab.write_text("\n".join(["[PAD]", "[UNK]", "[CLS]", "[SEP]", "[MASK]"] + WORDS), encoding="utf-8")
+    transformers.BertTokenizer(str(vocab)).save_pretrained(str(path))
+    config = transformers.BertConfig(vocab_size=len(WORDS) + 5, hidden_size=16, num_hidden_layers=1,
+                                     num_attention_heads=2, intermediate_size=32)
+    transformers.BertModel(config).save_pretrained(str(path))
+    return str(path)
+
+
+def test_sharded_embeddings_and_resume(tiny_model, tmp_path):
+    output_path = str(tmp_path / "emb.npy")
+    params = dict(model_name=tiny_model, pooling="mean", batch_size=4, normalize=True)
+    sharded = get_embeddings_sharded(TEXTS, output_path, num_workers=2, **params)
+    reference = EmbeddingModel(tiny_model, pooling="mean").get_embeddings(TEXTS, batch_size=4, normalize=True, progress=False)
+    assert sharded.shape == (23, 16)
+    np.testing.assert_allclose(sharded, reference, rtol=1e-4, atol=1e-5)
+    assert np.load(_progress_path(output_path)).all()
+    del sharded
+
+    # Calcul interrompu : lots 1, 2 et 5 (dernier lot, incomplet) non marqués ; lot 0 marqué, avec une
+    # valeur témoin qui ne doit pas être recalculée
+    output = np.load(output_path, mmap_mode='r+')
+    done = np.load(_progress_path(output_path), mmap_mode='r+')
+    output[4:12] = 0
+    output[20:] = 0
+    output[0] = 7.0
+    done[[1, 2, 5]] = False
+    output.flush()
+    done.flush()
+    del output, done
+
+    # Reprise avec un autre nombre de workers
+    resumed = get_embeddings_sharded(TEXTS, output_path, num_workers=3, **params)
+    np.testing.assert_allclose(resumed[1:], reference[1:], rtol=1e-4, atol=1e-5)
+    assert (resumed[0] == 7.0).all()
+    assert np.load(_progress_path(output_path)).all()
+
+    # Textes différents : pas de reprise, tout est recalculé
+    changed = get_embeddings_sharded(TEXTS[:-1] + ["papier"], output_path, num_workers=1, **params)
+    np.testing.assert_allclose(changed[:-1], reference[:-1], rtol=1e-4, atol=1e-5)
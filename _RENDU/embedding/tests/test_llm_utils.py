@@ -0,0 +1,147 @@
+import os
+import sys
+import json
+import urllib.error
+
+import pytest
+
+# Même import que app.py : le package src est relatif au dossier embedding
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+pytest.importorskip("tqdm")
+from src.llm_utils import LLMBackend, LLMRefiner, OpenAIServerBackend, make_backend
+from tests.stub_llm_server import FAIL_MARKER, start_stub_server
+
+
+@pytest.fixture
+def stub_server():
+    server, url = start_stub_server()
+    yield server, url
+    server.shutdown()
+    server.server_close()
+
+
+def test_backend_interface_is_abstract():
+    with pytest.raises(TypeError):
+        LLMBackend()
+
+
+def test_server_backend_sends_one_request_per_batch(stub_server):
+    server, url = stub_server
+    backend = OpenAIServerBackend(url, model_name="stub")
+    prompts = [f"Description : 'produit {i}'\nRéponse :" for i in range(5)]
+    # Choix renvoyés dans le désordre : remis dans l'ordre des prompts (champ index)
+    assert backend.generate(prompts, max_new_tokens=12) == [f" produit {i}" for i in range(5)]
+    assert len(server.requests) == 1
+    assert server.requests[0]["prompt"] == prompts
+    assert server.requests[0]["max_tokens"] == 12
+    assert server.requests[0]["temperature"] == 0
+    assert server.requests[0]["model"] == "stub"
+
+
+def test_refiner_batches_and_caches(stub_server, tmp_path):
+    server, url = stub_server
+    refiner = LLMRefiner(cache_file=str(tmp_path / "cache.json"), backend="server", server_url=url)
+    texts = [f"gants nitrile {i}" for i in range(10)]
+    assert refiner.refine_batch(texts, batch_size=4) == texts
+    assert [len(r["prompt"]) for r in server.requests] == [4, 4, 2]
+    # Deuxième passage : tout vient du cache
+    assert refiner.refine_batch(texts, batch_size=4) == texts
+    assert len(server.requests) == 3
+
+
+def test_make_backend_selection(stub_server, tmp_path):
+    _, url = stub_server
+    backend = make_backend("server", model_name="stub", server_url=url + "/")
+    assert isinstance(backend, OpenAIServerBackend)
+    assert backend.url == url + "/v1/completions"
+    assert make_backend("server").url == "http://127.0.0.1:8080/v1/completions"
+    with pytest.raises(ValueError):
+        make_backend("inconnu")
+    refiner = LLMRefiner(cache_file=str(tmp_path / "cache.json"), backend=backend)
+    assert refiner.backend is backend
+
+
+def test_server_errors(stub_server, tmp_path):
+    server, url = stub_server
+    backend = OpenAIServerBackend(url)
+    with pytest.raises(urllib.error.HTTPError):
+        backend.generate([f"Description : '{FAIL_MARKER}'"])
+    # Lot en erreur : texte d'origine conservé, les autres lots sont raffinés et mis en cache
+    refiner = LLMRefiner(cache_file=str(tmp_path / "cache.json"), backend=backend)
+    texts = ["papier a4", f"{FAIL_MARKER} seringue", "blouse", "gants"]
+    assert refiner.refine_batch(texts, batch_size=2) == texts
+    assert f"{FAIL_MARKER} seringue" not in refiner.cache
+    assert refiner.cache["blouse"] == "blouse"
+    # Serveur injoignable
+    with pytest.raises(urllib.error.URLError):
+        OpenAIServerBackend("http://127.0.0.1:9", timeout=2).generate(["x"])
+
+
+class ScriptedBackend(LLMBackend):
+    """
+    Backend en mémoire : renvoie le texte de chaque prompt en majuscules et garde la taille des lots reçus.
+    Echoue (comme un manque de mémoire) au-delà de `max_batch` prompts ou sur un texte contenant `fail_marker`,
+    et s'interrompt à l'appel numéro `interrupt_at` (à partir de 0).
+    """
+    def __init__(self, max_batch=None, fail_marker=FAIL_MARKER, interrupt_at=None):
+        self.max_batch = max_batch
+        self.fail_marker = fail_marker
+        self.interrupt_at = interrupt_at
+        self.batch_sizes = []
+
+    def generate(self, prompts, max_new_tokens=50):
+        if self.interrupt_at is not None and len(self.batch_sizes) == self.interrupt_at:
+            raise KeyboardInterrupt
+        self.batch_sizes.append(len(prompts))
+        if self.max_batch is not None and len(prompts) > self.max_batch:
+            raise RuntimeError("CUDA out of memory")
+        texts = [p.split("Description : '")[-1].split("'")[0] for p in prompts]
+        if self.fail_marker and any(self.fail_marker in t for t in texts):
+            raise RuntimeError("génération impossible")
+        return [" " + t.upper() for t in texts]
+
+
+def test_job_retries_by_halving(tmp_path):
+    backend = ScriptedBackend(max_batch=2)
+    refiner = LLMRefiner(cache_file=str(tmp_path / "cache.json"), backend=backend)
+    texts = ["papier", "gants", "blouse", "coton", "ecran", f"{FAIL_MARKER} clavier", "souris", "gants"]
+    result = refiner.refine_job(texts, batch_size=8)
+
+    # 7 textes uniques : 7 -> 4 -> 2 + 2, puis 3 -> 2 (échec sur le marqueur) -> 1 + 1, et 1
+    assert backend.batch_sizes == [7, 4, 2, 2, 3, 2, 1, 1, 1]
+    assert result == [t.upper() for t in texts[:5]] + [f"{FAIL_MARKER} clavier", "SOURIS", "GANTS"]
+    # Texte en échec non mis en cache (retenté au prochain job), journal supprimé après consolidation
+    assert f"{FAIL_MARKER} clavier" not in refiner.cache
+    assert not os.path.exists(tmp_path / "cache_journal.jsonl")
+    with open(tmp_path / "cache.json", encoding="utf-8") as f:
+        assert json.load(f)["souris"] == "SOURIS"
+
+
+def test_job_resumes_from_journal(tmp_path):
+    cache_file = str(tmp_path / "cache.json")
+    journal_file = tmp_path / "cache_journal.jsonl"
+    texts = [f"{FAIL_MARKER} papier", "gants", "blouse", "coton", "ecran", "souris"]
+
+    # Interruption au troisième lot (appel 4 : le premier lot, en échec, est retenté par textes seuls) :
+    # les deux premiers lots sont journalisés, rien n'est consolidé
+    first = ScriptedBackend(interrupt_at=4)
+    with pytest.raises(KeyboardInterrupt):
+        LLMRefiner(cache_file=cache_file, backend=first).refine_job(texts, batch_size=2)
+    assert not os.path.exists(cache_file)
+    entries = [json.loads(line) for line in journal_file.read_text(encoding="utf-8").splitlines()]
+    assert [e["batch"] for e in entries] == [0, 1]
+    assert entries[0]["failed"] == [f"{FAIL_MARKER} papier"]
+    # Crash pendant l'écriture d'une ligne : ligne tronquée ignorée à la reprise
+    with open(journal_file, "a", encoding="utf-8") as f:
+        f.write('{"batch": 2, "results": [["ecr')
+
+    second = ScriptedBackend(fail_marker=None)
+    refiner = LLMRefiner(cache_file=cache_file, backend=second)
+    result = refiner.refine_job(texts, batch_size=2)
+    # Seuls le texte en échec et le lot interrompu sont recalculés
+    assert second.batch_sizes == [2, 1]
+    assert result == [t.upper() for t in texts]
+    assert not journal_file.exists()
+    with open(cache_file, encoding="utf-8") as f:
+        assert len(json.load(f)) == len(texts)
@@ -0,0 +1,126 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+# Même import que app.py : le package src est relatif au dossier embedding
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+pytest.importorskip("faiss")
+pytest.importorskip("sklearn")
+from src.matching import Matcher
+
+
+def _unit(rows):
+    rows = np.asarray(rows, dtype=np.float32)
+    return rows / np.linalg.norm(rows, axis=1, keepdims=True)
+
+
+TEXTS = ["papier ramette a4", "gants nitrile", "seringue sterile", "blouse coton"]
+
+
+@pytest.fixture
+def matcher():
+    matcher = Matcher(use_faiss=True, alpha=0.5)
+    matcher.fit(_unit(np.eye(4, 8) + 0.01), target_texts=TEXTS, normalized=True, target_ids=["a", "b", "c", "d"])
+    return matcher
+
+
+def test_remove_then_upsert_reuses_slot(matcher):
+    query = _unit(np.eye(4, 8)[[1]])
+
+    assert matcher.remove(["b"]) == 1
+    _, indices = matcher.match(query, source_texts=["gants nitrile"], k=1)
+    assert matcher.ids_of(indices)[0, 0] != "b"
+    # Déjà supprimé : ignoré
+    assert matcher.remove(["b"]) == 0
+
+    stats = matcher.upsert(["b"], _unit(np.eye(4, 8)[[1]]), texts=["gants nitrile"], normalized=True)
+    assert stats == {'added': 1, 'replaced': 0}
+    assert matcher.target_ids == ["a", "b", "c", "d"]
+    assert len(matcher.active) == len(matcher.target_embeddings) == 4
+    assert matcher.active.all()
+    assert matcher.index.ntotal == 4
+
+    _, indices = matcher.match(query, source_texts=["gants nitrile"], k=1)
+    assert indices[0, 0] == 1
+    assert matcher.ids_of(indices)[0, 0] == "b"
+
+
+def test_upsert_growth_keeps_mask_aligned(matcher):
+    for i in range(10):
+        matcher.upsert([f"new{i}"], _unit(np.ones((1, 8)) + i), texts=[f"produit {i}"], normalized=True)
+    matcher.remove(["new3"])
+
+    assert len(matcher.active) == len(matcher.target_embeddings) == len(matcher.target_ids) == 14
+    assert matcher.active.sum() == 13
+    assert matcher.ids_of(np.flatnonzero(~matcher.active)).tolist() == ["new3"]
+
+
+def _sweep_matcher(top_n_cache=6):
+    rng = np.random.default_rng(0)
+    texts = [" ".join(rng.choice(["papier", "gants", "seringue", "blouse", "coton", "nitrile", "a4", "sterile"], size=3))
+             for _ in range(40)]
+    matcher = Matcher(use_faiss=True, alpha=0.5, top_n_cache=top_n_cache)
+    matcher.fit(_unit(rng.normal(size=(40, 8))), target_texts=texts, normalized=True)
+    queries = _unit(rng.normal(size=(25, 8)))
+    query_texts = [" ".join(rng.choice(["papier", "gants", "seringue", "blouse", "coton"], size=2)) for _ in range(25)]
+    return matcher, queries, query_texts
+
+
+def test_sweep_at_main_alpha_matches_match():
+    pytest.importorskip("rank_bm25")
+    matcher, queries, query_texts = _sweep_matcher()
+    matcher.remove([3, 17])
+    scores, indices = matcher.match(queries, source_texts=query_texts, k=3)
+
+    results = matcher.sweep([0.2, matcher.alpha, 0.8], k=3, chunk_size=7)
+    assert list(results) == ["alpha=0.2", "alpha=0.5", "alpha=0.8", "rrf"]
+    sweep_scores, sweep_indices = results["alpha=0.5"]
+    np.testing.assert_array_equal(sweep_indices, indices)
+    np.testing.assert_allclose(sweep_scores, scores, rtol=1e-5)
+    # Lignes supprimées jamais proposées, quelle que soit la fusion
+    for _, top in results.values():
+        assert not np.isin(top, [3, 17]).any()
+
+    # Rangs en cache (doublons fusionnés) : chaque rang 0..N-1 des listes dense et BM25 une seule fois, dans
+    # l'ordre des scores, et aucun candidat hors liste au-dessus du dernier rang
+    c = matcher.candidates
+    for q in range(len(queries)):
+        valid = c['valid'][q]
+        assert len(set(c['indices'][q][valid].tolist())) == valid.sum()
+        for column, rank in (('dense', c['dense_rank'][q][valid]), ('sparse', c['sparse_rank'][q][valid])):
+            scores_q = c[column][q][valid]
+            listed = np.isfinite(rank)
+            assert sorted(rank[listed].tolist()) == list(range(6))
+            by_rank = scores_q[listed][np.argsort(rank[listed])]
+            assert (np.diff(by_rank) <= 0).all()
+            assert (scores_q[~listed] <= by_rank[-1]).all()
+
+    # alpha = 1 : classement purement dense, comme un match() dense
+    dense_only = Matcher(use_faiss=True, alpha=1.0)
+    dense_only.fit(matcher.target_embeddings, target_texts=matcher.target_texts, normalized=True)
+    dense_only.remove([3, 17])
+    np.testing.assert_array_equal(matcher.sweep([1.0], k=3)["alpha=1"][1], dense_only.match(queries, k=3)[1])
+
+
+def test_sweep_requires_cached_candidates():
+    matcher, queries, _ = _sweep_matcher(top_n_cache=0)
+    matcher.match(queries, k=1)
+    with pytest.raises(RuntimeError):
+        matcher.sweep([0.5])
+
+
+def test_bm25_after_updates_matches_fresh_fit(matcher):
+    rank_bm25 = pytest.importorskip("rank_bm25")
+    matcher.remove(["b"])
+    matcher.upsert(["e"], _unit(np.ones((1, 8))), texts=["gants latex"], normalized=True)
+    matcher.upsert(["c"], _unit(np.eye(4, 8)[[2]]), texts=["seringue luer"], normalized=True)
+
+    active_texts = [t for t, a in zip(matcher.target_texts, matcher.active) if a]
+    fresh = rank_bm25.BM25Okapi([t.lower().split() for t in active_texts])
+    for query in (["gants"], ["seringue", "luer"], ["papier", "coton"]):
+        scores = matcher.bm25.get_scores(query)
+        assert len(scores) == len(matcher.target_ids)
+        np.testing.assert_allclose(scores[matcher.active], fresh.get_scores(query))
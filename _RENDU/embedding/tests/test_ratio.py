@@ -0,0 +1,54 @@
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+# Même import que app.py : le package src est relatif au dossier embedding
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.ratio import MonetaryRatioIndex
+
+RATIOS = pd.DataFrame({
+    "FE.RM.ID": [10, 20, 30],
+    "FE.LIB2": ["Fournitures de bureau", "Produits pharmaceutiques", "Services informatiques"],
+    "FE.VAL": [120.0, 250.0, 90.0],
+})
+
+
+def test_lookup_uses_the_index():
+    mapping = pd.DataFrame({
+        "COMPTE.LIB": ["FOURNITURES BUREAU", "MEDICAMENTS", "DIVERS", "ANCIEN COMPTE"],
+        "FE.RM.ID": [10, 20, 30, 99],
+        "similarite": [0.9, 0.8, 0.1, 0.9],
+    })
+    index = MonetaryRatioIndex(RATIOS, mapping, min_similarity=0.3)
+    rows = index.lookup(["MEDICAMENTS", "FOURNITURES BUREAU", "DIVERS", "ANCIEN COMPTE", "INCONNU"])
+    # Similarité trop faible, ratio absent de la table et compte inconnu : pas de ratio
+    assert rows.tolist() == [1, 0, -1, -1, -1]
+    assert index.ratios["FE.VAL"].to_numpy()[rows[:2]].tolist() == [250.0, 120.0]
+    assert len(index.lookup([])) == 0
+
+
+def test_build_keeps_hand_corrections_and_adds_missing_accounts(tmp_path):
+    pytest.importorskip("sklearn")
+    ratio_file = tmp_path / "ratios.csv"
+    RATIOS.to_csv(ratio_file, index=False)
+    index_file = tmp_path / "processed" / "ratio_index.csv"
+    os.makedirs(index_file.parent)
+    # Correction à la main : ce compte est rattaché aux services informatiques, quelle que soit la similarité
+    pd.DataFrame({"COMPTE.LIB": ["FOURNITURES BUREAU"], "FE.RM.ID": [30]}).to_csv(index_file, index=False)
+
+    index = MonetaryRatioIndex.build(str(ratio_file), ["FOURNITURES BUREAU", "PRODUITS PHARMACEUTIQUES", "SERVICES INFORMATIQUES"],
+                                     index_file=str(index_file))
+    assert index.lookup(["FOURNITURES BUREAU", "PRODUITS PHARMACEUTIQUES", "SERVICES INFORMATIQUES"]).tolist() == [2, 1, 2]
+
+    # Index réécrit avec les comptes calculés ; un second build ne recalcule rien
+    saved = pd.read_csv(index_file)
+    assert saved["COMPTE.LIB"].tolist() == ["FOURNITURES BUREAU", "PRODUITS PHARMACEUTIQUES", "SERVICES INFORMATIQUES"]
+    assert saved["FE.RM.ID"].tolist() == [30, 20, 30]
+    RATIOS.assign(**{"FE.LIB2": ["x", "y", "z"]}).to_csv(ratio_file, index=False)
+    again = MonetaryRatioIndex.build(str(ratio_file), ["PRODUITS PHARMACEUTIQUES"], index_file=str(index_file))
+    assert again.lookup(["PRODUITS PHARMACEUTIQUES"]).tolist() == [1]
+    assert np.array_equal(pd.read_csv(index_file)["FE.RM.ID"], saved["FE.RM.ID"])
@@ -0,0 +1,78 @@
+import os
+import sys
+import logging
+
+import numpy as np
+
+# Même import que app.py : le package src est relatif au dossier embedding
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.rerank import CrossEncoderReranker
+
+
+class StubReranker(CrossEncoderReranker):
+    """
+    Cross-encoder factice : le score d'une paire est le nombre de mots communs ; garde les paires calculées.
+    """
+    def __init__(self):
+        self.logger = logging.getLogger('Bilan Carbone CHU')
+        self.cache_file = None
+        self.cache = {}
+        self.scored = []
+
+    def score_pairs(self, pairs, batch_size=32):
+        keys = [self._key(q, c) for q, c in pairs]
+        for (q, c), key in zip(pairs, keys):
+            if key not in self.cache:
+                self.scored.append(key)
+                self.cache[key] = float(len(set(q.split()) & set(c.split())))
+        return np.array([self.cache[key] for key in keys], dtype=np.float32)
+
+
+TARGETS = ["papier a4", "gants nitrile", "seringue sterile", "blouse coton"]
+
+
+def test_rerank_reorders_by_cross_encoder():
+    reranker = StubReranker()
+    queries = ["gants nitrile taille m", "blouse coton"]
+    top_indices = np.array([[0, 1], [2, 3]])
+    top_scores = np.array([[0.9, 0.8], [0.7, 0.6]])
+    scores, indices, ce_scores, report = reranker.rerank(queries, TARGETS, top_scores, top_indices)
+    assert indices.tolist() == [[1, 0], [3, 2]]
+    # Scores hybrides d'origine, suivant leur candidat
+    assert scores.tolist() == [[0.8, 0.9], [0.6, 0.7]]
+    assert ce_scores.tolist() == [[2, 0], [2, 0]]
+    assert report['reranked'] == 2 and report['top1_changed'] == 2 and report['pairs_computed'] == 4
+
+
+def test_pair_budget_skips_only_what_does_not_fit():
+    reranker = StubReranker()
+    queries = ["gants", "papier", "blouse"]
+    # Requête 0 la plus incertaine (écart 0), puis 1, puis 2
+    top_scores = np.array([[0.5, 0.5], [0.6, 0.5], [0.9, 0.1]])
+    top_indices = np.array([[0, 1], [0, 2], [3, 0]])
+    # Paires de la requête 2 déjà en cache : elle ne coûte rien
+    reranker.cache[reranker._key("blouse", "blouse coton")] = 1.0
+    reranker.cache[reranker._key("blouse", "papier a4")] = 0.0
+
+    _, indices, ce_scores, report = reranker.rerank(queries, TARGETS, top_scores, top_indices, max_pairs=3, batch_size=2)
+    # Blocs d'une requête : la 0 (2 paires) passe, la 1 (2 paires) dépasse le budget restant (1),
+    # la 2 (en cache) est tout de même re-classée
+    assert report['pairs_computed'] == 2
+    assert report['reranked'] == 2
+    assert np.isnan(ce_scores[1]).all()
+    assert indices[0].tolist() == [1, 0]
+    assert indices[1].tolist() == [0, 2]
+    assert not np.isnan(ce_scores[2]).any()
+    assert reranker.scored == [reranker._key("gants", "papier a4"), reranker._key("gants", "gants nitrile")]
+
+
+def test_pair_budget_trims_inside_a_block():
+    reranker = StubReranker()
+    queries = ["gants", "papier", "seringue"]
+    top_scores = np.array([[0.5, 0.5], [0.6, 0.5], [0.7, 0.5]])
+    top_indices = np.array([[0, 1], [0, 1], [2, 3]])
+    # Un seul bloc de trois requêtes, budget de 4 paires : la requête 2 ne tient pas, les deux premières oui
+    _, _, ce_scores, report = reranker.rerank(queries, TARGETS, top_scores, top_indices, max_pairs=4, batch_size=6)
+    assert report['pairs_computed'] == 4 and report['reranked'] == 2
+    assert np.isnan(ce_scores[2]).all() and not np.isnan(ce_scores[:2]).any()
@@ -0,0 +1,169 @@
+import os
+import sys
+import json
+import threading
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pytest
+
+# Même import que app.py : le package src est relatif au dossier embedding
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.service import MatchingService, start_server
+
+VOCAB = ["papier", "gants", "seringue", "blouse", "ecran", "clavier"]
+
+
+class StubModel:
+    """
+    Embedding en sac de mots sur VOCAB (normalisé L2) ; garde la taille de chaque lot reçu.
+    """
+    def __init__(self, delay: float = 0.0):
+        self.delay = delay
+        self.batch_sizes = []
+
+    def get_embeddings(self, texts, batch_size=32, normalize=True, progress=True):
+        self.batch_sizes.append(len(texts))
+        if self.delay:
+            threading.Event().wait(self.delay)
+        emb = np.array([[float(word in text.split()) for word in VOCAB] for text in texts], dtype=np.float32) + 1e-3
+        return emb / np.linalg.norm(emb, axis=1, keepdims=True)
+
+
+class StubMatcher:
+    """
+    Produit scalaire exact sur les cibles actives, même interface que Matcher pour le service.
+    """
+    def __init__(self, ids, texts):
+        self.target_ids = list(ids)
+        self.target_texts = list(texts)
+        self.target_embeddings = StubModel().get_embeddings(texts)
+        self.active = np.ones(len(ids), dtype=bool)
+
+    def match(self, source_embeddings, source_texts=None, k=1, normalized=None):
+        scores = source_embeddings @ self.target_embeddings.T
+        scores[:, ~self.active] = -1
+        top = np.argsort(-scores, axis=1, kind='stable')[:, :k]
+        return np.take_along_axis(scores, top, axis=1), top
+
+    def ids_of(self, indices):
+        return np.asarray(self.target_ids, dtype=object)[indices]
+
+
+def _post(url, payload):
+    request = urllib.request.Request(f"{url}/match", data=json.dumps(payload).encode("utf-8"),
+                                     headers={"Content-Type": "application/json"})
+    with urllib.request.urlopen(request, timeout=10) as response:
+        return json.load(response)
+
+
+def _get(url, path):
+    with urllib.request.urlopen(f"{url}{path}", timeout=10) as response:
+        return json.load(response)
+
+
+@pytest.fixture
+def running():
+    def start(model=None, max_batch=64, max_wait_ms=10.0):
+        model = model or StubModel()
+        matcher = StubMatcher(["FE1", "FE2", "FE3", "FE4"], ["papier", "gants", "seringue", "blouse"])
+        service = MatchingService(model, matcher, max_batch=max_batch, max_wait_ms=max_wait_ms)
+        server = start_server(service, port=0)
+        started.append((server, service))
+        return f"http://127.0.0.1:{server.server_address[1]}", service, matcher, model
+
+    started = []
+    yield start
+    for server, service in started:
+        server.shutdown()
+        server.server_close()
+        service.stop()
+
+
+def test_match_returns_top_k(running):
+    url, _, _, _ = running()
+    results = _post(url, {"texts": ["Gants nitrile", "seringue"], "k": 3})["results"]
+    assert [len(r) for r in results] == [3, 3]
+    assert [r[0]["id"] for r in results] == ["FE2", "FE3"]
+    assert results[0][0]["text"] == "gants"
+    assert results[0][0]["score"] >= results[0][1]["score"] >= results[0][2]["score"]
+    # Texte unique
+    assert _post(url, {"text": "blouse", "k": 1})["results"][0][0]["id"] == "FE4"
+
+
+def test_invalid_request(running):
+    url, _, _, _ = running()
+    with pytest.raises(urllib.error.HTTPError) as error:
+        _post(url, {"texts": "gants"})
+    assert error.value.code == 400
+
+
+def test_results_follow_matcher_updates(running):
+    url, _, matcher, _ = running()
+    matcher.active[1] = False
+    matcher.target_ids[2] = "FE3-bis"
+    assert _get(url, "/health") == {"status": "ok", "targets": 3}
+    results = _post(url, {"texts": ["gants", "seringue"], "k": 1})["results"]
+    assert results[0][0]["id"] != "FE2"
+    assert results[1][0]["id"] == "FE3-bis"
+
+
+def test_concurrent_clients_are_micro_batched(running):
+    # Modèle lent : les requêtes arrivées pendant un lot sont regroupées dans le suivant
+    url, service, _, model = running(model=StubModel(delay=0.05), max_wait_ms=20)
+    texts = [VOCAB[i % len(VOCAB)] for i in range(40)]
+    with ThreadPoolExecutor(max_workers=16) as pool:
+        results = list(pool.map(lambda t: _post(url, {"texts": [t], "k": 1})["results"], texts))
+
+    expected = {"papier": "FE1", "gants": "FE2", "seringue": "FE3", "blouse": "FE4"}
+    for text, result in zip(texts, results):
+        if text in expected:
+            assert result[0][0]["id"] == expected[text]
+    assert sum(model.batch_sizes) == len(texts)
+    assert len(model.batch_sizes) < len(texts)
+    assert max(model.batch_sizes) > 1
+
+    metrics = _get(url, "/metrics")
+    assert metrics["requests"] == metrics["texts"] == len(texts)
+    assert metrics["errors"] == 0
+    assert metrics["batches"] == len(model.batch_sizes)
+    assert metrics["mean_batch_size"] == pytest.approx(len(texts) / len(model.batch_sizes))
+    assert 0 < metrics["latency_p50_ms"] <= metrics["latency_p99_ms"] <= metrics["latency_max_ms"]
+
+
+def test_health_and_unknown_path(running):
+    url, _, _, _ = running()
+    assert _get(url, "/health") == {"status": "ok", "targets": 4}
+    assert _get(url, "/metrics") == {"requests": 0, "texts": 0, "errors": 0, "batches": 0}
+    with pytest.raises(urllib.error.HTTPError) as error:
+        _get(url, "/inconnu")
+    assert error.value.code == 404
+
+
+def test_stop_fails_queued_requests():
+    # Lots d'un texte et modèle lent : pendant le premier lot, les autres requêtes restent en file
+    model = StubModel(delay=0.3)
+    service = MatchingService(model, StubMatcher(["FE1"], ["papier"]), max_batch=1).start()
+    outcomes = []
+
+    def call():
+        try:
+            outcomes.append(service.submit(["papier"], timeout=30))
+        except Exception as e:
+            outcomes.append(e)
+
+    clients = [threading.Thread(target=call) for _ in range(3)]
+    for client in clients:
+        client.start()
+    while not model.batch_sizes or service._queue.qsize() < 2:
+        threading.Event().wait(0.001)
+    service.stop()
+    for client in clients:
+        client.join(timeout=5)
+    assert not any(client.is_alive() for client in clients)
+    errors = [o for o in outcomes if isinstance(o, Exception)]
+    assert len(errors) == 2 and all(isinstance(e, RuntimeError) for e in errors)
+    with pytest.raises(RuntimeError):
+        service.submit(["papier"])
@@ -0,0 +1,39 @@
+import os
+import sys
+import json
+import subprocess
+
+EMBEDDING_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HEAVY = ("torch", "transformers", "faiss", "sklearn", "rank_bm25")
+
+# Lance app.py (même point d'entrée que `python app.py ...`) puis liste les modules lourds chargés
+SCRIPT = """
+import sys, json, runpy
+sys.argv = ["app.py"] + json.loads(sys.argv[1])
+try:
+    runpy.run_path({app!r}, run_name="__main__")
+except SystemExit:
+    pass
+print(json.dumps(sorted(m for m in {modules!r} if m in sys.modules)))
+"""
+
+
+def _loaded_modules(args, cwd):
+    script = SCRIPT.format(app=os.path.join(EMBEDDING_DIR, "app.py"), modules=HEAVY + ("pandas",))
+    result = subprocess.run([sys.executable, "-c", script, json.dumps(args)], cwd=cwd, capture_output=True,
+                            text=True, timeout=120)
+    assert result.returncode == 0, result.stderr
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def test_help_loads_no_heavy_module(tmp_path):
+    assert _loaded_modules(["--help"], tmp_path) == []
+
+
+def test_preprocess_only_loads_no_model_library(tmp_path):
+    # Dossier de travail sans données : le prétraitement s'arrête tôt, mais après les imports de l'étape
+    workdir = tmp_path / "embedding"
+    workdir.mkdir()
+    loaded = _loaded_modules(["-p"], workdir)
+    assert "pandas" in loaded
+    assert not set(loaded) & set(HEAVY)
@@ -0,0 +1,204 @@
+import pandas as pd
+import numpy as np
+
+from tools import SparseWeights
+
+# Vectorized performance analytics for the backtest outputs of tools.py (portfolio_with_drift /
+# portfolio_without_drift): rolling and expanding tracking error and active return, drawdowns and
+# their durations, and a daily Brinson sector attribution. Every series is computed in one NumPy pass
+# (cumulative sums, running maxima, bincount / matrix products over the date x asset arrays) and the
+# results are returned together as a single tidy frame: date, metric, sector, value.
+
+def _returns(values: np.ndarray) -> np.ndarray:
+    # Simple returns, NaN on the first date (no previous value)
+    returns = np.full(len(values), np.nan)
+    returns[1:] = values[1:] / values[:-1] - 1
+    return returns
+
+def _windowed_sums(x: np.ndarray, window: int = None):
+    """
+    Sums of x and x**2 over a rolling window (expanding when window is None), with the number of
+    non-NaN observations. NaNs are skipped (the first return is NaN), as in pandas: an expanding value
+    uses every observation so far, a rolling value needs window observations (NaN otherwise, like
+    pd.Series.rolling(window).std()). x is centred on its mean first so that s2 - s1**2 / n does not
+    cancel out large sums.
+    """
+    valid = ~np.isnan(x)
+    centred = x - x[valid].mean() if valid.any() else x
+    c1 = np.concatenate([[0.0], np.nancumsum(centred)])
+    c2 = np.concatenate([[0.0], np.nancumsum(centred ** 2)])
+    cn = np.concatenate([[0.0], np.cumsum(valid, dtype=np.float64)])
+    if window is None:
+        return c1[1:], c2[1:], cn[1:]
+    start = np.maximum(np.arange(1, len(x) + 1) - window, 0)
+    s1, s2, n = c1[1:] - c1[start], c2[1:] - c2[start], cn[1:] - cn[start]
+    # Incomplete windows (or with a NaN gap) are not reported
+    incomplete = n < window
+    s1[incomplete] = s2[incomplete] = np.nan
+    return s1, s2, n
+
+def _std(s1: np.ndarray, s2: np.ndarray, n: np.ndarray) -> np.ndarray:
+    # Sample standard deviation (ddof=1) from the sums, as in compute_tracking_error
+    with np.errstate(invalid="ignore", divide="ignore"):
+        var = (s2 - s1 ** 2 / n) / (n - 1)
+    var[n < 2] = np.nan
+    return np.sqrt(np.maximum(var, 0))
+
+def tracking_error(portfolio_value: pd.Series, benchmark_value: pd.Series, window: int = 63, period: int = 252) -> pd.DataFrame:
+    """
+    Compute the rolling and expanding tracking error and active return.
+
+    Parameters:
+    portfolio_value (pd.Series): Portfolio value over time (e.g. output of portfolio_with_drift).
+    benchmark_value (pd.Series): Benchmark value over time.
+    window (int): Rolling window in periods (63 trading days = one quarter).
+    period (int): Number of periods per year for the annualisation.
+
+    Returns:
+    pd.DataFrame: Columns active_return (daily), rolling_te, expanding_te (annualised), rolling_active_return,
+    expanding_active_return (portfolio minus benchmark return over the window / since the start).
+    """
+    portfolio_value, benchmark_value = portfolio_value.align(benchmark_value, join="inner")
+    p = portfolio_value.to_numpy(dtype=np.float64)
+    b = benchmark_value.to_numpy(dtype=np.float64)
+    active = _returns(p) - _returns(b)
+
+    rolling_te = _std(*_windowed_sums(active, window)) * np.sqrt(period)
+    expanding_te = _std(*_windowed_sums(active)) * np.sqrt(period)
+
+    rolling_active = np.full(len(p), np.nan)
+    rolling_active[window:] = (p[window:] / p[:-window]) - (b[window:] / b[:-window])
+    expanding_active = p / p[0] - b / b[0]
+
+    return pd.DataFrame({
+        "active_return": active,
+        "rolling_te": rolling_te,
+        "expanding_te": expanding_te,
+        "rolling_active_return": rolling_active,
+        "expanding_active_return": expanding_active,
+    }, index=portfolio_value.index)
+
+def drawdowns(values: pd.Series) -> pd.DataFrame:
+    """
+    Compute the drawdown series and its duration.
+
+    Parameters:
+    values (pd.Series): Value over time (portfolio, benchmark, or relative value portfolio / benchmark).
+
+    Returns:
+    pd.DataFrame: Columns drawdown (value / running peak - 1, <= 0) and duration (periods since the last peak).
+    """
+    v = values.to_numpy(dtype=np.float64)
+    peak = np.maximum.accumulate(v)
+    positions = np.arange(len(v))
+    last_peak = np.maximum.accumulate(np.where(v >= peak, positions, 0))
+    return pd.DataFrame({"drawdown": v / peak - 1, "duration": positions - last_peak}, index=values.index)
+
+def _sector_sums(weights, returns: np.ndarray, dates: pd.DatetimeIndex, columns: pd.Index,
+                 sector_codes: np.ndarray, n_sectors: int):
+    """
+    Sum of weights and of weight x return per (date, sector), as (dates x sectors) arrays.
+    Weights in force on a date are its row, or the last row before it (same convention as
+    portfolio_without_drift); the weights of date t apply to the returns of date t, as in tools.py.
+    """
+    n_dates = len(dates)
+    if isinstance(weights, SparseWeights):
+        weights = weights.align_assets(columns)
+        rows = weights.dates.searchsorted(dates, side="right") - 1
+        lengths = np.where(rows >= 0, np.diff(weights.indptr)[np.maximum(rows, 0)], 0)
+        # Holdings of every date, flattened: positions in the CSR arrays
+        offsets = np.cumsum(lengths) - lengths
+        flat = np.repeat(weights.indptr[np.maximum(rows, 0)] - offsets, lengths) + np.arange(lengths.sum())
+        date_ids = np.repeat(np.arange(n_dates), lengths)
+        cols = weights.indices[flat]
+        w = weights.data[flat]
+        keys = date_ids * n_sectors + sector_codes[cols]
+        size = n_dates * n_sectors
+        weight_sum = np.bincount(keys, weights=w, minlength=size)
+        weighted_return = np.bincount(keys, weights=w * returns[date_ids, cols], minlength=size)
+        return weight_sum.reshape(n_dates, n_sectors), weighted_return.reshape(n_dates, n_sectors)
+
+    w = weights.reindex(columns=columns).reindex(dates).ffill().fillna(0).to_numpy(dtype=np.float64)
+    one_hot = np.zeros((len(columns), n_sectors))
+    one_hot[np.arange(len(columns)), sector_codes] = 1
+    return w @ one_hot, (w * returns) @ one_hot
+
+def sector_attribution(portfolio_weights, benchmark_weights, prices: pd.DataFrame, metadata: pd.DataFrame) -> dict:
+    """
+    Compute a daily Brinson-Fachler sector attribution of the active return.
+
+    Parameters:
+    portfolio_weights (pd.DataFrame | SparseWeights): Portfolio weights (e.g. daily weights from portfolio_with_drift).
+    benchmark_weights (pd.DataFrame | SparseWeights): Benchmark weights (e.g. universe).
+    prices (pd.DataFrame): DataFrame containing the asset prices with dates as index and asset IDs as columns.
+    metadata (pd.DataFrame): Asset metadata with ID and SECTOR columns (metadata.parquet).
+
+    Returns:
+    dict: 'sectors' (list of sector names) and (dates x sectors) arrays 'allocation', 'selection' and
+    'interaction'; summed over sectors they equal the daily portfolio minus benchmark return when both
+    weight sets sum to one.
+    """
+    returns = prices.pct_change(fill_method=None).fillna(0).to_numpy()
+    sector_of = metadata.drop_duplicates("ID").set_index("ID")["SECTOR"].reindex(prices.columns).fillna("Unknown")
+    sector_codes, sectors = pd.factorize(sector_of)
+    args = (returns, prices.index, prices.columns, sector_codes, len(sectors))
+    wp, wrp = _sector_sums(portfolio_weights, *args)
+    wb, wrb = _sector_sums(benchmark_weights, *args)
+
+    benchmark_total = wrb.sum(axis=1, keepdims=True)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        # Sector returns; sectors without holdings take the benchmark sector (or total) return
+        rb = np.where(wb > 0, wrb / wb, benchmark_total)
+        rp = np.where(wp > 0, wrp / wp, rb)
+    return {
+        "sectors": list(sectors),
+        "allocation": (wp - wb) * (rb - benchmark_total),
+        "selection": wb * (rp - rb),
+        "interaction": (wp - wb) * (rp - rb),
+    }
+
+def performance_report(portfolio_value: pd.Series, benchmark_value: pd.Series, portfolio_weights=None,
+                       benchmark_weights=None, prices: pd.DataFrame = None, metadata: pd.DataFrame = None,
+                       window: int = 63, period: int = 252) -> pd.DataFrame:
+    """
+    Compute all analytics and return them as one tidy frame.
+
+    Parameters:
+    portfolio_value, benchmark_value (pd.Series): Values over time (outputs of portfolio_with_drift / portfolio_without_drift).
+    portfolio_weights, benchmark_weights (pd.DataFrame | SparseWeights): Optional weights for the sector attribution,
+        which also requires prices and metadata.
+    window (int): Rolling window in periods; period (int): periods per year.
+
+    Returns:
+    pd.DataFrame: Columns date, metric, sector, value. Metrics: active_return, rolling_te, expanding_te,
+    rolling_active_return, expanding_active_return, drawdown_* and drawdown_duration_* for the portfolio,
+    the benchmark and the relative value (active), and allocation / selection / interaction per sector.
+    """
+    portfolio_value, benchmark_value = portfolio_value.align(benchmark_value, join="inner")
+    dates = portfolio_value.index
+    columns = {}
+    for name, values in tracking_error(portfolio_value, benchmark_value, window, period).items():
+        columns[(name, None)] = values.to_numpy()
+    for label, values in (("portfolio", portfolio_value), ("benchmark", benchmark_value),
+                          ("active", portfolio_value / benchmark_value)):
+        dd = drawdowns(values)
+        columns[(f"drawdown_{label}", None)] = dd["drawdown"].to_numpy()
+        columns[(f"drawdown_duration_{label}", None)] = dd["duration"].to_numpy(dtype=np.float64)
+
+    if portfolio_weights is not None and benchmark_weights is not None:
+        if prices is None or metadata is None:
+            raise ValueError("prices and metadata are required for the sector attribution.")
+        attribution = sector_attribution(portfolio_weights, benchmark_weights, prices.reindex(dates), metadata)
+        for effect in ("allocation", "selection", "interaction"):
+            for s, sector in enumerate(attribution["sectors"]):
+                columns[(effect, sector)] = attribution[effect][:, s]
+
+    # Long format in one construction: every series has one value per date
+    keys = list(columns)
+    values = np.concatenate([columns[k] for k in keys])
+    return pd.DataFrame({
+        "date": np.tile(dates.to_numpy(), len(keys)),
+        "metric": np.repeat([k[0] for k in keys], len(dates)),
+        "sector": np.repeat(np.array([k[1] for k in keys], dtype=object), len(dates)),
+        "value": values,
+    })
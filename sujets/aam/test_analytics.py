@@ -0,0 +1,52 @@
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+# analytics.py imports tools.py as a top-level module (scripts are run from this folder)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from analytics import _std, _windowed_sums, tracking_error
+
+
+def _returns_with_gap(n=400, seed=0):
+    rng = np.random.default_rng(seed)
+    # Large common level: the uncentred s2 - s1**2 / n would lose most of the digits
+    x = 1e3 + rng.normal(scale=1e-3, size=n)
+    x[0] = np.nan
+    x[120:125] = np.nan
+    x[300] = np.nan
+    return x
+
+
+def test_rolling_std_matches_pandas_with_nan_gap():
+    x = _returns_with_gap()
+    for window in (5, 20, 63):
+        expected = pd.Series(x).rolling(window).std().to_numpy()
+        result = _std(*_windowed_sums(x, window))
+        np.testing.assert_array_equal(np.isnan(result), np.isnan(expected))
+        np.testing.assert_allclose(result, expected, rtol=1e-6, equal_nan=True)
+    # Values after the gap are reported again once the window is full
+    assert not np.isnan(result[-1])
+
+
+def test_expanding_std_matches_pandas_with_nan_gap():
+    x = _returns_with_gap()
+    expected = pd.Series(x).expanding().std().to_numpy()
+    result = _std(*_windowed_sums(x))
+    np.testing.assert_array_equal(np.isnan(result), np.isnan(expected))
+    np.testing.assert_allclose(result, expected, rtol=1e-6, equal_nan=True)
+
+
+def test_tracking_error_skips_missing_values():
+    dates = pd.bdate_range("2024-01-01", periods=200)
+    rng = np.random.default_rng(1)
+    portfolio = pd.Series(100 * np.cumprod(1 + rng.normal(scale=0.01, size=200)), index=dates)
+    benchmark = pd.Series(100 * np.cumprod(1 + rng.normal(scale=0.01, size=200)), index=dates)
+    portfolio.iloc[50] = np.nan
+
+    te = tracking_error(portfolio, benchmark, window=20, period=252)
+    active = portfolio.pct_change(fill_method=None) - benchmark.pct_change(fill_method=None)
+    np.testing.assert_allclose(te["rolling_te"], active.rolling(20).std() * np.sqrt(252), rtol=1e-9, equal_nan=True)
+    np.testing.assert_allclose(te["expanding_te"], active.expanding().std() * np.sqrt(252), rtol=1e-9, equal_nan=True)
+    assert te["expanding_te"].iloc[60:].notna().all()
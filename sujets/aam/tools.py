@@ -2,6 +2,101 @@ import pandas as pd
 import numpy as np
 import datetime
 
+
+class SparseWeights:
+    """
+    Compact weight matrix: one CSR row per rebalance date, storing only the non-zero holdings.
+
+    Memory scales with the number of holdings instead of dates x full universe. The row of a date
+    holds the complete target portfolio: an asset absent from the row has a zero weight.
+
+    Attributes:
+    dates (pd.DatetimeIndex): Rebalance dates, sorted (one row each).
+    assets (pd.Index): Asset IDs indexed by the column numbers in `indices`.
+    indptr, indices, data (np.ndarray): CSR arrays; the holdings of row k are
+        assets[indices[indptr[k]:indptr[k + 1]]] with weights data[indptr[k]:indptr[k + 1]].
+    """
+
+    def __init__(self, dates, assets, indptr, indices, data):
+        self.dates = pd.DatetimeIndex(dates)
+        self.assets = pd.Index(assets)
+        self.indptr = np.asarray(indptr, dtype=np.int64)
+        self.indices = np.asarray(indices, dtype=np.int64)
+        self.data = np.asarray(data, dtype=np.float64)
+
+    @classmethod
+    def from_frame(cls, weights: pd.DataFrame) -> "SparseWeights":
+        """
+        Build from a wide date x asset frame (e.g. universe.parquet). NaN and zero weights are dropped.
+        """
+        weights = weights.sort_index()
+        values = weights.to_numpy(dtype=np.float64)
+        rows, cols = np.nonzero(np.nan_to_num(values))
+        indptr = np.concatenate([[0], np.cumsum(np.bincount(rows, minlength=len(weights)))])
+        return cls(weights.index, weights.columns, indptr, cols, values[rows, cols])
+
+    def __len__(self) -> int:
+        return len(self.dates)
+
+    def __contains__(self, date) -> bool:
+        return pd.Timestamp(date) in self.dates
+
+    @property
+    def nnz(self) -> int:
+        return len(self.data)
+
+    @property
+    def nbytes(self) -> int:
+        return self.indptr.nbytes + self.indices.nbytes + self.data.nbytes
+
+    def row_ids(self) -> np.ndarray:
+        """
+        Row number of every stored holding (CSR expanded to COO rows).
+        """
+        return np.repeat(np.arange(len(self.dates)), np.diff(self.indptr))
+
+    def row(self, k: int) -> pd.Series:
+        """
+        Holdings of the k-th rebalance as a Series (asset ID -> weight).
+        """
+        sl = slice(self.indptr[k], self.indptr[k + 1])
+        return pd.Series(self.data[sl], index=self.assets[self.indices[sl]])
+
+    def loc(self, date) -> pd.Series:
+        """
+        Holdings of an exact rebalance date.
+        """
+        return self.row(self.dates.get_loc(pd.Timestamp(date)))
+
+    def asof(self, date) -> pd.Series:
+        """
+        Holdings in force at a date: last rebalance on or before it.
+        """
+        k = self.dates.searchsorted(pd.Timestamp(date), side="right") - 1
+        if k < 0:
+            raise ValueError("No rebalance date on or before the requested date.")
+        return self.row(k)
+
+    def align_assets(self, columns) -> "SparseWeights":
+        """
+        Re-express the column numbers against another asset list (e.g. prices.columns).
+        Holdings of assets missing from `columns` are dropped.
+        """
+        columns = pd.Index(columns)
+        new_cols = columns.get_indexer(self.assets)[self.indices]
+        keep = new_cols >= 0
+        counts = np.bincount(self.row_ids()[keep], minlength=len(self.dates))
+        indptr = np.concatenate([[0], np.cumsum(counts)])
+        return SparseWeights(self.dates, columns, indptr, new_cols[keep], self.data[keep])
+
+    def to_frame(self) -> pd.DataFrame:
+        """
+        Dense date x asset frame (zeros for assets not held). For inspection on small slices only.
+        """
+        dense = np.zeros((len(self.dates), len(self.assets)))
+        dense[self.row_ids(), self.indices] = self.data
+        return pd.DataFrame(dense, index=self.dates, columns=self.assets)
+
 def compute_temperature(itr: pd.DataFrame, date: pd.Timestamp, weights: pd.Series) -> float:
     """
     Compute the temperature factor for a given date.
@@ -9,7 +104,8 @@ def compute_temperature(itr: pd.DataFrame, date: pd.Timestamp, weights: pd.Serie
     Parameters:
     itr (pd.DataFrame): DataFrame containing the ITR values with dates as index and asset IDs as columns.
     date (pd.Timestamp): The date for which to compute the temperature factor.
-    weights (pd.Series): Series containing the weights for each asset ID.
+    weights (pd.Series | SparseWeights): Series containing the weights for each asset ID, or sparse
+        weights (the last rebalance on or before `date` is used).
 
     Returns:
     float: The temperature factor for the specified date.
@@ -19,6 +115,8 @@ def compute_temperature(itr: pd.DataFrame, date: pd.Timestamp, weights: pd.Serie
         date = pd.to_datetime(date)
     elif isinstance(date, datetime.datetime) or isinstance(date, datetime.date):
         date = pd.Timestamp(date)
+    if isinstance(weights, SparseWeights):
+        weights = weights.asof(date)
 
     # Find the previous date with available ITR data
     prev_date = itr.index[itr.index < date].max()
@@ -39,7 +137,8 @@ def compute_esg_score(esg_score: pd.DataFrame, date: pd.Timestamp, weights: pd.S
     Parameters:
     esg_score (pd.DataFrame): DataFrame containing the ESG scores with dates as index and asset IDs as columns.
     date (pd.Timestamp): The date for which to compute the ESG score factor.
-    weights (pd.Series): Series containing the weights for each asset ID.
+    weights (pd.Series | SparseWeights): Series containing the weights for each asset ID, or sparse
+        weights (the last rebalance on or before `date` is used).
 
     Returns:
     float: The ESG score factor for the specified date.
@@ -49,6 +148,8 @@ def compute_esg_score(esg_score: pd.DataFrame, date: pd.Timestamp, weights: pd.S
         date = pd.to_datetime(date)
     elif isinstance(date, datetime.datetime) or isinstance(date, datetime.date):
         date = pd.Timestamp(date)
+    if isinstance(weights, SparseWeights):
+        weights = weights.asof(date)
 
     # Find the previous date with available ESG score data
     prev_date = esg_score.index[esg_score.index < date].max()
@@ -62,6 +163,38 @@ def compute_esg_score(esg_score: pd.DataFrame, date: pd.Timestamp, weights: pd.S
     esg_factor = (esg_values * weights).sum() / weights.sum()
     return esg_factor
 
+def compute_factor_series(factor: pd.DataFrame, weights) -> pd.Series:
+    """
+    Compute a weighted-average factor (ITR temperature, ESG score) at every rebalance date in one pass.
+    Same convention as compute_temperature / compute_esg_score: the factor values of the previous
+    available date are used, missing values count as zero in the numerator but their weight stays
+    in the denominator.
+
+    Parameters:
+    factor (pd.DataFrame): DataFrame containing the factor values with dates as index and asset IDs as columns.
+    weights (SparseWeights | pd.DataFrame): Weights with rebalance dates as index.
+
+    Returns:
+    pd.Series: The factor value for each rebalance date (NaN when no previous factor date exists).
+    """
+    if not isinstance(weights, SparseWeights):
+        weights = SparseWeights.from_frame(weights)
+    factor = factor.sort_index()
+    aligned = weights.align_assets(factor.columns)
+
+    # Previous factor date (strictly before) of each rebalance date
+    prev = factor.index.searchsorted(aligned.dates, side="left") - 1
+    rows = aligned.row_ids()
+    values = np.nan_to_num(factor.to_numpy(dtype=np.float64)[np.maximum(prev, 0)[rows], aligned.indices])
+
+    numerator = np.bincount(rows, weights=aligned.data * values, minlength=len(aligned))
+    # Denominator over all holdings, including assets without factor column
+    denominator = np.bincount(weights.row_ids(), weights=weights.data, minlength=len(weights))
+    with np.errstate(invalid="ignore", divide="ignore"):
+        result = numerator / denominator
+    result[prev < 0] = np.nan
+    return pd.Series(result, index=weights.dates)
+
 def compute_turnover(prev_weights: pd.Series, current_weights: pd.Series) -> float:
     """
     Compute the turnover between two weight distributions.
@@ -83,6 +216,29 @@ def compute_turnover(prev_weights: pd.Series, current_weights: pd.Series) -> flo
     turnover = (prev_aligned - current_aligned).abs().sum() / 2
     return turnover
 
+def compute_turnover_series(weights) -> pd.Series:
+    """
+    Compute the turnover between consecutive rebalance dates in one pass over the holdings.
+
+    Parameters:
+    weights (SparseWeights | pd.DataFrame): Weights with rebalance dates as index.
+
+    Returns:
+    pd.Series: Turnover at each rebalance date (the first date is compared to an empty portfolio).
+    """
+    if not isinstance(weights, SparseWeights):
+        weights = SparseWeights.from_frame(weights)
+    n_assets = len(weights.assets)
+    rows = weights.row_ids()
+
+    # Weight changes keyed by (rebalance, asset): +w for the current row, -w for the same holding one row later
+    keys = np.concatenate([rows * n_assets + weights.indices, (rows + 1) * n_assets + weights.indices])
+    deltas = np.concatenate([weights.data, -weights.data])
+    keys, inverse = np.unique(keys, return_inverse=True)
+    changes = np.bincount(inverse, weights=deltas)
+    turnover = np.bincount(keys // n_assets, weights=np.abs(changes), minlength=len(weights) + 1)[:len(weights)] / 2
+    return pd.Series(turnover, index=weights.dates)
+
 def compute_tracking_error(portfolio_returns: pd.Series, benchmark_returns: pd.Series, period: int = 252) -> float:
     """
     Compute the tracking error between portfolio returns and benchmark returns.
@@ -110,12 +266,17 @@ def portfolio_with_drift(weights, prices):
     Rebalances only on dates where weights are defined in the original weights DataFrame.
 
     Parameters:
-    weights (pd.DataFrame): DataFrame containing the target weights with dates as index and asset IDs as columns.
+    weights (pd.DataFrame | SparseWeights): DataFrame containing the target weights with dates as index and asset IDs as columns,
+        or sparse weights (rebalance rows only).
     prices (pd.DataFrame): DataFrame containing the asset prices with dates as index and asset IDs as columns.
 
     Returns:
     pd.Series: Series containing the portfolio value over time.
+    pd.DataFrame | SparseWeights: Daily weights (one sparse row per price date for sparse input).
     """
+    if isinstance(weights, SparseWeights):
+        return _portfolio_with_drift_sparse(weights, prices)
+
     returns = prices.pct_change(fill_method=None).fillna(0)
     
     # Forward fill weights to all dates (but only rebalance on original dates)
@@ -159,14 +320,90 @@ def portfolio_without_drift(weights, prices):
     Rebalances on every date to the specified weights
     
     Parameters:
-    weights (pd.DataFrame): DataFrame containing the target weights with dates as index and asset IDs as columns.
+    weights (pd.DataFrame | SparseWeights): DataFrame containing the target weights with dates as index and asset IDs as columns,
+        or sparse weights (rebalance rows only).
     prices (pd.DataFrame): DataFrame containing the asset prices with dates as index and asset IDs as columns.
 
     Returns:
     pd.Series: Series containing the portfolio value over time.
+    pd.DataFrame | SparseWeights: Daily weights, or for sparse input the rebalance rows in force on price
+        dates (each applies until the next one; an asset missing from a row has a zero weight, whereas
+        the DataFrame path forward-fills NaN cells from earlier rebalances).
     """
+    if isinstance(weights, SparseWeights):
+        return _portfolio_without_drift_sparse(weights, prices)
+
     returns = prices.pct_change(fill_method=None).fillna(0)
     weights_filled = weights.reindex_like(prices).ffill()
 
     portfolio_value = (returns * weights_filled).sum(axis=1).add(1).cumprod()
-    return portfolio_value, weights_filled
\ No newline at end of file
+    return portfolio_value, weights_filled
+
+def _rebalance_periods(weights, prices):
+    """
+    Rebalance rows falling on price dates, with the [start, end) price positions during which each applies.
+    Like the DataFrame path, rebalance dates absent from prices.index are ignored.
+    """
+    weights = weights.align_assets(prices.columns)
+    positions = prices.index.get_indexer(weights.dates)
+    rows = np.flatnonzero(positions >= 0)
+    starts = positions[rows]
+    ends = np.append(starts[1:], len(prices.index))
+    return weights, rows, starts, ends
+
+def _portfolio_without_drift_sparse(weights, prices):
+    """
+    portfolio_without_drift for SparseWeights: each period is a product of the held columns' returns
+    with the rebalance row, without materialising daily weights.
+    """
+    returns = prices.pct_change(fill_method=None).fillna(0).to_numpy()
+    weights, rows, starts, ends = _rebalance_periods(weights, prices)
+    portfolio_returns = np.zeros(len(prices.index))
+    for k, start, end in zip(rows, starts, ends):
+        sl = slice(weights.indptr[k], weights.indptr[k + 1])
+        portfolio_returns[start:end] = returns[start:end, weights.indices[sl]] @ weights.data[sl]
+
+    portfolio_value = pd.Series(portfolio_returns + 1, index=prices.index).cumprod()
+    indptr = np.concatenate([[0], np.cumsum(np.diff(weights.indptr)[rows])])
+    keep = np.concatenate([np.arange(weights.indptr[k], weights.indptr[k + 1]) for k in rows]) if len(rows) else np.array([], dtype=np.int64)
+    in_force = SparseWeights(prices.index[starts], weights.assets, indptr, weights.indices[keep], weights.data[keep])
+    return portfolio_value, in_force
+
+def _portfolio_with_drift_sparse(weights, prices):
+    """
+    portfolio_with_drift for SparseWeights. Between two rebalances, the drifted weights are the rebalance
+    weights times the cumulative growth of each held asset, renormalised to sum to one: one cumulative
+    product per period over the held columns only, instead of a loop over every date and asset.
+    """
+    returns = prices.pct_change(fill_method=None).fillna(0).to_numpy()
+    weights, rows, starts, ends = _rebalance_periods(weights, prices)
+    portfolio_returns = np.zeros(len(prices.index))
+    daily_counts = np.zeros(len(prices.index), dtype=np.int64)
+    daily_indices, daily_data = [], []
+
+    for k, start, end in zip(rows, starts, ends):
+        sl = slice(weights.indptr[k], weights.indptr[k + 1])
+        cols, target = weights.indices[sl], weights.data[sl]
+        period = returns[start:end, cols]
+
+        # Rebalance day: target weights (not renormalised), applied to that day's returns
+        drifted = np.empty((end - start, len(cols)))
+        drifted[0] = target
+        if end - start > 1:
+            drifted[1:] = target * np.cumprod(1 + period[1:], axis=0)
+            totals = drifted[1:].sum(axis=1, keepdims=True)
+            drifted[1:] = np.where(totals > 0, drifted[1:] / np.where(totals > 0, totals, 1), drifted[1:])
+        portfolio_returns[start:end] = (drifted * period).sum(axis=1)
+
+        daily_counts[start:end] = len(cols)
+        daily_indices.append(np.tile(cols, end - start))
+        daily_data.append(drifted.ravel())
+    # First date: initial value, no return
+    portfolio_returns[0] = 0
+
+    portfolio_value = pd.Series(portfolio_returns + 1, index=prices.index).cumprod()
+    indptr = np.concatenate([[0], np.cumsum(daily_counts)])
+    daily_weights = SparseWeights(prices.index, weights.assets, indptr,
+                                  np.concatenate(daily_indices) if daily_indices else np.array([], dtype=np.int64),
+                                  np.concatenate(daily_data) if daily_data else np.array([]))
+    return portfolio_value, daily_weights